@@ -24,6 +24,19 @@ class QUERY_OP_RELATION(Enum):
     IPREFIX = ('iprefix',)  # string like only
     CONTAINS = ('contains',)  # ArrayField only
     CONTAINS_ANY = ('contains_any',)  # ArrayField only
+    MATCH = ('match',)  # full-text search, column must have a full-text index
+
+
+class COUNT_STRATEGY(Enum):
+    SEPARATE = 'separate'  # 单独执行一次 COUNT
+    WINDOW = 'window'  # 在查询中附带 COUNT(*) OVER()，只需一次查询
+    CONCURRENT = 'concurrent'  # COUNT 与分页查询并发执行
+    ESTIMATED = 'estimated'  # 读取数据库的统计信息，结果不精确
+
+
+class INDEX_TYPE(Enum):
+    HASH = 'hash'  # eq / in
+    SORTED = 'sorted'  # eq / in / lt / le / gt / ge / prefix
 
 
 QUERY_OP_FROM_TXT = {}
@@ -1,15 +1,21 @@
+import asyncio
+import functools
 from abc import ABC
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from typing import Any, Dict, Union, List, Type, Iterable
+from typing import Any, Dict, Union, List, Type, Iterable, AsyncIterator, Optional, Callable, Awaitable, Tuple, Set, \
+    Sequence
 
 import pydantic
 
-from pycrud.const import QUERY_OP_RELATION
+from pycrud.const import QUERY_OP_RELATION, QUERY_OP_COMPARE
 from pycrud.crud._core_crud import CoreCrud
 from pycrud.crud.query_result_row import QueryResultRow, QueryResultRowList
+from pycrud.crud.transaction import Transaction, get_transaction, set_transaction, reset_transaction
 from pycrud.error import PermissionException, InvalidQueryValue
 from pycrud.permission import RoleDefine, A
-from pycrud.query import QueryInfo, QueryConditions, ConditionExpr, QueryJoinInfo, ConditionLogicExpr, UnaryExpr
+from pycrud.query import QueryInfo, QueryConditions, ConditionExpr, QueryJoinInfo, ConditionLogicExpr, UnaryExpr, \
+    parse_foreign_key_name
 from pycrud.types import RecordMapping, IDList, RecordMappingField
 from pycrud.values import ValuesToWrite
 
@@ -28,6 +34,102 @@ class PermInfo:
 class BaseCrud(CoreCrud, ABC):
     permission: Any
 
+    # get_list_with_foreign_keys 中同时进行的外键查询数量
+    fk_query_concurrency = 8
+
+    def get_transaction(self) -> Optional[Transaction]:
+        """
+        当前上下文中正在进行的事务
+        """
+        return get_transaction(id(self))
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Transaction]:
+        """
+        事务作用域：async with crud.transaction(): ...
+        其中的全部 crud 调用共用一个连接，结束时提交一次，出现异常时回滚；嵌套的作用域以保存点实现。
+        insert/update/delete 的 when_complete 钩子推迟到最外层提交之后执行，回滚时不再执行
+        """
+        parent = self.get_transaction()
+        tx = Transaction(parent)
+        token = set_transaction(id(self), tx)
+
+        try:
+            if parent is None:
+                await self._tx_begin(tx)
+            else:
+                await self._tx_savepoint(tx)
+
+            try:
+                yield tx
+            except BaseException:
+                if parent is None:
+                    await self._tx_rollback(tx)
+                else:
+                    await self._tx_rollback_to_savepoint(tx)
+                for i in tx.after_rollback:
+                    await i()
+                raise
+
+            try:
+                if parent is None:
+                    await self._tx_commit(tx)
+                else:
+                    await self._tx_release_savepoint(tx)
+            except BaseException:
+                # 提交失败时 _tx_commit 已回滚并释放连接；释放保存点失败时回滚到保存点，外层事务仍可继续
+                if parent is not None:
+                    try:
+                        await self._tx_rollback_to_savepoint(tx)
+                    except Exception:
+                        # 以原始错误为准，外层随之回滚
+                        pass
+                for i in tx.after_rollback:
+                    await i()
+                raise
+        finally:
+            reset_transaction(token)
+
+        if parent is None:
+            for i in tx.after_commit:
+                await i()
+        else:
+            parent.after_commit.extend(tx.after_commit)
+            # 外层回滚时，已释放的保存点中的写入同样被撤销
+            parent.after_rollback.extend(tx.after_rollback)
+
+    async def _run_when_complete(self, when_complete: List[Callable[..., Awaitable]], *args):
+        """
+        执行写操作的 when_complete 钩子，处于事务之中时推迟到提交之后
+        """
+        tx = self.get_transaction()
+        for i in when_complete:
+            if tx is None:
+                await i(*args)
+            else:
+                tx.after_commit.append(functools.partial(i, *args))
+
+    async def _tx_begin(self, tx: Transaction):
+        raise NotImplementedError('%s does not support transaction' % type(self).__name__)
+
+    async def _tx_commit(self, tx: Transaction):
+        """
+        提交失败时须回滚事务并释放连接，再抛出异常
+        """
+        raise NotImplementedError('%s does not support transaction' % type(self).__name__)
+
+    async def _tx_rollback(self, tx: Transaction):
+        raise NotImplementedError('%s does not support transaction' % type(self).__name__)
+
+    async def _tx_savepoint(self, tx: Transaction):
+        raise NotImplementedError('%s does not support transaction' % type(self).__name__)
+
+    async def _tx_release_savepoint(self, tx: Transaction):
+        raise NotImplementedError('%s does not support transaction' % type(self).__name__)
+
+    async def _tx_rollback_to_savepoint(self, tx: Transaction):
+        raise NotImplementedError('%s does not support transaction' % type(self).__name__)
+
     async def solve_returning(self, table: Type[RecordMapping], id_lst: IDList, info: QueryInfo = None,
                               perm: PermInfo = None):
         if info:
@@ -119,13 +221,106 @@ class BaseCrud(CoreCrud, ABC):
 
         return lst
 
+    @staticmethod
+    def _column_names(columns: Iterable[Union[str, RecordMappingField]]) -> List[str]:
+        return [x.name if isinstance(x, RecordMappingField) else x for x in columns]
+
+    async def upsert_many(self, table: Type[RecordMapping], values_list: Iterable[ValuesToWrite],
+                          conflict_columns: Sequence[Union[str, RecordMappingField]],
+                          update_columns: Sequence[Union[str, RecordMappingField]] = None, *, _perm=None) -> IDList:
+        """
+        写入多行，与已有的行在 conflict_columns 上相同时改为更新其 update_columns（默认为写入的其余列），
+        返回与 values_list 顺序一致的 id。
+        默认实现逐行查询后 insert 或 update，不是原子的
+        """
+        conflict = self._column_names(conflict_columns)
+        updates = None if update_columns is None else self._column_names(update_columns)
+        id_lst = []
+
+        for values in values_list:
+            if any(k not in values for k in conflict):
+                raise InvalidQueryValue('conflict columns are required: %s' % ', '.join(conflict))
+
+            conditions = [ConditionExpr(getattr(table, k), QUERY_OP_COMPARE.EQ, values[k]) for k in conflict]
+            lst = await self.get_list(QueryInfo(table, [], conditions=QueryConditions(conditions)), _perm=_perm)
+
+            if not lst:
+                id_lst.extend(await self.insert_many(table, [values], _perm=_perm))
+                continue
+
+            id_ = lst[0].id
+            data = ValuesToWrite({k: v for k, v in values.items()
+                                  if k not in conflict and k != 'id' and (updates is None or k in updates)}, table)
+            if data:
+                info = QueryInfo(table, [], conditions=QueryConditions([ConditionExpr(table.id, QUERY_OP_COMPARE.EQ, id_)]))
+                await self.update(info, data, _perm=_perm)
+            id_lst.append(id_)
+
+        return id_lst
+
+    async def upsert_many_with_perm(self, table: Type[RecordMapping], values_list: Iterable[ValuesToWrite],
+                                    conflict_columns: Sequence[Union[str, RecordMappingField]],
+                                    update_columns: Sequence[Union[str, RecordMappingField]] = None,
+                                    returning=False, *, perm: PermInfo = None) -> Union[IDList, List[QueryResultRow]]:
+        """
+        写入的列须有创建权限，冲突时更新的列须有更新权限，没有更新权限的列不会被更新
+        """
+        values_list_new = []
+
+        if perm is None:
+            perm = PermInfo(False, None, None)
+
+        conflict = self._column_names(conflict_columns)
+        updates = None if update_columns is None else self._column_names(update_columns)
+
+        if perm.is_check:
+            avail = perm.role.get_perm_avail(table, A.CREATE)
+            avail_update = perm.role.get_perm_avail(table, A.UPDATE)
+            if updates is None:
+                updates = [x for x in table.record_fields.keys() if x not in conflict and x != 'id']
+            updates = [x for x in updates if x in avail_update]
+
+        for i in values_list:
+            if perm.is_check:
+                for j in (i.keys() - avail):
+                    del i[j]
+
+            i.bind(True, table=table)
+            if i:
+                values_list_new.append(i)
+
+        lst = await self.upsert_many(table, values_list_new, conflict, updates, _perm=perm)
+
+        if returning:
+            return await self.solve_returning(table, lst, perm=perm)
+
+        return lst
+
     async def update_with_perm(self, info: QueryInfo, values: ValuesToWrite, returning=False,
                                *, perm: PermInfo = None) -> Union[List[Any], List[QueryResultRow]]:
         if perm is None:
             perm = PermInfo(False, None, None)
 
-        if perm.is_check:
-            avail = perm.role.get_perm_avail(info.from_table, A.UPDATE)
+        avail = perm.role.get_perm_avail(info.from_table, A.UPDATE) if perm.is_check else None
+        self._solve_update_values(info.from_table, values, avail)
+
+        if not values:
+            raise InvalidQueryValue('empty values')
+
+        info = await self._solve_query(info, perm)
+        lst = await self.update(info, values, _perm=perm)
+
+        if returning:
+            return await self.solve_returning(info.from_table, lst, info, perm=perm)
+
+        return lst
+
+    @staticmethod
+    def _solve_update_values(table: Type[RecordMapping], values: ValuesToWrite, avail: Optional[Set[Any]]):
+        """
+        去掉没有更新权限的列（avail 为 None 时不检查），再进行绑定
+        """
+        if avail is not None:
             rest = []
 
             for j in values.keys():
@@ -141,19 +336,43 @@ class BaseCrud(CoreCrud, ABC):
                 del values[i]
 
         try:
-            values.bind(False, table=info.from_table)
+            values.bind(False, table=table)
         except pydantic.ValidationError:
             # TODO: 权限检查之后过不了检验的后面再处置
             pass
 
-        if not values:
+    async def bulk_update(self, table: Type[RecordMapping], items: Iterable[Tuple[Any, ValuesToWrite]], *,
+                          _perm=None) -> IDList:
+        """
+        按 id 分别更新多行，每行写入的值可以不同，返回实际更新了的 id。
+        默认实现逐行调用 update
+        """
+        id_lst = []
+        for id_, values in items:
+            info = QueryInfo(table, [], conditions=QueryConditions([ConditionExpr(table.id, QUERY_OP_COMPARE.EQ, id_)]))
+            id_lst.extend(await self.update(info, values, _perm=_perm))
+        return id_lst
+
+    async def bulk_update_with_perm(self, table: Type[RecordMapping], items: Iterable[Tuple[Any, ValuesToWrite]],
+                                    returning=False, *, perm: PermInfo = None) -> Union[IDList, List[QueryResultRow]]:
+        if perm is None:
+            perm = PermInfo(False, None, None)
+
+        avail = perm.role.get_perm_avail(table, A.UPDATE) if perm.is_check else None
+        items_new = []
+
+        for id_, values in items:
+            self._solve_update_values(table, values, avail)
+            if values:
+                items_new.append((id_, values))
+
+        if not items_new:
             raise InvalidQueryValue('empty values')
 
-        info = await self._solve_query(info, perm)
-        lst = await self.update(info, values, _perm=perm)
+        lst = await self.bulk_update(table, items_new, _perm=perm)
 
         if returning:
-            return await self.solve_returning(info.from_table, lst, info, perm=perm)
+            return await self.solve_returning(table, lst, perm=perm)
 
         return lst
 
@@ -174,55 +393,212 @@ class BaseCrud(CoreCrud, ABC):
         info = await self._solve_query(info, perm)
         return await self.get_list(info, with_count, _perm=perm)
 
+    async def get_list_iter(self, info: QueryInfo, batch_size=1000, *, _perm=None) -> AsyncIterator[QueryResultRow]:
+        """
+        逐行返回全部查询结果，内部分批读取，内存占用与结果总数无关。
+        不使用 info 中的 limit 与 offset，on_read 的 when_complete 对每一批结果分别触发。
+        默认实现以 keyset 分页逐批调用 get_list，因此不能按可为 NULL 的列排序，此时抛出 InvalidCursor
+        """
+        query = info.clone()
+        query.limit = batch_size
+        query.cursor = ''
+
+        while True:
+            lst = await self.get_list(query, _perm=_perm)
+            for i in lst:
+                yield i
+
+            if lst.next_cursor is None:
+                break
+            query.cursor = lst.next_cursor
+
+    async def get_list_iter_with_perm(self, info: QueryInfo, batch_size=1000, *,
+                                      perm: PermInfo = None) -> AsyncIterator[QueryResultRow]:
+        if perm is None:
+            perm = PermInfo(False, None, None)
+        info = await self._solve_query(info, perm)
+
+        async for i in self.get_list_iter(info, batch_size, _perm=perm):
+            yield i
+
+    @staticmethod
+    def _split_fk_conditions(conditions: QueryConditions, main_table: Type[RecordMapping],
+                             fk_table: Type[RecordMapping]):
+        """
+        将外键查询条件拆分为关联条件 (fk_table.x == main_table.y) 与只涉及 fk_table 的其余条件。
+        返回 (关联条件, 其余条件)，关联条件为 (fk_table.x, main_table.y) 或 None，无法拆分时返回 None
+        """
+        def is_related(c) -> bool:
+            if isinstance(c, (QueryConditions, ConditionLogicExpr)):
+                return any(is_related(x) for x in c.items)
+            elif isinstance(c, UnaryExpr):
+                return is_related(c.expr)
+            elif isinstance(c, ConditionExpr):
+                if c.column.table != fk_table:
+                    return True
+                return isinstance(c.value, RecordMappingField) and c.value.table != fk_table
+            return False
+
+        if main_table == fk_table:
+            return None
+
+        link, rest = None, []
+        for c in (conditions.items if conditions else []):
+            if isinstance(c, ConditionExpr) and c.op == QUERY_OP_COMPARE.EQ and \
+                    isinstance(c.value, RecordMappingField):
+                pair = None
+                if c.column.table == fk_table and c.value.table == main_table:
+                    pair = (c.column, c.value)
+                elif c.column.table == main_table and c.value.table == fk_table:
+                    pair = (c.value, c.column)
+
+                if pair:
+                    if link:
+                        return None
+                    link = pair
+                    continue
+
+            if is_related(c):
+                return None
+            rest.append(c)
+
+        return link, rest
+
+    @staticmethod
+    def _fk_parent_key(row: QueryResultRow, depth: int, name: str = 'id'):
+        if name == 'id':
+            return row.id if depth == 0 else row.raw_data[0]
+
+        for i, j in zip(row.info.select_for_crud, row.raw_data):
+            if i.table == row.base and i.name == name:
+                return j
+        raise KeyError(name)
+
+    async def _solve_fk_select(self, main_table: Type[RecordMapping], query: QueryInfo, perm: PermInfo) -> List:
+        """
+        外键查询的列，按以 join 查询时 get_list_with_perm 对上级查询的过滤方式过滤
+        """
+        q = await self._solve_query(QueryInfo(main_table, [*query.select]), perm)
+        return q.select
+
+    async def _get_fk_rows_directly(self, ret_lst, main_table: Type[RecordMapping], query: QueryInfo, limit: int,
+                                    depth: int, perm: PermInfo):
+        """
+        不经过主表，以上级行中的值直接查询外键表，省去一次 join。
+        返回 (结果行, 上级行 -> 结果行 id 的映射函数)，无法处理时返回 None
+        """
+        r = self._split_fk_conditions(query.conditions, main_table, query.from_table)
+        if r is None:
+            return None
+
+        link, rest = r
+        fk_table = query.from_table
+
+        if link and limit != -1 and link[0].name != 'id':
+            # 每个上级只取前 N 条，交给 join 以窗口函数在数据库中截取
+            return None
+
+        if link:
+            try:
+                keys = {self._fk_parent_key(x, depth, link[1].name) for x in ret_lst}
+            except KeyError:
+                # 上级行中没有关联列
+                return None
+
+            def key_of(row):
+                return self._fk_parent_key(row, depth, link[1].name)
+        else:
+            # 与上级无关，所有上级共享同一组结果
+            def key_of(_):
+                return None
+
+        # 与 _get_fk_rows_by_join 的权限规则一致：列按上级查询过滤，关联条件与其余条件不做过滤
+        qi = QueryInfo(fk_table, await self._solve_fk_select(main_table, query, perm),
+                       conditions=QueryConditions(rest), order_by=query.order_by, limit=-1 if link else limit)
+        if link:
+            qi.conditions.items.append(ConditionExpr(link[0], QUERY_OP_RELATION.IN, list(keys)))
+        # 首列为 id 以便继续向下解析，关联列附在末尾
+        select = [fk_table.id, *qi.select]
+        qi.select = [*select, link[0]] if link else select
+
+        groups: Dict[Any, List] = {}
+        for x in await self.get_list(qi, _perm=perm):
+            if link:
+                groups.setdefault(x.raw_data[-1], []).append(x.raw_data[:-1])
+            else:
+                groups.setdefault(None, []).append(x.raw_data)
+
+        out_info = QueryInfo(fk_table, select)
+        elist = []
+
+        for key, items in groups.items():
+            if limit != -1:
+                items = items[:limit]
+            for raw_data in items:
+                elist.append(QueryResultRow(key, raw_data, out_info, fk_table))
+
+        return elist, key_of
+
+    async def _get_fk_rows_by_join(self, ret_lst, main_table: Type[RecordMapping], query: QueryInfo, limit: int,
+                                   depth: int, perm: PermInfo):
+        def key_of(row):
+            return self._fk_parent_key(row, depth)
+
+        # 上级ID，数据，查询条件
+        q = QueryInfo(main_table, [query.from_table.id, *query.select], limit=-1)
+        q.conditions = QueryConditions([ConditionExpr(main_table.id, QUERY_OP_RELATION.IN,
+                                                      [key_of(x) for x in ret_lst])])
+        q.join = [QueryJoinInfo(query.from_table, query.conditions, limit=limit, order_by=query.order_by)]
+
+        elist = []
+        for x in await self.get_list_with_perm(q, perm=perm):
+            x.base = query.from_table
+            elist.append(x)
+        return elist, key_of
+
     async def get_list_with_foreign_keys(self, info: QueryInfo, with_count=False,
                                          perm: PermInfo = None) -> QueryResultRowList:
+        """
+        查询并解析外键。同一层级的多个外键并发查询，并发数由 fk_query_concurrency 限制；
+        外键条件只是简单的等值关联时，直接以上级的值查询外键表，不再 join 上级表
+        """
         if perm is None:
             perm = PermInfo(False, None, None)
 
         ret = await self.get_list_with_perm(info, with_count, perm=perm)
+        semaphore = asyncio.Semaphore(self.fk_query_concurrency)
 
-        async def solve(ret_lst, main_table, fk_queries, depth=0):
-            if fk_queries is None:
-                return
-
-            if depth == 0:
-                pk_items = [x.id for x in ret_lst]
-            else:
-                pk_items = [x.raw_data[0] for x in ret_lst]
+        async def solve_one(ret_lst, main_table, raw_name, query: QueryInfo, depth):
+            _, limit = parse_foreign_key_name(raw_name)
 
-            for raw_name, query in fk_queries.items():
-                query: QueryInfo
-                limit = -1 if raw_name.endswith('[]') else 1
+            async with semaphore:
+                r = await self._get_fk_rows_directly(ret_lst, main_table, query, limit, depth, perm)
+                if r is None:
+                    r = await self._get_fk_rows_by_join(ret_lst, main_table, query, limit, depth, perm)
 
-                # 上级ID，数据，查询条件
-                q = QueryInfo(main_table, [query.from_table.id, *query.select])
-                q.conditions = QueryConditions([ConditionExpr(main_table.id, QUERY_OP_RELATION.IN, pk_items)])
-                q.join = [QueryJoinInfo(query.from_table, query.conditions, limit=limit)]
+            elist, key_of = r
+            extra: Dict[Any, Union[List, QueryResultRow]] = {}
 
-                elist = []
-                for x in await self.get_list_with_perm(q, perm=perm):
-                    x.base = query.from_table
-                    elist.append(x)
+            if limit != 1:
+                for x in elist:
+                    extra.setdefault(x.id, [])
+                    extra[x.id].append(x)
+            else:
+                for x in elist:
+                    extra[x.id] = x
 
-                extra: Dict[Any, Union[List, QueryResultRow]] = {}
+            for i in ret_lst:
+                i.extra[raw_name] = extra.get(key_of(i))
 
-                if limit != 1:
-                    for x in elist:
-                        extra.setdefault(x.id, [])
-                        extra[x.id].append(x)
-                else:
-                    for x in elist:
-                        extra[x.id] = x
+            if query.foreign_keys:
+                await solve(elist, query.from_table, query.foreign_keys, depth + 1)
 
-                if depth == 0:
-                    for i in ret_lst:
-                        i.extra[raw_name] = extra.get(i.id)
-                else:
-                    for i in ret_lst:
-                        i.extra[raw_name] = extra.get(i.raw_data[0])
+        async def solve(ret_lst, main_table, fk_queries, depth=0):
+            if fk_queries is None or not ret_lst:
+                return
 
-                if query.foreign_keys:
-                    await solve(elist, query.from_table, query.foreign_keys, depth + 1)
+            await asyncio.gather(*[solve_one(ret_lst, main_table, raw_name, query, depth)
+                                   for raw_name, query in fk_queries.items()])
 
         await solve(ret, info.from_table, info.foreign_keys)
         return ret
@@ -0,0 +1,288 @@
+import functools
+import hashlib
+import pickle
+import time
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Type, Iterable, Optional, Set, AsyncIterator, Tuple, Sequence, Union
+
+from pycrud.crud.base_crud import BaseCrud, PermInfo
+from pycrud.crud.query_result_row import QueryResultRow, QueryResultRowList
+from pycrud.crud.transaction import Transaction
+from pycrud.query import QueryInfo, QueryConditions, ConditionLogicExpr, ConditionExpr, UnaryExpr
+from pycrud.types import RecordMapping, RecordMappingField, IDList
+from pycrud.utils.lru_cache import LRUCache
+from pycrud.values import ValuesToWrite
+
+
+class CacheStorage(ABC):
+    """
+    CachedCrud 的存储层。
+    除缓存的值以外，还为每个表保存一个版本号，写入表时版本号加一，旧版本号下的缓存随之失效。
+    版本号不能因淘汰而丢失或回退，否则旧的缓存会重新生效
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Any:
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, value: Any):
+        pass
+
+    @abstractmethod
+    async def get_version(self, name: str) -> int:
+        pass
+
+    @abstractmethod
+    async def incr_version(self, name: str) -> int:
+        pass
+
+
+class LocalCacheStorage(CacheStorage):
+    """
+    进程内的 LRU 缓存，ttl 为秒数，None 为不过期
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = 60):
+        self.cache = LRUCache(maxsize, ttl)
+        self._versions: Dict[str, int] = {}
+
+    async def get(self, key: str) -> Any:
+        return self.cache.get(key)
+
+    async def set(self, key: str, value: Any):
+        self.cache.set(key, value)
+
+    async def get_version(self, name: str) -> int:
+        return self._versions.get(name, 0)
+
+    async def incr_version(self, name: str) -> int:
+        self._versions[name] = self._versions.get(name, 0) + 1
+        return self._versions[name]
+
+
+class SharedCacheStorage(CacheStorage, ABC):
+    """
+    多个进程共享的存储（如 redis），值以 pickle 序列化后保存。
+    子类实现字节串的读写与版本号的原子自增
+    """
+
+    def __init__(self, ttl: Optional[float] = 60):
+        self.ttl = ttl
+
+    @abstractmethod
+    async def get_bytes(self, key: str) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    async def set_bytes(self, key: str, value: bytes, ttl: Optional[float]):
+        pass
+
+    async def get(self, key: str) -> Any:
+        data = await self.get_bytes(key)
+        return None if data is None else pickle.loads(data)
+
+    async def set(self, key: str, value: Any):
+        await self.set_bytes(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self.ttl)
+
+
+class MemorySharedCacheStorage(SharedCacheStorage):
+    """
+    SharedCacheStorage 的本地替身，用于测试与单机部署。
+    值同样经过序列化，行为与真正的共享存储一致
+    """
+
+    def __init__(self, ttl: Optional[float] = 60):
+        super().__init__(ttl)
+        self._data: Dict[str, Tuple[Optional[float], bytes]] = {}
+        self._versions: Dict[str, int] = {}
+
+    async def get_bytes(self, key: str) -> Optional[bytes]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+
+        expire_at, value = item
+        if expire_at is not None and expire_at <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    async def set_bytes(self, key: str, value: bytes, ttl: Optional[float]):
+        self._data[key] = (None if ttl is None else time.monotonic() + ttl, value)
+
+    async def get_version(self, name: str) -> int:
+        return self._versions.get(name, 0)
+
+    async def incr_version(self, name: str) -> int:
+        self._versions[name] = self._versions.get(name, 0) + 1
+        return self._versions[name]
+
+
+class TieredCacheStorage(CacheStorage):
+    """
+    先查本地缓存，未命中再查共享缓存。
+    版本号总是以共享存储为准，其他进程的写入同样能使本地缓存失效
+    """
+
+    def __init__(self, local: CacheStorage, shared: SharedCacheStorage):
+        self.local = local
+        self.shared = shared
+
+    async def get(self, key: str) -> Any:
+        value = await self.local.get(key)
+        if value is None:
+            value = await self.shared.get(key)
+            if value is not None:
+                await self.local.set(key, value)
+        return value
+
+    async def set(self, key: str, value: Any):
+        await self.local.set(key, value)
+        await self.shared.set(key, value)
+
+    async def get_version(self, name: str) -> int:
+        return await self.shared.get_version(name)
+
+    async def incr_version(self, name: str) -> int:
+        return await self.shared.incr_version(name)
+
+
+@dataclass
+class CachedCrud(BaseCrud):
+    """
+    为任意 crud 缓存 get_list 的结果（get_list_with_perm 与外键查询也经过 get_list）。
+    键为查询的指纹、角色与所涉及各表的版本号，insert_many/update/delete 使所写的表的版本号加一。
+    命中时不会再触发 on_query/on_read 等钩子，结果依赖钩子的表不应使用
+    """
+    crud: BaseCrud
+    storage: CacheStorage = None
+
+    def __post_init__(self):
+        if self.storage is None:
+            self.storage = LocalCacheStorage()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    async def invalidate(self, table: Type[RecordMapping]):
+        await self.storage.incr_version(table.table_name)
+
+    def get_transaction(self) -> Optional[Transaction]:
+        return self.crud.get_transaction()
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Transaction]:
+        # 事务中的读取不经过缓存，未提交的数据不能被其他人读到
+        async with self.crud.transaction() as tx:
+            yield tx
+
+    async def _invalidate_after_write(self, table: Type[RecordMapping]):
+        await self.invalidate(table)
+
+        tx = self.get_transaction()
+        if tx:
+            # 提交之前其他人仍可能读到旧数据并写入缓存，提交后再失效一次
+            tx.after_commit.append(functools.partial(self.invalidate, table))
+
+    @classmethod
+    def _collect_tables(cls, c, out: Set[Type[RecordMapping]]):
+        if isinstance(c, (QueryConditions, ConditionLogicExpr)):
+            for i in c.items:
+                cls._collect_tables(i, out)
+        elif isinstance(c, UnaryExpr):
+            cls._collect_tables(c.expr, out)
+        elif isinstance(c, ConditionExpr):
+            out.add(c.column.table)
+            if isinstance(c.value, RecordMappingField):
+                out.add(c.value.table)
+
+    def _role_key(self, perm: Optional[PermInfo]):
+        if not perm:
+            return None
+        # 共享存储需要跨进程一致的键，优先使用角色名
+        for k, v in (self.permission or {}).items():
+            if v is perm.role:
+                return k
+        return 'role:%d' % id(perm.role)
+
+    async def _cache_key(self, info: QueryInfo, with_count, perm: Optional[PermInfo]) -> str:
+        tables = {info.from_table}
+        for ji in info.join or []:
+            tables.add(ji.table)
+            self._collect_tables(ji.conditions, tables)
+        self._collect_tables(info.conditions, tables)
+
+        names = sorted(x.table_name for x in tables)
+        versions = [await self.storage.get_version(x) for x in names]
+
+        text = repr((info.fingerprint().digest, self._role_key(perm), with_count, names, versions))
+        return 'pycrud:%s' % hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    async def get_list(self, info: QueryInfo, with_count=False, *, _perm=None) -> QueryResultRowList:
+        if self.get_transaction():
+            return await self.crud.get_list(info, with_count, _perm=_perm)
+
+        key = await self._cache_key(info, with_count, _perm)
+        value = await self.storage.get(key)
+
+        if value is None:
+            self.misses += 1
+            ret = await self.crud.get_list(info, with_count, _perm=_perm)
+            value = (ret.rows_count, ret.rows_count_estimated, ret.next_cursor,
+                     [(x.id, tuple(x.raw_data)) for x in ret])
+            await self.storage.set(key, value)
+        else:
+            self.hits += 1
+
+        # 每次返回新的行对象，外键查询会在行上写入 extra
+        rows_count, rows_count_estimated, next_cursor, rows = value
+        ret = QueryResultRowList([QueryResultRow(a, list(b), info, info.from_table) for a, b in rows])
+        ret.rows_count = rows_count
+        ret.rows_count_estimated = rows_count_estimated
+        ret.next_cursor = next_cursor
+        return ret
+
+    async def get_list_iter(self, info: QueryInfo, batch_size=1000, *, _perm=None) -> AsyncIterator[QueryResultRow]:
+        # 全量读取不做缓存
+        async for i in self.crud.get_list_iter(info, batch_size, _perm=_perm):
+            yield i
+
+    async def insert_many(self, table: Type[RecordMapping], values_list: Iterable[ValuesToWrite], *, _perm=None) -> IDList:
+        try:
+            return await self.crud.insert_many(table, values_list, _perm=_perm)
+        finally:
+            await self._invalidate_after_write(table)
+
+    async def update(self, info: QueryInfo, values: ValuesToWrite, *, _perm=None) -> IDList:
+        try:
+            return await self.crud.update(info, values, _perm=_perm)
+        finally:
+            await self._invalidate_after_write(info.from_table)
+
+    async def bulk_update(self, table: Type[RecordMapping], items: Iterable[Tuple[Any, ValuesToWrite]], *,
+                          _perm=None) -> IDList:
+        try:
+            return await self.crud.bulk_update(table, items, _perm=_perm)
+        finally:
+            await self._invalidate_after_write(table)
+
+    async def upsert_many(self, table: Type[RecordMapping], values_list: Iterable[ValuesToWrite],
+                          conflict_columns: Sequence[Union[str, RecordMappingField]],
+                          update_columns: Sequence[Union[str, RecordMappingField]] = None, *, _perm=None) -> IDList:
+        try:
+            return await self.crud.upsert_many(table, values_list, conflict_columns, update_columns, _perm=_perm)
+        finally:
+            await self._invalidate_after_write(table)
+
+    async def delete(self, info: QueryInfo, *, _perm=None) -> IDList:
+        try:
+            return await self.crud.delete(info, _perm=_perm)
+        finally:
+            await self._invalidate_after_write(info.from_table)
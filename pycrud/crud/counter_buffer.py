@@ -0,0 +1,211 @@
+import asyncio
+import logging
+from typing import Dict, List, Tuple, Any, Type, Optional, Union, Iterable, Set
+
+from pycrud.crud.base_crud import BaseCrud
+from pycrud.crud.query_result_row import QueryResultRowList
+from pycrud.query import QueryInfo
+from pycrud.types import RecordMapping, IDList
+from pycrud.values import ValuesToWrite, ValuesDataFlag
+
+logger = logging.getLogger(__name__)
+
+
+class _TableDeltas:
+    def __init__(self, crud: BaseCrud, table: Type[RecordMapping]):
+        self.crud = crud
+        self.table = table
+        # id -> {列: 增量}
+        self.deltas: Dict[Any, Dict[str, Union[int, float]]] = {}
+
+
+class CounterBuffer:
+    """
+    INCR/DECR 的写回缓冲（write-behind）。
+    只含 incr/decr 的 update 不立即写入，增量按 (表, id, 列) 累加在内存中，
+    每隔 interval 秒或累积到 max_keys 行时写入，每张表一条语句。
+    merge_reads 为 True 时，get_list 的结果会加上尚未写入的增量。
+    缓冲中的增量只在本进程内，退出前须调用 flush()；update 的 when_complete 钩子在增量进入缓冲后即执行
+    """
+
+    def __init__(self, interval: float = 1.0, max_keys: int = 1000, merge_reads: bool = False):
+        self.interval = interval
+        self.max_keys = max_keys
+        self.merge_reads = merge_reads
+        self.flushes = 0
+        self._pending: Dict[Tuple[int, Type[RecordMapping]], _TableDeltas] = {}
+        # 正在写入的增量，写入完成前读取时仍需合并
+        self._flushing: List[_TableDeltas] = []
+        # 首次写入时创建，python 3.9 及以前 asyncio.Lock 创建时即绑定当时的事件循环
+        self._lock: Optional[asyncio.Lock] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @staticmethod
+    def accepts(values: ValuesToWrite) -> bool:
+        """
+        values 是否只含数值的 incr/decr
+        """
+        if not values:
+            return False
+        for k, v in values.items():
+            if values.data_flag.get(k) not in (ValuesDataFlag.INCR, ValuesDataFlag.DECR):
+                return False
+            if isinstance(v, bool) or not isinstance(v, (int, float)):
+                return False
+        return True
+
+    @property
+    def pending_keys(self) -> int:
+        return sum(len(x.deltas) for x in self._pending.values())
+
+    def add(self, crud: BaseCrud, table: Type[RecordMapping], id_lst: IDList, values: ValuesToWrite):
+        key = (id(crud), table)
+        item = self._pending.get(key)
+        if item is None:
+            item = self._pending[key] = _TableDeltas(crud, table)
+
+        for k, v in values.items():
+            delta = v if values.data_flag[k] == ValuesDataFlag.INCR else -v
+            for id_ in id_lst:
+                d = item.deltas.setdefault(id_, {})
+                d[k] = d.get(k, 0) + delta
+
+        if self.pending_keys >= self.max_keys:
+            self._cancel_timer()
+            asyncio.ensure_future(self._auto_flush())
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(
+                self.interval, lambda: asyncio.ensure_future(self._auto_flush()))
+
+    def _get_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    async def _auto_flush(self):
+        try:
+            await self.flush()
+        except Exception:
+            # 增量已放回缓冲，下次再写
+            logger.exception('failed to flush counter deltas')
+
+    async def flush(self):
+        """
+        写入全部缓冲的增量。写入失败的表的增量放回缓冲，稍后重试
+        """
+        async with self._get_lock():
+            self._cancel_timer()
+            items = list(self._pending.values())
+            self._pending = {}
+            self._flushing = items
+            error = None
+
+            try:
+                for item in items:
+                    try:
+                        await item.crud._write_counter_deltas(item.table, item.deltas)
+                    except Exception as e:
+                        error = e
+                        self._restore(item)
+                    self._flushing.remove(item)
+            finally:
+                for item in self._flushing:
+                    self._restore(item)
+                self._flushing = []
+
+            self.flushes += 1
+            if error is not None:
+                if self._timer is None:
+                    self._timer = asyncio.get_event_loop().call_later(
+                        self.interval, lambda: asyncio.ensure_future(self._auto_flush()))
+                raise error
+
+    async def flush_columns(self, crud: BaseCrud, table: Type[RecordMapping], columns: Iterable[str]):
+        """
+        写入 table 上涉及 columns 的增量。普通的写入（update/bulk_update/upsert_many）覆盖这些列之前调用，
+        使缓冲的增量先于其写入，而不是在之后把它覆盖掉。
+        处于事务之中时在该事务中写入，回滚时增量放回缓冲；此时不等待正在进行的后台写入，以免与事务互相等待
+        """
+        columns = set(columns)
+
+        def touches(item: _TableDeltas) -> bool:
+            return item.crud is crud and item.table is table and any(columns & d.keys() for d in item.deltas.values())
+
+        if not any(touches(x) for x in self._flushing + list(self._pending.values())):
+            return
+
+        if crud.get_transaction() is None:
+            # 等待进行中的后台写入结束
+            async with self._get_lock():
+                await self._flush_subset(crud, table, columns)
+        else:
+            await self._flush_subset(crud, table, columns)
+
+    async def _flush_subset(self, crud: BaseCrud, table: Type[RecordMapping], columns: Set[str]):
+        key = (id(crud), table)
+        item = self._pending.get(key)
+        if item is None:
+            return
+
+        part = _TableDeltas(crud, table)
+        for id_, d in list(item.deltas.items()):
+            sub = {k: d.pop(k) for k in list(d.keys()) if k in columns}
+            if sub:
+                part.deltas[id_] = sub
+            if not d:
+                del item.deltas[id_]
+
+        if not item.deltas:
+            del self._pending[key]
+        if not part.deltas:
+            return
+
+        self._flushing.append(part)
+        try:
+            await crud._write_counter_deltas(table, part.deltas)
+        except Exception:
+            self._restore(part)
+            raise
+        finally:
+            self._flushing.remove(part)
+
+        tx = crud.get_transaction()
+        if tx is not None:
+            async def restore():
+                self._restore(part)
+            tx.after_rollback.append(restore)
+
+    def _restore(self, item: _TableDeltas):
+        key = (id(item.crud), item.table)
+        cur = self._pending.get(key)
+        if cur is None:
+            self._pending[key] = item
+            return
+        for id_, d in item.deltas.items():
+            cd = cur.deltas.setdefault(id_, {})
+            for k, v in d.items():
+                cd[k] = cd.get(k, 0) + v
+
+    def merge_rows(self, crud: BaseCrud, info: QueryInfo, rows: QueryResultRowList):
+        """
+        将尚未写入的增量加到查询结果上
+        """
+        items = [x for x in self._flushing + list(self._pending.values())
+                 if x.crud is crud and x.table is info.from_table]
+        if not items:
+            return
+
+        columns = [(n, x.name) for n, x in enumerate(info.select_for_crud) if x.table == info.from_table]
+        for row in rows:
+            for item in items:
+                d = item.deltas.get(row.id)
+                if not d:
+                    continue
+                for n, name in columns:
+                    if name in d and row.raw_data[n] is not None:
+                        row.raw_data[n] += d[name]
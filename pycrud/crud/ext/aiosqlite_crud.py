@@ -0,0 +1,230 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Dict, Type, List, Sequence, AsyncIterator, Optional
+from urllib.parse import quote
+
+import typing
+
+from pycrud.crud.sql_crud import SQLCrud, PlaceHolderGenerator, SQLExecuteResult, SQLDialect
+from pycrud.crud.transaction import Transaction
+from pycrud.error import DBException
+from pycrud.types import RecordMapping
+
+if typing.TYPE_CHECKING:
+    import aiosqlite
+
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # 负数单位为 KiB
+    'busy_timeout': 5000,
+}
+
+
+@dataclass
+class AioSqliteCrud(SQLCrud):
+    """
+    基于 aiosqlite 的 SQLite 后端，mapping2model 的值为表名。
+    持有一个写连接与 readers 个只读连接（WAL 模式下读写互不阻塞），查询语句交给只读连接，其余语句交给写连接。
+    aiosqlite 的每个连接各自占用一个线程，读操作可以并行，且不阻塞事件循环。
+    readers 为 0 时（例如内存数据库）全部语句都使用写连接
+    """
+    mapping2model: Dict[Type[RecordMapping], str]
+    database: str
+    readers: int = 4
+    # 覆盖或追加到 DEFAULT_PRAGMAS，journal_mode 只对写连接设置
+    pragmas: Dict[str, Any] = None
+
+    def __post_init__(self):
+        super().__post_init__()
+        self._writer: Optional['aiosqlite.Connection'] = None
+        self._reader_pool: Optional[asyncio.Queue] = None
+        self._reader_lst: List['aiosqlite.Connection'] = []
+        # 在 connect() 中创建，python 3.9 及以前 asyncio.Lock 创建时即绑定当时的事件循环
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._connect_lock: Optional[asyncio.Lock] = None
+
+    def get_dialect(self) -> SQLDialect:
+        return SQLDialect.SQLITE
+
+    def get_placeholder_generator(self) -> PlaceHolderGenerator:
+        return PlaceHolderGenerator('?', self.json_dumps_func)
+
+    def _get_pragmas(self) -> Dict[str, Any]:
+        pragmas = DEFAULT_PRAGMAS.copy()
+        pragmas.update(self.pragmas or {})
+        return pragmas
+
+    async def _open(self, readonly: bool) -> 'aiosqlite.Connection':
+        import aiosqlite
+
+        if readonly:
+            conn = await aiosqlite.connect('file:%s?mode=ro' % quote(self.database), uri=True, isolation_level=None)
+        else:
+            conn = await aiosqlite.connect(self.database, isolation_level=None)
+
+        for k, v in self._get_pragmas().items():
+            if readonly and k == 'journal_mode':
+                continue
+            await conn.execute('PRAGMA %s=%s' % (k, v))
+        return conn
+
+    async def connect(self):
+        """
+        建立全部连接。不主动调用时在第一次执行语句时建立
+        """
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+            self._write_lock = asyncio.Lock()
+
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+
+            # 先由写连接设置 WAL，只读连接才能打开
+            self._writer = await self._open(False)
+            self._reader_pool = asyncio.Queue()
+
+            for _ in range(self.readers):
+                conn = await self._open(True)
+                self._reader_lst.append(conn)
+                self._reader_pool.put_nowait(conn)
+
+    async def close(self):
+        if self._connect_lock is None:
+            return
+
+        async with self._connect_lock:
+            for conn in self._reader_lst:
+                await conn.close()
+            self._reader_lst = []
+            self._reader_pool = None
+
+            if self._writer is not None:
+                await self._writer.close()
+                self._writer = None
+
+    async def _acquire_reader(self):
+        if self._writer is None:
+            await self.connect()
+        if not self.readers:
+            return None
+        return await self._reader_pool.get()
+
+    def _release_reader(self, conn):
+        if conn is not None:
+            self._reader_pool.put_nowait(conn)
+
+    @staticmethod
+    def _is_read(sql: str) -> bool:
+        return sql.lstrip()[:7].upper() in ('SELECT ', 'EXPLAIN')
+
+    async def _tx_begin(self, tx: Transaction):
+        # 事务期间独占写连接，其他任务的写入等待提交，读取仍由只读连接进行
+        if self._writer is None:
+            await self.connect()
+        await self._write_lock.acquire()
+
+        try:
+            await self._writer.execute('BEGIN')
+        except Exception as e:
+            self._write_lock.release()
+            raise DBException(*e.args)
+        tx.conn = self._writer
+
+    async def _tx_end(self, sql: str):
+        try:
+            await self._writer.execute(sql)
+        except Exception as e:
+            if sql == 'COMMIT':
+                # 提交失败（如 SQLITE_BUSY、延迟的外键约束）时事务仍未结束，回滚后再交出写连接
+                try:
+                    await self._writer.execute('ROLLBACK')
+                except Exception:
+                    pass
+            raise DBException(*e.args)
+        finally:
+            self._write_lock.release()
+
+    async def _tx_commit(self, tx: Transaction):
+        await self._tx_end('COMMIT')
+
+    async def _tx_rollback(self, tx: Transaction):
+        await self._tx_end('ROLLBACK')
+
+    async def _execute_on_writer(self, sql: str, phg: PlaceHolderGenerator):
+        async with self._writer.execute(sql, phg.values) as cursor:
+            values = await cursor.fetchall() if cursor.description else None
+            return SQLExecuteResult(cursor.lastrowid, values)
+
+    async def execute_sql(self, sql: str, phg: PlaceHolderGenerator):
+        try:
+            tx = self.get_transaction()
+            if tx:
+                # 事务中的读取也要经过写连接，才能看到未提交的写入
+                async with tx.lock:
+                    return await self._execute_on_writer(sql, phg)
+
+            if self._is_read(sql):
+                conn = await self._acquire_reader()
+                if conn is not None:
+                    try:
+                        return SQLExecuteResult(None, await conn.execute_fetchall(sql, phg.values))
+                    finally:
+                        self._release_reader(conn)
+
+            if self._writer is None:
+                await self.connect()
+
+            async with self._write_lock:
+                return await self._execute_on_writer(sql, phg)
+        except Exception as e:
+            raise DBException(*e.args)
+
+    async def execute_many(self, sql: str, values_lst: List[Sequence]):
+        try:
+            tx = self.get_transaction()
+            if tx:
+                async with tx.lock:
+                    await self._writer.executemany(sql, values_lst)
+                return
+
+            if self._writer is None:
+                await self.connect()
+
+            async with self._write_lock:
+                await self._writer.execute('BEGIN')
+                try:
+                    await self._writer.executemany(sql, values_lst)
+                except BaseException:
+                    await self._writer.execute('ROLLBACK')
+                    raise
+                await self._writer.execute('COMMIT')
+        except Exception as e:
+            raise DBException(*e.args)
+
+    async def execute_sql_iter(self, sql: str, phg: PlaceHolderGenerator, batch_size: int) -> AsyncIterator[List]:
+        if self.get_transaction():
+            # 一次读出，迭代期间不占用事务的连接
+            async for rows in super().execute_sql_iter(sql, phg, batch_size):
+                yield rows
+            return
+
+        conn = await self._acquire_reader()
+        try:
+            if conn is None:
+                conn = self._writer
+
+            async with conn.execute(sql, phg.values) as cursor:
+                while True:
+                    rows = await cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+        except Exception as e:
+            raise DBException(*e.args)
+        finally:
+            if self.readers:
+                self._release_reader(conn)
@@ -0,0 +1,182 @@
+import json
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Type, List, Sequence, AsyncIterator, Tuple
+
+import typing
+
+from pycrud.crud.sql_crud import SQLCrud, PlaceHolderGenerator, SQLExecuteResult, SQLDialect
+from pycrud.crud.transaction import Transaction
+from pycrud.error import DBException
+from pycrud.types import RecordMapping, IDList
+from pycrud.utils.lru_cache import LRUCache
+from pycrud.values import ValuesToWrite
+
+if typing.TYPE_CHECKING:
+    import asyncpg
+
+
+@dataclass
+class AsyncpgCrud(SQLCrud):
+    """
+    基于 asyncpg 连接池的 PostgreSQL 后端，mapping2model 的值为表名。
+    asyncpg 以 SQL 文本为键，在每个连接上缓存预编译语句（容量由创建连接池时的 statement_cache_size 决定），
+    因此默认启用 sql_cache，令结构相同的查询生成完全相同的 SQL 文本
+    """
+    mapping2model: Dict[Type[RecordMapping], str]
+    pool: 'asyncpg.Pool'
+
+    def __post_init__(self):
+        from pydantic.fields import SHAPE_SINGLETON, SHAPE_DICT, SHAPE_MAPPING, SHAPE_DEFAULTDICT
+        super().__post_init__()
+
+        # 按 RecordMapping 的字段类型推断数组与 json 列
+        for k in self.mapping2model.keys():
+            for name, f in k.__fields__.items():
+                if f.shape in (SHAPE_DICT, SHAPE_MAPPING, SHAPE_DEFAULTDICT) or \
+                        (f.shape == SHAPE_SINGLETON and f.outer_type_ in (dict, Dict, Any)):
+                    self._table_cache[k]['json_fields'].add(name)
+                elif f.shape != SHAPE_SINGLETON:
+                    self._table_cache[k]['array_fields'].add(name)
+
+        self.sql_cache = LRUCache(1024)
+        # asyncpg 默认以字符串返回 json/jsonb
+        self.json_loads_func = json.loads
+        # 单组插入行数不少于此值时以 COPY 写入，设为 0 则不使用 COPY
+        self.copy_min_rows = 500
+
+    def get_dialect(self) -> SQLDialect:
+        return SQLDialect.POSTGRESQL
+
+    def get_placeholder_generator(self) -> PlaceHolderGenerator:
+        return PlaceHolderGenerator('${count}', self.json_dumps_func)
+
+    @asynccontextmanager
+    async def _acquire(self) -> AsyncIterator['asyncpg.Connection']:
+        """
+        处于事务之中时使用事务的连接，否则从连接池中取出一个
+        """
+        tx = self.get_transaction()
+        if tx:
+            # asyncpg 的连接不能同时执行多条语句
+            async with tx.lock:
+                yield tx.conn[0]
+        else:
+            async with self.pool.acquire() as conn:
+                yield conn
+
+    async def _tx_begin(self, tx: Transaction):
+        try:
+            conn = await self.pool.acquire()
+        except Exception as e:
+            raise DBException(*e.args)
+
+        try:
+            tr = conn.transaction()
+            await tr.start()
+        except Exception as e:
+            await self.pool.release(conn)
+            raise DBException(*e.args)
+        tx.conn = (conn, tr)
+
+    async def _tx_commit(self, tx: Transaction):
+        conn, tr = tx.conn
+        try:
+            await tr.commit()
+        except Exception as e:
+            raise DBException(*e.args)
+        finally:
+            await self.pool.release(conn)
+
+    async def _tx_rollback(self, tx: Transaction):
+        conn, tr = tx.conn
+        try:
+            await tr.rollback()
+        except Exception as e:
+            raise DBException(*e.args)
+        finally:
+            await self.pool.release(conn)
+
+    async def execute_sql(self, sql: str, phg: PlaceHolderGenerator):
+        try:
+            async with self._acquire() as conn:
+                if sql.startswith('INSERT INTO'):
+                    rows = await conn.fetch(sql + ' RETURNING id', *phg.values)
+                    return SQLExecuteResult(rows[-1][0] if rows else None, rows)
+
+                # asyncpg.Record 可以直接按位置迭代，无需再转换
+                return SQLExecuteResult(None, await conn.fetch(sql, *phg.values))
+        except Exception as e:
+            raise DBException(*e.args)
+
+    async def execute_many(self, sql: str, values_lst: List[Sequence]):
+        try:
+            async with self._acquire() as conn:
+                async with conn.transaction():
+                    await conn.executemany(sql, values_lst)
+        except Exception as e:
+            raise DBException(*e.args)
+
+    async def execute_sql_iter(self, sql: str, phg: PlaceHolderGenerator, batch_size: int) -> AsyncIterator[List]:
+        if self.get_transaction():
+            # 一次读出，迭代期间不占用事务的连接
+            async for rows in super().execute_sql_iter(sql, phg, batch_size):
+                yield rows
+            return
+
+        try:
+            async with self.pool.acquire() as conn:
+                # asyncpg 的游标需要处于事务之中
+                async with conn.transaction():
+                    cursor = await conn.cursor(sql, *phg.values)
+                    while True:
+                        rows = await cursor.fetch(batch_size)
+                        if not rows:
+                            break
+                        yield rows
+        except Exception as e:
+            raise DBException(*e.args)
+
+    def _copy_records(self, tc, columns: Tuple[str, ...], rows: List[ValuesToWrite]) -> List[Tuple]:
+        json_fields = tc['json_fields']
+        return [tuple(self.json_dumps_func(i[x]) if x in json_fields else i[x] for x in columns) for i in rows]
+
+    async def _copy_rows(self, model, tc, columns: Tuple[str, ...], rows: List[ValuesToWrite]) -> IDList:
+        """
+        以 COPY 写入一组数据。未给出 id 时先从表的序列中取出相应数量的 id，以保证返回的 id 与 rows 顺序一致。
+        表没有关联序列时返回 None
+        """
+        table_name = model.get_table_name()
+
+        try:
+            async with self._acquire() as conn:
+                async with conn.transaction():
+                    if 'id' in columns:
+                        id_lst = [x['id'] for x in rows]
+                        records = self._copy_records(tc, columns, rows)
+                    else:
+                        seq = await conn.fetchval("SELECT pg_get_serial_sequence($1, 'id')", '"%s"' % table_name)
+                        if seq is None:
+                            return None
+                        id_lst = [x[0] for x in await conn.fetch(
+                            'SELECT nextval($1::text::regclass) FROM generate_series(1, $2)', seq, len(rows))]
+                        columns = ('id', *columns)
+                        records = [(a, *b) for a, b in zip(id_lst, self._copy_records(tc, columns[1:], rows))]
+
+                    await conn.copy_records_to_table(table_name, records=records, columns=columns)
+                    return id_lst
+        except Exception as e:
+            raise DBException(*e.args)
+
+    async def _insert_rows(self, model, tc, columns: Tuple[str, ...], rows: List[ValuesToWrite]) -> IDList:
+        if self.copy_min_rows and len(rows) >= self.copy_min_rows:
+            id_lst = await self._copy_rows(model, tc, columns, rows)
+            if id_lst is not None:
+                return id_lst
+        return await super()._insert_rows(model, tc, columns, rows)
+
+    async def _insert_rows_by_execute_many(self, model, tc, columns: Tuple[str, ...], rows: List[ValuesToWrite]):
+        if self.copy_min_rows and len(rows) >= self.copy_min_rows:
+            await self._copy_rows(model, tc, columns, rows)
+            return
+        await super()._insert_rows_by_execute_many(model, tc, columns, rows)
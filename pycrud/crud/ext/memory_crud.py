@@ -0,0 +1,547 @@
+import bisect
+import copy
+import operator
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Type, List, Iterable, Optional, Set, Union
+
+from pycrud.const import QUERY_OP_COMPARE, QUERY_OP_RELATION, INDEX_TYPE
+from pycrud.crud.base_crud import BaseCrud
+from pycrud.crud.query_result_row import QueryResultRow, QueryResultRowList
+from pycrud.crud.sql_crud import prefix_upper_bound
+from pycrud.crud.transaction import Transaction
+from pycrud.error import DBException, InvalidOrderSyntax
+from pycrud.query import QueryInfo, QueryConditions, ConditionLogicExpr, ConditionExpr, NegatedExpr, QueryOrder
+from pycrud.types import RecordMapping, RecordMappingField, IDList
+from pycrud.values import ValuesToWrite, ValuesDataFlag
+
+_compare_map = {
+    QUERY_OP_COMPARE.EQ: operator.eq,
+    QUERY_OP_COMPARE.NE: operator.ne,
+    QUERY_OP_COMPARE.LT: operator.lt,
+    QUERY_OP_COMPARE.LE: operator.le,
+    QUERY_OP_COMPARE.GE: operator.ge,
+    QUERY_OP_COMPARE.GT: operator.gt,
+}
+
+
+def _words(text: str) -> List[str]:
+    return re.findall(r'\w+', text.lower())
+
+
+def _match_score(text: str, query: str) -> int:
+    """
+    全文检索的简单替代：query 中的词都出现时返回出现的总次数，否则返回 0
+    """
+    words = _words(text)
+    counts = [words.count(x) for x in set(_words(query))]
+    return sum(counts) if counts and all(counts) else 0
+
+
+class HashIndex:
+    def __init__(self):
+        self._data: Dict[Any, Set] = {}
+
+    def add(self, key, id_):
+        self._data.setdefault(key, set()).add(id_)
+
+    def remove(self, key, id_):
+        ids = self._data[key]
+        ids.discard(id_)
+        if not ids:
+            del self._data[key]
+
+    def get(self, key) -> Set:
+        return self._data.get(key, set())
+
+
+class SortedIndex:
+    """
+    有序索引，值为 None 的行不加入索引（与 NULL 的比较总是不成立）
+    """
+    def __init__(self):
+        self._keys = []
+        self._ids = []
+
+    def add(self, key, id_):
+        if key is None:
+            return
+        n = bisect.bisect_right(self._keys, key)
+        self._keys.insert(n, key)
+        self._ids.insert(n, id_)
+
+    def remove(self, key, id_):
+        if key is None:
+            return
+        n = self._ids.index(id_, bisect.bisect_left(self._keys, key), bisect.bisect_right(self._keys, key))
+        del self._keys[n]
+        del self._ids[n]
+
+    def get(self, key) -> Set:
+        return self.range(key, key)
+
+    def range(self, low=None, high=None, low_inclusive=True, high_inclusive=True) -> Set:
+        a = 0
+        if low is not None:
+            a = (bisect.bisect_left if low_inclusive else bisect.bisect_right)(self._keys, low)
+
+        b = len(self._keys)
+        if high is not None:
+            b = (bisect.bisect_right if high_inclusive else bisect.bisect_left)(self._keys, high)
+
+        return set(self._ids[a:b])
+
+
+class MemoryTable:
+    def __init__(self, indexes: Dict[str, INDEX_TYPE]):
+        self.rows: Dict[Any, Dict[str, Any]] = {}
+        # 写入顺序，没有指定排序时按此顺序返回
+        self.seq: Dict[Any, int] = {}
+        self.indexes: Dict[str, Union[HashIndex, SortedIndex]] = {}
+        self._next_id = 1
+        self._next_seq = 0
+
+        for name, index_type in indexes.items():
+            self.indexes[name] = SortedIndex() if INDEX_TYPE(index_type) == INDEX_TYPE.SORTED else HashIndex()
+
+    def next_id(self):
+        while self._next_id in self.rows:
+            self._next_id += 1
+        return self._next_id
+
+    def _update_indexes(self, id_, old: Optional[Dict[str, Any]], new: Optional[Dict[str, Any]]):
+        """
+        将 id_ 在各索引中的值由 old 行改为 new 行，为 None 时只删除或只加入。
+        值不可哈希或无法与已有的值比较时，撤销已修改的索引后抛出 DBException
+        """
+        undo = []
+        name = None
+        try:
+            for name, index in self.indexes.items():
+                if old is not None:
+                    index.remove(old.get(name), id_)
+                    undo.append((index.add, old.get(name)))
+                if new is not None:
+                    index.add(new.get(name), id_)
+                    undo.append((index.remove, new.get(name)))
+        except TypeError as e:
+            for func, key in reversed(undo):
+                func(key, id_)
+            raise DBException('invalid value for index %s: %s' % (name, e))
+
+    def add(self, row: Dict[str, Any], seq: int = None):
+        id_ = row['id']
+        self._update_indexes(id_, None, row)
+
+        if seq is None:
+            seq = self._next_seq
+            self._next_seq += 1
+
+        self.rows[id_] = row
+        self.seq[id_] = seq
+        if isinstance(id_, int) and id_ >= self._next_id:
+            self._next_id = id_ + 1
+
+    def remove(self, id_) -> int:
+        row = self.rows.pop(id_)
+        self._update_indexes(id_, row, None)
+        return self.seq.pop(id_)
+
+    def replace(self, id_, row: Dict[str, Any]):
+        """
+        以 row 替换 id_ 所在的行，id 不变时保持原有的位置。失败时原有的行不变
+        """
+        if row['id'] != id_:
+            # 先加入新行，失败时不需要恢复
+            self.add(row, self.seq[id_])
+            self.remove(id_)
+            return
+
+        self._update_indexes(id_, self.rows[id_], row)
+        self.rows[id_] = row
+
+    def lookup(self, name: str, op, value) -> Optional[Set]:
+        """
+        以索引查出可能满足条件的 id，无法使用索引时返回 None
+        """
+        if op in (QUERY_OP_COMPARE.EQ, QUERY_OP_RELATION.IS, QUERY_OP_RELATION.IN):
+            if value is None:
+                # = NULL 不成立，IS NULL 无法使用索引
+                return set() if op == QUERY_OP_COMPARE.EQ else None
+            values = value if op == QUERY_OP_RELATION.IN else [value]
+
+            if name == 'id':
+                return {x for x in values if x in self.rows}
+
+        index = self.indexes.get(name)
+        if index is None:
+            return None
+
+        try:
+            if op in (QUERY_OP_COMPARE.EQ, QUERY_OP_RELATION.IS, QUERY_OP_RELATION.IN):
+                return set().union(*[index.get(x) for x in values])
+
+            if not isinstance(index, SortedIndex) or value is None:
+                return None
+
+            if op == QUERY_OP_COMPARE.LT:
+                return index.range(high=value, high_inclusive=False)
+            elif op == QUERY_OP_COMPARE.LE:
+                return index.range(high=value)
+            elif op == QUERY_OP_COMPARE.GT:
+                return index.range(low=value, low_inclusive=False)
+            elif op == QUERY_OP_COMPARE.GE:
+                return index.range(low=value)
+            elif op == QUERY_OP_RELATION.PREFIX:
+                high = prefix_upper_bound(value)
+                if high is not None:
+                    # 以 value 开头的字符串都落在 [value, high) 之间
+                    return index.range(value, high, high_inclusive=False)
+        except (TypeError, ValueError):
+            # 值不可哈希、类型无法比较等
+            return None
+
+
+@dataclass
+class MemoryCrud(BaseCrud):
+    """
+    数据保存在进程内存中，不需要数据库。可作为只读参考数据的缓存，也可作为测试替身。
+    indexes 为各表声明二级索引，如 {User: {'username': INDEX_TYPE.HASH, 'time': INDEX_TYPE.SORTED}}，
+    id 总是可以直接定位。条件中可以走索引的部分先缩小范围，再对候选行计算完整的条件
+    """
+    indexes: Dict[Type[RecordMapping], Dict[str, INDEX_TYPE]] = None
+
+    def __post_init__(self):
+        self._tables: Dict[Type[RecordMapping], MemoryTable] = {}
+
+    async def _tx_begin(self, tx: Transaction):
+        # 以快照实现回滚，回滚时同时撤销事务期间其他任务的写入
+        tx.state = copy.deepcopy(self._tables)
+
+    async def _tx_commit(self, tx: Transaction):
+        pass
+
+    async def _tx_rollback(self, tx: Transaction):
+        self._tables = tx.state
+
+    async def _tx_savepoint(self, tx: Transaction):
+        await self._tx_begin(tx)
+
+    async def _tx_release_savepoint(self, tx: Transaction):
+        pass
+
+    async def _tx_rollback_to_savepoint(self, tx: Transaction):
+        await self._tx_rollback(tx)
+
+    def get_table(self, table: Type[RecordMapping]) -> MemoryTable:
+        t = self._tables.get(table)
+        if t is None:
+            t = self._tables[table] = MemoryTable((self.indexes or {}).get(table, {}))
+        return t
+
+    def _get_value(self, ctx: Dict[Type[RecordMapping], Dict], field: RecordMappingField):
+        row = ctx.get(field.table)
+        return None if row is None else row.get(field.name)
+
+    def _eval_condition(self, c, ctx: Dict[Type[RecordMapping], Dict]) -> Optional[bool]:
+        """
+        按 SQL 的三值逻辑计算条件，None 代表 NULL（不成立）
+        """
+        if isinstance(c, (QueryConditions, ConditionLogicExpr)):
+            is_and = c.type == 'and'
+            ret = True if is_and else False
+            for i in c.items:
+                r = self._eval_condition(i, ctx)
+                if r is None:
+                    ret = None
+                elif r != is_and:
+                    return r
+            # 空条件不做限制
+            return ret if c.items else True
+
+        elif isinstance(c, NegatedExpr):
+            r = self._eval_condition(c.expr, ctx)
+            return None if r is None else not r
+
+        elif isinstance(c, ConditionExpr):
+            left = self._get_value(ctx, c.column)
+            value = self._get_value(ctx, c.value) if isinstance(c.value, RecordMappingField) else c.value
+
+            if c.op == QUERY_OP_RELATION.IS:
+                return left is None if value is None else left == value
+            elif c.op == QUERY_OP_RELATION.IS_NOT:
+                return left is not None if value is None else left != value
+
+            if left is None:
+                return None
+
+            if c.op in _compare_map:
+                if value is None:
+                    return None
+                try:
+                    return _compare_map[c.op](left, value)
+                except TypeError:
+                    return False
+
+            elif c.op in (QUERY_OP_RELATION.IN, QUERY_OP_RELATION.NOT_IN):
+                found = left in value
+                if not found and None in value:
+                    return None
+                return found if c.op == QUERY_OP_RELATION.IN else not found
+
+            elif c.op == QUERY_OP_RELATION.PREFIX:
+                return left.startswith(value)
+            elif c.op == QUERY_OP_RELATION.IPREFIX:
+                return left.lower().startswith(value.lower())
+
+            elif c.op == QUERY_OP_RELATION.MATCH:
+                return _match_score(left, value) > 0
+
+            elif c.op == QUERY_OP_RELATION.CONTAINS:
+                return all(x in left for x in value)
+            elif c.op == QUERY_OP_RELATION.CONTAINS_ANY:
+                return any(x in left for x in value)
+
+        return True
+
+    def _lookup(self, c, table: Type[RecordMapping], ctx: Dict[Type[RecordMapping], Dict]) -> Optional[Set]:
+        """
+        以索引查出 table 中可能满足条件的 id，无法缩小范围时返回 None。
+        ctx 中已确定的行（join 时的上级）的列可以作为条件的值
+        """
+        if isinstance(c, (QueryConditions, ConditionLogicExpr)):
+            lst = [self._lookup(x, table, ctx) for x in c.items]
+
+            if c.type == 'and':
+                lst = sorted([x for x in lst if x is not None], key=len)
+                return set.intersection(*lst) if lst else None
+
+            if not lst or any(x is None for x in lst):
+                return None
+            return set().union(*lst)
+
+        elif isinstance(c, ConditionExpr):
+            column, value = c.column, c.value
+
+            if isinstance(value, RecordMappingField):
+                if column.table != table and value.table == table and c.op == QUERY_OP_COMPARE.EQ:
+                    column, value = value, column
+                if value.table not in ctx:
+                    return None
+                value = self._get_value(ctx, value)
+
+            if column.table == table:
+                return self.get_table(table).lookup(column.name, c.op, value)
+
+    def _scan(self, table: Type[RecordMapping], conditions, ctx: Dict[Type[RecordMapping], Dict]) -> List[Dict]:
+        """
+        返回 table 中可能满足条件的行，按写入顺序排列
+        """
+        t = self.get_table(table)
+        ids = self._lookup(conditions, table, ctx) if conditions else None
+        if ids is None:
+            return list(t.rows.values())
+        return [t.rows[x] for x in sorted(ids, key=t.seq.__getitem__)]
+
+    def _sort(self, ctx_lst: List[Dict], orders: List[QueryOrder], info: QueryInfo = None) -> List[Dict]:
+        for o in reversed(orders):
+            if o.rank:
+                c = info.get_match_condition(o.column) if info else None
+                if c is None:
+                    raise InvalidOrderSyntax('rank order requires a match condition on column: %s' % o.column.name)
+                ctx_lst.sort(key=lambda x: _match_score(self._get_value(x, o.column) or '', c.value),
+                             reverse=o.order != 'asc')
+                continue
+
+            # NULL 排在最前
+            ctx_lst.sort(key=lambda x: (lambda v: (v is not None, v))(self._get_value(x, o.column)),
+                         reverse=o.order == 'desc')
+        return ctx_lst
+
+    def _select(self, info: QueryInfo) -> List[Dict]:
+        """
+        返回满足条件的行组合（表 -> 行），已排序但未分页
+        """
+        ret = []
+
+        for row in self._scan(info.from_table, info.conditions, {}):
+            ctx_lst = [{info.from_table: row}]
+
+            for ji in info.join or []:
+                new_lst = []
+                for ctx in ctx_lst:
+                    lst = []
+                    for jrow in self._scan(ji.table, ji.conditions, ctx):
+                        ctx2 = {**ctx, ji.table: jrow}
+                        if self._eval_condition(ji.conditions, ctx2):
+                            lst.append(ctx2)
+
+                    if ji.limit != -1:
+                        lst = self._sort(lst, ji.order_by or [QueryOrder(ji.table.id)])[:ji.limit]
+                    new_lst.extend(lst)
+                ctx_lst = new_lst
+
+            for ctx in ctx_lst:
+                if info.conditions is None or self._eval_condition(info.conditions, ctx):
+                    ret.append(ctx)
+
+        return self._sort(ret, info.order_by, info)
+
+    async def get_list(self, info: QueryInfo, with_count=False, *, _perm=None) -> QueryResultRowList:
+        # hook
+        await info.from_table.on_query(info, _perm)
+        when_complete = []
+        await info.from_table.on_read(info, when_complete, _perm)
+
+        query = info if info.cursor is None else info.to_keyset_query()
+        ctx_lst = self._select(query)
+        ret = QueryResultRowList()
+
+        if with_count:
+            ret.rows_count = len(ctx_lst)
+
+        ctx_lst = ctx_lst[query.offset:]
+        if query.limit != -1:
+            ctx_lst = ctx_lst[:query.limit]
+
+        # 末尾为 keyset 排序列
+        n = len(info.select_for_crud)
+        raw_data = []
+        for ctx in ctx_lst:
+            raw_data = [self._get_value(ctx, x) for x in query.select_for_crud]
+            ret.append(QueryResultRow(ctx[info.from_table]['id'], raw_data[:n], info, info.from_table))
+
+        if query is not info and info.limit != -1 and len(ret) == info.limit:
+            ret.next_cursor = info.make_cursor(raw_data[n:])
+
+        for i in when_complete:
+            await i(ret)
+
+        return ret
+
+    def _new_row(self, table: Type[RecordMapping], values: ValuesToWrite) -> Dict[str, Any]:
+        row = {}
+        for name, f in table.__fields__.items():
+            if name not in values:
+                row[name] = f.get_default()
+        row.update(copy.deepcopy(dict(values)))
+        return row
+
+    async def insert_many(self, table: Type[RecordMapping], values_list: Iterable[ValuesToWrite], *, _perm=None) -> IDList:
+        values_list = list(values_list)
+        when_complete = []
+        await table.on_insert(values_list, when_complete, _perm)
+
+        t = self.get_table(table)
+        rows = [self._new_row(table, x) for x in values_list]
+
+        # 先检查，全部通过后再写入
+        id_set = set()
+        next_id = t.next_id()
+        for row in rows:
+            if row.get('id') is None:
+                while next_id in t.rows or next_id in id_set:
+                    next_id += 1
+                row['id'] = next_id
+
+            if row['id'] in t.rows or row['id'] in id_set:
+                raise DBException('UNIQUE constraint failed: %s.id' % table.table_name)
+            id_set.add(row['id'])
+
+        # 索引的值有误时撤销已写入的行
+        added = []
+        try:
+            for row in rows:
+                t.add(row)
+                added.append(row['id'])
+        except DBException:
+            for id_ in added:
+                t.remove(id_)
+            raise
+
+        id_lst = [x['id'] for x in rows]
+        await self._run_when_complete(when_complete, id_lst)
+
+        return id_lst
+
+    @staticmethod
+    def _apply_values(row: Dict[str, Any], values: ValuesToWrite):
+        for k, v in values.items():
+            vflag = values.data_flag.get(k)
+            old = row.get(k)
+
+            if vflag == ValuesDataFlag.INCR:
+                v = None if old is None else old + v
+            elif vflag == ValuesDataFlag.DECR:
+                v = None if old is None else old - v
+
+            elif vflag == ValuesDataFlag.ARRAY_EXTEND:
+                v = [*(old or []), *v]
+            elif vflag == ValuesDataFlag.ARRAY_EXTEND_DISTINCT:
+                v = list(dict.fromkeys([*(old or []), *v]))
+            elif vflag == ValuesDataFlag.ARRAY_PRUNE:
+                v = None if old is None else [x for x in old if x not in v]
+            elif vflag == ValuesDataFlag.ARRAY_PRUNE_DISTINCT:
+                v = None if old is None else list(dict.fromkeys([x for x in old if x not in v]))
+            else:
+                v = copy.deepcopy(v)
+
+            row[k] = v
+
+    async def update(self, info: QueryInfo, values: ValuesToWrite, *, _perm=None) -> IDList:
+        # hook
+        await info.from_table.on_query(info, _perm)
+        when_before_update, when_complete = [], []
+        await info.from_table.on_update(info, values, when_before_update, when_complete, _perm)
+
+        qi = info.clone()
+        qi.select = []
+        lst = await self.get_list(qi, _perm=_perm)
+        id_lst = [x.id for x in lst]
+
+        for i in when_before_update:
+            await i(id_lst)
+
+        t = self.get_table(info.from_table)
+        rows = []
+        for id_ in id_lst:
+            row = dict(t.rows[id_])
+            self._apply_values(row, values)
+            if row['id'] != id_ and row['id'] in t.rows:
+                raise DBException('UNIQUE constraint failed: %s.id' % info.from_table.table_name)
+            rows.append((id_, row))
+
+        done = []
+        try:
+            for id_, row in rows:
+                old = t.rows[id_]
+                t.replace(id_, row)
+                done.append((row['id'], old))
+        except DBException:
+            for id_, old in reversed(done):
+                t.replace(id_, old)
+            raise
+
+        await self._run_when_complete(when_complete)
+
+        return id_lst
+
+    async def delete(self, info: QueryInfo, *, _perm=None) -> IDList:
+        when_before_delete, when_complete = [], []
+        await info.from_table.on_delete(info, when_before_delete, when_complete, _perm)
+
+        qi = info.clone()
+        qi.select = []
+        lst = await self.get_list(qi, _perm=_perm)
+        id_lst = [x.id for x in lst]
+
+        for i in when_before_delete:
+            await i(id_lst)
+
+        t = self.get_table(info.from_table)
+        for id_ in id_lst:
+            t.remove(id_)
+
+        await self._run_when_complete(when_complete)
+
+        return id_lst
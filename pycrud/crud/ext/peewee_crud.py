@@ -1,12 +1,16 @@
+import asyncio
 import inspect
+import uuid
+from concurrent.futures import Executor, ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Union, Dict, Type
+from typing import Any, Union, Dict, Type, List, Sequence, AsyncIterator, Optional, Callable
 
 import pypika
 import typing
 
 from pycrud.types import RecordMapping
-from pycrud.crud.sql_crud import SQLCrud, PlaceHolderGenerator, SQLExecuteResult
+from pycrud.crud.sql_crud import SQLCrud, PlaceHolderGenerator, SQLExecuteResult, SQLDialect
+from pycrud.crud.transaction import Transaction
 from pycrud.error import DBException, UnknownDatabaseException
 
 if typing.TYPE_CHECKING:
@@ -17,6 +21,12 @@ if typing.TYPE_CHECKING:
 class PeeweeCrud(SQLCrud):
     mapping2model: Dict[Type[RecordMapping], Union[str, Type['peewee.Model']]]
     db: Any
+    # 设置后 SQL 在此线程池中执行，不再阻塞事件循环。
+    # peewee 的连接是线程独立的，每个工作线程各自持有一个连接
+    executor: Optional[Executor] = None
+    # 使用 executor 时，事务与 postgres 游标读取各自固定在一个专用线程上，此为专用线程的数量，超出时等待。
+    # 专用线程及其连接用完后保留，供之后的事务使用
+    tx_workers: int = 4
 
     def __post_init__(self):
         import peewee
@@ -38,36 +48,241 @@ class PeeweeCrud(SQLCrud):
                     elif isinstance(f, (BinaryJSONField, MySQL_JSONField, SQLite_JSONField)):
                         self._table_cache[k]['json_fields'].add(f.name)
 
+                self._table_cache[k]['index_fields'].add(v._meta.primary_key.name)
+                for i in v._meta.fields_to_index():
+                    # 只有索引的第一列可以用于区间查询
+                    expr = i._expressions[0]
+                    if isinstance(expr, peewee.Field):
+                        self._table_cache[k]['index_fields'].add(expr.column_name)
+                    elif isinstance(expr, peewee.Function) and expr.name.lower() == 'lower' and \
+                            isinstance(expr.arguments[0], peewee.Field):
+                        self._table_cache[k]['lower_index_fields'].add(expr.arguments[0].column_name)
+
         for k, v in self.mapping2model.items():
             if inspect.isclass(v) and issubclass(v, peewee.Model):
                 self.mapping2model[k] = pypika.Table(v._meta.table_name)
 
         self._phg_cache = None
+        self._dialect = None
+        # 以下两者在事件循环中首次使用时创建，python 3.9 及以前 asyncio.Lock/Queue 创建时即绑定当时的事件循环
+        # 未设置 executor 时全部语句共用事件循环线程的连接，事务期间其他语句须等待事务结束
+        self._tx_lock: Optional[asyncio.Lock] = None
+        # 空闲的事务专用线程，None 表示尚未创建
+        self._tx_executors: Optional[asyncio.Queue] = None
 
-    def get_placeholder_generator(self) -> PlaceHolderGenerator:
-        if self._phg_cache is None:
+    def get_dialect(self) -> SQLDialect:
+        if self._dialect is None:
             import peewee
 
             if isinstance(self.db, peewee.SqliteDatabase):
-                self._phg_cache = '?'
+                self._dialect = SQLDialect.SQLITE
             elif isinstance(self.db, peewee.PostgresqlDatabase):
-                self._phg_cache = '%s'
+                self._dialect = SQLDialect.POSTGRESQL
             elif isinstance(self.db, peewee.MySQLDatabase):
-                self._phg_cache = '%s'
+                self._dialect = SQLDialect.MYSQL
             else:
                 raise UnknownDatabaseException('unknown database: %s', self.db)
 
+        return self._dialect
+
+    def get_placeholder_generator(self) -> PlaceHolderGenerator:
+        if self._phg_cache is None:
+            if self.get_dialect() == SQLDialect.SQLITE:
+                self._phg_cache = '?'
+            else:
+                self._phg_cache = '%s'
+
         return PlaceHolderGenerator(self._phg_cache, self.json_dumps_func)
 
-    async def execute_sql(self, sql: str, phg: PlaceHolderGenerator):
+    async def _run_sync(self, func: Callable, *args, executor: Executor = None):
+        """
+        执行同步的数据库调用。未设置 executor 时直接在当前线程执行
+        """
+        executor = executor or self.executor
+        if executor is None:
+            return func(*args)
+        return await asyncio.get_event_loop().run_in_executor(executor, func, *args)
+
+    def _execute_sql_sync(self, sql: str, values):
         import peewee
         try:
             if sql.startswith('INSERT INTO'):
                 if isinstance(self.db, peewee.PostgresqlDatabase):
                     sql += ' RETURNING id'
-                    r = self.db.execute_sql(sql, phg.values)
-                    return SQLExecuteResult(r.fetchone()[0])
-            return self.db.execute_sql(sql, phg.values)
+                    rows = self.db.execute_sql(sql, values).fetchall()
+                    return SQLExecuteResult(rows[-1][0] if rows else None, rows)
+                cursor = self.db.execute_sql(sql, values)
+                if cursor.description is not None:
+                    # INSERT ... RETURNING
+                    return SQLExecuteResult(cursor.lastrowid, cursor.fetchall())
+                return SQLExecuteResult(cursor.lastrowid)
+            cursor = self.db.execute_sql(sql, values)
+            if self.executor is not None and cursor.description is not None:
+                # 游标不能跨线程使用，在工作线程中读出全部结果
+                return SQLExecuteResult(cursor.lastrowid, cursor.fetchall())
+            return cursor
         except Exception as e:
-            self.db.rollback()
+            # 回滚须与出错的语句处于同一线程（同一连接）。处于 transaction() 之中时由其负责回滚
+            if not self.db.in_transaction():
+                try:
+                    self.db.rollback()
+                except Exception:
+                    # 没有进行中的事务时回滚本身会失败，以原始错误为准
+                    pass
             raise DBException(*e.args)
+
+    def _execute_many_sync(self, sql: str, values_lst: List[Sequence]):
+        try:
+            with self.db.atomic():
+                self.db.cursor().executemany(sql, values_lst)
+        except Exception as e:
+            raise DBException(*e.args)
+
+    def _get_tx_lock(self) -> asyncio.Lock:
+        if self._tx_lock is None:
+            self._tx_lock = asyncio.Lock()
+        return self._tx_lock
+
+    async def _acquire_tx_executor(self) -> Executor:
+        """
+        取一个空闲的专用线程，没有时等待
+        """
+        if self._tx_executors is None:
+            self._tx_executors = asyncio.Queue()
+            for _ in range(self.tx_workers):
+                self._tx_executors.put_nowait(None)
+        executor = await self._tx_executors.get()
+        return executor or ThreadPoolExecutor(1)
+
+    def _release_tx_executor(self, executor: Executor):
+        self._tx_executors.put_nowait(executor)
+
+    def _close_conn(self):
+        try:
+            self.db.close()
+        except Exception:
+            pass
+
+    async def _run_statement(self, func: Callable, *args):
+        """
+        执行事务之外或之中的一条语句
+        """
+        tx = self.get_transaction()
+        if tx:
+            return await self._run_sync(func, *args, executor=tx.conn[0])
+        if self.executor is None:
+            # 与事务共用一个连接，等待进行中的事务结束，以免落在其中
+            async with self._get_tx_lock():
+                return func(*args)
+        return await self._run_sync(func, *args)
+
+    async def _tx_begin(self, tx: Transaction):
+        # peewee 的连接是线程独立的，使用线程池时事务固定在一个专用线程上。
+        # 未设置 executor 时全部语句都在事件循环的线程中执行，事务独占这个连接直到结束
+        if self.executor is None:
+            await self._get_tx_lock().acquire()
+            executor = None
+        else:
+            executor = await self._acquire_tx_executor()
+
+        ctx = self.db.atomic()
+        tx.conn = (executor, ctx)
+
+        try:
+            await self._run_sync(ctx.__enter__, executor=executor)
+        except Exception as e:
+            await self._tx_end(tx, type(e), e)
+            raise DBException(*e.args)
+
+    async def _tx_end(self, tx: Transaction, exc_type=None, exc=None):
+        executor, ctx = tx.conn
+
+        def end():
+            try:
+                ctx.__exit__(exc_type, exc, None)
+            except Exception:
+                if executor is not None:
+                    # 连接可能已不可用，下次使用时重新建立
+                    self._close_conn()
+                raise
+
+        try:
+            await self._run_sync(end, executor=executor)
+        except Exception as e:
+            raise DBException(*e.args)
+        finally:
+            if executor is None:
+                self._tx_lock.release()
+            else:
+                self._release_tx_executor(executor)
+
+    async def _tx_commit(self, tx: Transaction):
+        await self._tx_end(tx)
+
+    async def _tx_rollback(self, tx: Transaction):
+        await self._tx_end(tx, DBException, DBException('rollback'))
+
+    async def execute_sql(self, sql: str, phg: PlaceHolderGenerator):
+        return await self._run_statement(self._execute_sql_sync, sql, phg.values)
+
+    async def execute_many(self, sql: str, values_lst: List[Sequence]):
+        await self._run_statement(self._execute_many_sync, sql, values_lst)
+
+    async def execute_sql_iter(self, sql: str, phg: PlaceHolderGenerator, batch_size: int) -> AsyncIterator[List]:
+        is_pg = self.get_dialect() == SQLDialect.POSTGRESQL
+
+        if (not is_pg and self.executor is None) or self.get_transaction():
+            # sqlite 的游标本身即逐步读取；事务之中使用事务的连接
+            async for rows in super().execute_sql_iter(sql, phg, batch_size):
+                yield rows
+            return
+
+        # postgres 使用服务端游标（named cursor），需要处于事务之中。
+        # 使用线程池时，游标（以及事务）的全部操作固定在同一个线程，也就是同一个连接上进行
+        executor = await self._acquire_tx_executor() if self.executor is not None else None
+        ctx = self.db.atomic() if is_pg else None
+        cursor = None
+
+        def begin():
+            nonlocal cursor
+            try:
+                if ctx:
+                    ctx.__enter__()
+                    cursor = self.db.connection().cursor(name='pycrud_%s' % uuid.uuid4().hex)
+                    cursor.itersize = batch_size
+                    cursor.execute(sql, phg.values)
+                else:
+                    cursor = self.db.execute_sql(sql, phg.values)
+            except Exception as e:
+                end(type(e), e, e.__traceback__)
+                raise DBException(*e.args)
+
+        def fetch():
+            try:
+                return cursor.fetchmany(batch_size)
+            except Exception as e:
+                raise DBException(*e.args)
+
+        def end(*exc_info):
+            try:
+                if cursor is not None:
+                    cursor.close()
+            finally:
+                if ctx:
+                    ctx.__exit__(*exc_info)
+
+        try:
+            await self._run_sync(begin, executor=executor)
+            try:
+                while True:
+                    rows = await self._run_sync(fetch, executor=executor)
+                    if not rows:
+                        break
+                    yield rows
+            except BaseException as e:
+                await self._run_sync(end, type(e), e, e.__traceback__, executor=executor)
+                raise
+            await self._run_sync(end, None, None, None, executor=executor)
+        finally:
+            if executor is not None:
+                self._release_tx_executor(executor)
@@ -0,0 +1,204 @@
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, Union, Dict, Type, List, Sequence, AsyncIterator
+
+import pypika
+import typing
+
+from pycrud.crud.sql_crud import SQLCrud, PlaceHolderGenerator, SQLExecuteResult, SQLDialect
+from pycrud.crud.transaction import Transaction
+from pycrud.error import DBException, UnknownDatabaseException
+from pycrud.types import RecordMapping
+
+if typing.TYPE_CHECKING:
+    import sqlalchemy
+    from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+_dialect_map = {
+    'sqlite': SQLDialect.SQLITE,
+    'postgresql': SQLDialect.POSTGRESQL,
+    'mysql': SQLDialect.MYSQL,
+    'mariadb': SQLDialect.MYSQL,
+}
+
+_placeholder_map = {
+    'qmark': '?',
+    'numeric': ':{count}',
+    'numeric_dollar': '${count}',
+    'format': '%s',
+    'pyformat': '%s',
+}
+
+
+@dataclass
+class SQLAlchemyCrud(SQLCrud):
+    """
+    以 SQLAlchemy 的 AsyncEngine 执行 pypika 生成的语句，连接由 SQLAlchemy 的连接池管理。
+    mapping2model 的值可以是表名、sqlalchemy.Table 或声明式模型，后两者会读取其中的数组与 json 列以及索引。
+    engine 可以直接传入 AsyncEngine，也可以传入 url（如 sqlite+aiosqlite:///a.db、postgresql+asyncpg://...），
+    此时以下面的连接池参数创建 AsyncEngine
+    """
+    mapping2model: Dict[Type[RecordMapping], Union[str, 'sqlalchemy.Table', Any]]
+    engine: Union[str, 'AsyncEngine']
+    pool_size: int = 5
+    max_overflow: int = 10
+    # 取出连接时先检查连接是否可用
+    pool_pre_ping: bool = True
+    # 连接使用超过此秒数后重建，-1 为不限制
+    pool_recycle: int = 3600
+
+    def __post_init__(self):
+        import sqlalchemy
+
+        super().__post_init__()
+
+        for k, v in self.mapping2model.items():
+            table = getattr(v, '__table__', v)
+            if isinstance(table, sqlalchemy.Table):
+                for c in table.columns:
+                    if isinstance(c.type, sqlalchemy.ARRAY):
+                        self._table_cache[k]['array_fields'].add(c.name)
+                    elif isinstance(c.type, sqlalchemy.JSON):
+                        self._table_cache[k]['json_fields'].add(c.name)
+
+                for c in list(table.primary_key.columns)[:1]:
+                    self._table_cache[k]['index_fields'].add(c.name)
+                for i in table.indexes:
+                    # 只有索引的第一列可以用于区间查询
+                    expr = i.expressions[0]
+                    if isinstance(expr, sqlalchemy.Column):
+                        self._table_cache[k]['index_fields'].add(expr.name)
+                    elif isinstance(expr, sqlalchemy.sql.functions.Function) and expr.name.lower() == 'lower':
+                        arg = next(iter(expr.clauses), None)
+                        if isinstance(arg, sqlalchemy.Column):
+                            self._table_cache[k]['lower_index_fields'].add(arg.name)
+
+                self.mapping2model[k] = pypika.Table(table.name)
+
+        if isinstance(self.engine, str):
+            self.engine = self._create_engine(self.engine)
+
+        self._dialect = None
+
+    def _create_engine(self, url: str) -> 'AsyncEngine':
+        from sqlalchemy.engine import make_url
+        from sqlalchemy.ext.asyncio import create_async_engine
+
+        url = make_url(url)
+        kwargs = {
+            'pool_pre_ping': self.pool_pre_ping,
+            'pool_recycle': self.pool_recycle,
+        }
+
+        # 内存中的 sqlite 只能共享同一个连接（StaticPool），没有连接数可言
+        if not (url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')):
+            kwargs['pool_size'] = self.pool_size
+            kwargs['max_overflow'] = self.max_overflow
+
+        return create_async_engine(url, **kwargs)
+
+    def get_dialect(self) -> SQLDialect:
+        if self._dialect is None:
+            name = self.engine.dialect.name
+            if name not in _dialect_map:
+                raise UnknownDatabaseException('unknown database: %s', name)
+            self._dialect = _dialect_map[name]
+
+        return self._dialect
+
+    def get_placeholder_generator(self) -> PlaceHolderGenerator:
+        return PlaceHolderGenerator(_placeholder_map[self.engine.dialect.paramstyle], self.json_dumps_func)
+
+    async def close(self):
+        """
+        关闭连接池中的全部连接
+        """
+        await self.engine.dispose()
+
+    @asynccontextmanager
+    async def _begin(self) -> AsyncIterator['sqlalchemy.ext.asyncio.AsyncConnection']:
+        """
+        处于事务之中时使用事务的连接，否则取出一个连接并在语句结束后提交
+        """
+        tx = self.get_transaction()
+        if tx:
+            async with tx.lock:
+                yield tx.conn
+        else:
+            async with self.engine.begin() as conn:
+                yield conn
+
+    async def _tx_begin(self, tx: Transaction):
+        try:
+            conn = await self.engine.connect()
+        except Exception as e:
+            raise DBException(*e.args)
+
+        try:
+            await conn.begin()
+        except Exception as e:
+            await conn.close()
+            raise DBException(*e.args)
+        tx.conn = conn
+
+    async def _tx_commit(self, tx: Transaction):
+        try:
+            await tx.conn.commit()
+        except Exception as e:
+            raise DBException(*e.args)
+        finally:
+            await tx.conn.close()
+
+    async def _tx_rollback(self, tx: Transaction):
+        try:
+            await tx.conn.rollback()
+        except Exception as e:
+            raise DBException(*e.args)
+        finally:
+            await tx.conn.close()
+
+    async def execute_sql(self, sql: str, phg: PlaceHolderGenerator):
+        if sql.startswith('INSERT INTO') and self.get_dialect() == SQLDialect.POSTGRESQL:
+            sql += ' RETURNING id'
+
+        try:
+            async with self._begin() as conn:
+                result = await conn.exec_driver_sql(sql, tuple(phg.values))
+                values = result.fetchall() if result.returns_rows else None
+                lastrowid = result.lastrowid if values is None else None
+                return SQLExecuteResult(lastrowid, values)
+        except Exception as e:
+            raise DBException(*e.args)
+
+    async def execute_many(self, sql: str, values_lst: List[Sequence]):
+        try:
+            async with self._begin() as conn:
+                await conn.exec_driver_sql(sql, [tuple(x) for x in values_lst])
+        except Exception as e:
+            raise DBException(*e.args)
+
+    async def execute_sql_iter(self, sql: str, phg: PlaceHolderGenerator, batch_size: int) -> AsyncIterator[List]:
+        if self.get_transaction():
+            # 一次读出，迭代期间不占用事务的连接
+            async for rows in super().execute_sql_iter(sql, phg, batch_size):
+                yield rows
+            return
+
+        def execute(sync_conn):
+            return sync_conn.exec_driver_sql(sql, tuple(phg.values), execution_options={'stream_results': True})
+
+        try:
+            # 服务端游标（postgres）需要处于事务之中
+            async with self.engine.begin() as conn:
+                result = await conn.run_sync(execute)
+                try:
+                    while True:
+                        rows = await conn.run_sync(lambda _: result.fetchmany(batch_size))
+                        if not rows:
+                            break
+                        yield rows
+                finally:
+                    await conn.run_sync(lambda _: result.close())
+        except Exception as e:
+            raise DBException(*e.args)
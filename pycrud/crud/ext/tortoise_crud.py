@@ -1,12 +1,13 @@
 import inspect
 from dataclasses import dataclass
-from typing import Any, Union, Dict, Type
+from typing import Any, Union, Dict, Type, List, Sequence, AsyncIterator
 
 import pypika
 import typing
 
 from pycrud.types import RecordMapping
-from pycrud.crud.sql_crud import SQLCrud, PlaceHolderGenerator, SQLExecuteResult
+from pycrud.crud.sql_crud import SQLCrud, PlaceHolderGenerator, SQLExecuteResult, SQLDialect
+from pycrud.crud.transaction import Transaction
 from pycrud.error import DBException
 
 if typing.TYPE_CHECKING:
@@ -35,8 +36,14 @@ class TortoiseCrud(SQLCrud):
                 self.mapping2model[k] = pypika.Table(v._meta.db_table)
 
         self._phg_cache = None
+        self._dialect = None
         self.is_pg = False
 
+    def get_dialect(self) -> SQLDialect:
+        if self._dialect is None:
+            self.get_placeholder_generator()
+        return self._dialect
+
     def get_placeholder_generator(self) -> PlaceHolderGenerator:
         if self._phg_cache is None:
             import tortoise
@@ -61,33 +68,126 @@ class TortoiseCrud(SQLCrud):
 
             if SqliteClient and isinstance(conn, SqliteClient):
                 self._phg_cache = '?'
+                self._dialect = SQLDialect.SQLITE
             elif AsyncpgDBClient and isinstance(conn, AsyncpgDBClient):
                 self._phg_cache = '${count}'
+                self._dialect = SQLDialect.POSTGRESQL
                 self.is_pg = True
             elif MySQLClient and isinstance(conn, MySQLClient):
                 self._phg_cache = '%s'
+                self._dialect = SQLDialect.MYSQL
             else:
                 raise Exception('unknown database: %s', conn)
 
         return PlaceHolderGenerator(self._phg_cache, self.json_dumps_func)
 
+    async def _tx_begin(self, tx: Transaction):
+        from tortoise.transactions import in_transaction
+        ctx = in_transaction()
+        try:
+            tx.conn = (ctx, await ctx.__aenter__())
+        except Exception as e:
+            raise DBException(*e.args)
+
+    async def _tx_end(self, tx: Transaction, exc_type=None, exc=None):
+        ctx, _ = tx.conn
+        try:
+            # 有异常时回滚，否则提交
+            await ctx.__aexit__(exc_type, exc, None)
+        except Exception as e:
+            raise DBException(*e.args)
+
+    async def _tx_commit(self, tx: Transaction):
+        await self._tx_end(tx)
+
+    async def _tx_rollback(self, tx: Transaction):
+        await self._tx_end(tx, DBException, DBException('rollback'))
+
+    @staticmethod
+    def _row_values(row) -> tuple:
+        """
+        行会被按位置下标与切片访问。各后端返回 dict、asyncpg.Record 或 sqlite3.Row，
+        前两者需取 values()，后者本身即按位置迭代
+        """
+        return tuple(row.values() if hasattr(row, 'values') else row)
+
+    async def _execute_sql(self, tconn, sql: str, phg: PlaceHolderGenerator):
+        if sql.startswith('INSERT INTO'):
+            if self.is_pg:
+                sql += ' RETURNING id'
+                # rows affected, [<Record id=b'ff20'>, ...]
+                r = await tconn.execute_query(sql, phg.values)
+                r2 = [self._row_values(x) for x in r[1]]
+                return SQLExecuteResult(r2[-1][0] if r2 else None, r2)
+            elif ' RETURNING ' in sql:
+                r = await tconn.execute_query(sql, phg.values)
+                return SQLExecuteResult(None, [self._row_values(x) for x in r[1]])
+            else:
+                r = await tconn.execute_insert(sql, phg.values)
+                return SQLExecuteResult(r)
+        else:
+            # rows affected, The resultset: [1, {}]
+            r = await tconn.execute_query(sql, phg.values)
+            r2 = [self._row_values(x) for x in r[1]]
+            return SQLExecuteResult(None, r2)
+
     async def execute_sql(self, sql: str, phg: PlaceHolderGenerator):
         from tortoise.transactions import in_transaction
+        try:
+            tx = self.get_transaction()
+            if tx:
+                async with tx.lock:
+                    return await self._execute_sql(tx.conn[1], sql, phg)
+
+            async with in_transaction() as tconn:
+                return await self._execute_sql(tconn, sql, phg)
+        except Exception as e:
+            raise DBException(*e.args)
+
+    async def execute_many(self, sql: str, values_lst: List[Sequence]):
+        from tortoise.transactions import in_transaction
+        try:
+            tx = self.get_transaction()
+            if tx:
+                async with tx.lock:
+                    await tx.conn[1].execute_many(sql, [list(x) for x in values_lst])
+                return
+
+            async with in_transaction() as tconn:
+                await tconn.execute_many(sql, [list(x) for x in values_lst])
+        except Exception as e:
+            raise DBException(*e.args)
+
+    async def execute_sql_iter(self, sql: str, phg: PlaceHolderGenerator, batch_size: int) -> AsyncIterator[List]:
+        from tortoise.transactions import in_transaction
+
+        if self.get_dialect() == SQLDialect.MYSQL or self.get_transaction():
+            # 事务之中一次读出，迭代期间不占用事务的连接
+            async for rows in super().execute_sql_iter(sql, phg, batch_size):
+                yield rows
+            return
+
         try:
             async with in_transaction() as tconn:
-                if sql.startswith('INSERT INTO'):
+                async with tconn.acquire_connection() as connection:
                     if self.is_pg:
-                        sql += ' RETURNING id'
-                        r = await tconn.execute_insert(sql, phg.values)
-                        # [<Record id=b'ff20'>]
-                        return SQLExecuteResult(r[0])
+                        # asyncpg 的游标需要处于事务之中
+                        cursor = await connection.cursor(sql, *phg.values)
+                        while True:
+                            rows = await cursor.fetch(batch_size)
+                            if not rows:
+                                break
+                            yield rows
                     else:
-                        r = await tconn.execute_insert(sql, phg.values)
-                        return SQLExecuteResult(r)
-                else:
-                    # rows affected, The resultset: [1, {}]
-                    r = await tconn.execute_query(sql, phg.values)
-                    r2 = [x.values() for x in r[1]]
-                    return SQLExecuteResult(None, r2)
+                        # aiosqlite
+                        cursor = await connection.execute(sql, phg.values)
+                        try:
+                            while True:
+                                rows = await cursor.fetchmany(batch_size)
+                                if not rows:
+                                    break
+                                yield rows
+                        finally:
+                            await cursor.close()
         except Exception as e:
             raise DBException(*e.args)
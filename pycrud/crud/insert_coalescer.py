@@ -0,0 +1,99 @@
+import asyncio
+from typing import Dict, List, Tuple, Any, Optional
+
+from pycrud.crud.base_crud import BaseCrud
+from pycrud.types import IDList
+from pycrud.values import ValuesToWrite
+
+
+class _PendingBatch:
+    def __init__(self, crud: BaseCrud, model, tc):
+        self.crud = crud
+        self.model = model
+        self.tc = tc
+        self.rows_count = 0
+        # 每个调用者的数据与等待结果的 future
+        self.items: List[Tuple[List[ValuesToWrite], asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class InsertCoalescer:
+    """
+    合并并发的小批量 INSERT（group commit）。
+    window 秒内对同一张表、同一组列的写入合并为多行 INSERT，在一个事务中写入，各调用者取回各自的 id；
+    攒够 max_rows 行时立即写入。整批失败时逐个调用者单独重试，错误只抛给出错的调用者。
+    合并后的写入在调用者的事务之外进行，处于事务中的 insert_many 不经过此处
+    """
+
+    def __init__(self, window: float = 0.002, max_rows: int = 500):
+        self.window = window
+        self.max_rows = max_rows
+        self.batches = 0
+        self.rows = 0
+        self._pending: Dict[Tuple[Any, ...], _PendingBatch] = {}
+
+    async def insert(self, crud, model, tc, columns: Tuple[str, ...], rows: List[ValuesToWrite]) -> IDList:
+        key = (id(crud), model.get_table_name(), columns)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = _PendingBatch(crud, model, tc)
+            batch.timer = asyncio.get_event_loop().call_later(self.window, self._flush, key)
+
+        fut = asyncio.get_event_loop().create_future()
+        batch.items.append((rows, fut))
+        batch.rows_count += len(rows)
+
+        if batch.rows_count >= self.max_rows:
+            self._flush(key)
+
+        return await fut
+
+    def _flush(self, key):
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        asyncio.ensure_future(self._write(batch, key[2]))
+
+    async def _write(self, batch: _PendingBatch, columns: Tuple[str, ...]):
+        crud = batch.crud
+        items = [x for x in batch.items if not x[1].done()]
+        if not items:
+            return
+
+        self.batches += 1
+        self.rows += sum(len(x[0]) for x in items)
+
+        try:
+            async with crud.transaction():
+                ids = await crud._insert_rows_chunked(batch.model, batch.tc, columns, [r for x in items for r in x[0]])
+        except Exception as e:
+            if len(items) == 1:
+                self._set_exception(items[0][1], e)
+                return
+
+            # 逐个重试，确定是哪个调用者的数据出错
+            for rows, fut in items:
+                try:
+                    async with crud.transaction():
+                        ids = await crud._insert_rows_chunked(batch.model, batch.tc, columns, rows)
+                except Exception as e:
+                    self._set_exception(fut, e)
+                else:
+                    self._set_result(fut, ids)
+            return
+
+        n = 0
+        for rows, fut in items:
+            self._set_result(fut, ids[n:n + len(rows)])
+            n += len(rows)
+
+    @staticmethod
+    def _set_result(fut: asyncio.Future, value):
+        if not fut.done():
+            fut.set_result(value)
+
+    @staticmethod
+    def _set_exception(fut: asyncio.Future, e: Exception):
+        if not fut.done():
+            fut.set_exception(e)
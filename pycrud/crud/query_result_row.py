@@ -49,3 +49,7 @@ class QueryResultRowList(list):
     def __init__(self, *args):
         super().__init__(*args)
         self.rows_count = None
+        # rows_count 是否为估算值
+        self.rows_count_estimated = False
+        # keyset 分页时下一页的 cursor，没有下一页时为 None
+        self.next_cursor = None
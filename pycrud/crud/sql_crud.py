@@ -1,23 +1,37 @@
+import asyncio
+import copy
 import json
+import re
+import sqlite3
 from abc import abstractmethod
 from dataclasses import dataclass
 from enum import Enum
 from functools import reduce
-from typing import Dict, Type, Union, List, Iterable, Any, Tuple, Set
+from typing import Dict, Type, Union, List, Iterable, Any, Tuple, Set, Sequence, Callable, Optional, \
+    AsyncIterator
 
 import pypika
 from pypika import Query, Order
+from pypika.analytics import RowNumber
 from pypika.enums import Arithmetic, Comparator
-from pypika.functions import Count, DistinctOptionFunction
+from pypika.functions import Count, DistinctOptionFunction, Lower
 from pypika.terms import ComplexCriterion, Parameter, Field as PypikaField, ArithmeticExpression, Criterion, \
-    BasicCriterion
+    BasicCriterion, Term, Case, Tuple as PypikaTuple
+from pypika.utils import format_quotes
 
-from pycrud.const import QUERY_OP_COMPARE, QUERY_OP_RELATION
+from pycrud.const import QUERY_OP_COMPARE, QUERY_OP_RELATION, COUNT_STRATEGY
 from pycrud.crud.base_crud import BaseCrud
+from pycrud.crud.counter_buffer import CounterBuffer
+from pycrud.crud.insert_coalescer import InsertCoalescer
 from pycrud.crud.query_result_row import QueryResultRow, QueryResultRowList
-from pycrud.query import QueryInfo, QueryConditions, ConditionLogicExpr, ConditionExpr, NegatedExpr
+from pycrud.crud.transaction import Transaction
+from pycrud.error import UnsupportedQueryOperator, InvalidQueryValue, InvalidOrderSyntax
+from pycrud.query import QueryInfo, QueryConditions, ConditionLogicExpr, ConditionExpr, NegatedExpr, QueryJoinInfo, \
+    QueryOrder
+from pycrud.query_optimizer import optimize_conditions
 from pycrud.types import RecordMapping, RecordMappingField, IDList
 from pycrud.utils.json_ex import json_dumps_ex
+from pycrud.utils.lru_cache import LRUCache
 from pycrud.values import ValuesToWrite, ValuesDataFlag
 
 _sql_method_map = {
@@ -39,6 +53,12 @@ _sql_method_map = {
 }
 
 
+class SQLDialect(Enum):
+    SQLITE = 'sqlite'
+    POSTGRESQL = 'postgresql'
+    MYSQL = 'mysql'
+
+
 class ArithmeticExt(Enum):
     concat = '||'
 
@@ -50,6 +70,23 @@ class ArrayMatchingExt(Comparator):
     is_not = ' IS NOT '
 
 
+class CountOver(Term):
+    def get_sql(self, **kwargs):
+        return 'COUNT(*) OVER()'
+
+
+class PostgresArrayAnyAll(Criterion):
+    def __init__(self, expr, array, negated=False, **kwargs):
+        super().__init__(**kwargs)
+        self._expr = expr
+        self._array = array
+        self._negated = negated
+
+    def get_sql(self, **kwargs):
+        tmpl = '%s<>ALL(%s)' if self._negated else '%s=ANY(%s)'
+        return tmpl % (self._expr.get_sql(**kwargs), self._array.get_sql(**kwargs))
+
+
 class PostgresArrayDistinct(Criterion):
     def __init__(self, expr, **kwargs):
         super().__init__(**kwargs)
@@ -72,6 +109,92 @@ class PostgresArrayDifference(Criterion):
         )
 
 
+class LikeEscape(Criterion):
+    """
+    带 ESCAPE 子句的 LIKE/ILIKE，pypika 的 like 不支持指定转义字符
+    """
+    def __init__(self, expr, pattern, ilike=False, **kwargs):
+        super().__init__(**kwargs)
+        self._expr = expr
+        self._pattern = pattern
+        self._ilike = ilike
+
+    def get_sql(self, **kwargs):
+        return "%s %s %s ESCAPE '%s'" % (self._expr.get_sql(**kwargs), 'ILIKE' if self._ilike else 'LIKE',
+                                         self._pattern.get_sql(**kwargs), LIKE_ESCAPE_CHAR)
+
+
+class FullTextMatch(Criterion):
+    """
+    全文检索条件，rank 为 True 时为相关度（越大越相关）。
+    sqlite 查询 fts5 影子表 <表名>_fts，postgres 为 to_tsvector @@ plainto_tsquery，mysql 为 MATCH AGAINST
+    """
+    def __init__(self, dialect: 'SQLDialect', id_field, field, query, config='simple', rank=False, **kwargs):
+        super().__init__(**kwargs)
+        self._dialect = dialect
+        self._id_field = id_field
+        self._field = field
+        self._query = query
+        self._config = config
+        self._rank = rank
+
+    def get_sql(self, **kwargs):
+        query = self._query.get_sql(**kwargs)
+
+        if self._dialect == SQLDialect.SQLITE:
+            quote_char = kwargs.get('quote_char', '"')
+            fts = format_quotes(self._field.table.get_table_name() + '_fts', quote_char)
+            column = format_quotes(self._field.name, quote_char)
+            id_sql = self._id_field.get_sql(**{**kwargs, 'with_namespace': True})
+
+            if self._rank:
+                # bm25 越小越相关
+                return '(SELECT -bm25(%s) FROM %s WHERE %s MATCH %s AND rowid=%s)' % (fts, fts, column, query, id_sql)
+            return '%s IN (SELECT rowid FROM %s WHERE %s MATCH %s)' % (id_sql, fts, column, query)
+
+        field = self._field.get_sql(**kwargs)
+        if self._dialect == SQLDialect.POSTGRESQL:
+            config = "'%s'" % self._config.replace("'", "''")
+            tmpl = 'ts_rank(to_tsvector(%s, %s), plainto_tsquery(%s, %s))' if self._rank else \
+                'to_tsvector(%s, %s) @@ plainto_tsquery(%s, %s)'
+            return tmpl % (config, field, config, query)
+
+        return 'MATCH (%s) AGAINST (%s IN NATURAL LANGUAGE MODE)' % (field, query)
+
+
+def fts5_query(text: str) -> str:
+    """
+    将用户输入转为 fts5 的查询：每个词作为一个短语，词之间为 AND，与 plainto_tsquery 一致。
+    没有词时返回空短语，不匹配任何行
+    """
+    return ' '.join('"%s"' % x for x in re.findall(r'\w+', text)) or '""'
+
+
+# 不用反斜杠，mysql 的字符串字面量中反斜杠本身需要转义
+LIKE_ESCAPE_CHAR = '!'
+
+
+def escape_like(value: str) -> str:
+    for i in (LIKE_ESCAPE_CHAR, '%', '_'):
+        value = value.replace(i, LIKE_ESCAPE_CHAR + i)
+    return value
+
+
+def prefix_upper_bound(prefix: str) -> Optional[str]:
+    """
+    以 prefix 开头的字符串的上界（不含），即按码点比较时第一个大于所有此类字符串的值。prefix 为空时返回 None
+    """
+    prefix = prefix.rstrip(chr(0x10ffff))
+    if not prefix:
+        return None
+
+    code = ord(prefix[-1]) + 1
+    if 0xd800 <= code <= 0xdfff:
+        # 跳过代理区，无法编码为 utf-8
+        code = 0xe000
+    return prefix[:-1] + chr(code)
+
+
 @dataclass
 class PlaceHolderGenerator:
     template: str = '?'  # sqlite
@@ -131,6 +254,8 @@ class SQLCrud(BaseCrud):
 
     def __post_init__(self):
         self.json_dumps_func = json_dumps_ex
+        # 驱动以字符串返回 json 列时（如 asyncpg），读出后以此解码，为 None 则不处理
+        self.json_loads_func: Optional[Callable[[str], Any]] = None
         self._table_cache = {
             # 'mapping': {
             #     'array_fields': [],
@@ -145,33 +270,547 @@ class SQLCrud(BaseCrud):
             self._table_cache[k] = {
                 'array_fields': set(),
                 'json_fields': set(),
+                # 带有 b-tree 索引的列，与 lower(列) 上的表达式索引
+                'index_fields': set(),
+                'lower_index_fields': set(),
+                # 建有全文索引的列，见 create_fts_index
+                'fts_fields': set(),
             }
 
+        # 单条 INSERT 语句最多写入的行数，设为 1 时逐行插入
+        self.insert_batch_size = 1000
+        # update/delete 直接以查询条件写入，不再先查出全部 id（需要数据库支持 RETURNING）
+        self.direct_write = False
+        # 超过此长度的 IN 列表在 sqlite 中以单个 json 参数传入，在其他数据库中整数列表直接写入语句
+        self.in_list_inline_max = 100
+        # get_list 的 SQL 模板缓存，以查询结构为键，设为 LRUCache 实例即启用
+        self.sql_cache: Optional[LRUCache] = None
+        # get_list(with_count=True) 时的计数方式，with_count 也可以直接传入 COUNT_STRATEGY
+        self.count_strategy = COUNT_STRATEGY.SEPARATE
+        # 查询前化简条件，条件不可能成立时直接返回空结果，不访问数据库
+        self.condition_optimizer = True
+        # 有索引的列上的 prefix/iprefix 编译为区间（col >= 'abc' AND col < 'abd'），iprefix 需要 lower(col) 上的索引。
+        # 区间按二进制顺序比较，列的排序规则须与之一致（如 postgres 的 C collation）
+        self.prefix_as_range = False
+        # postgres 全文检索使用的配置（分词与词干规则）
+        self.fts_config = 'simple'
+        # 合并并发的 insert_many，设为 InsertCoalescer 实例即启用
+        self.insert_coalescer: Optional[InsertCoalescer] = None
+        # 只含 incr/decr 的 update 先累加在内存中再批量写入，设为 CounterBuffer 实例即启用
+        self.counter_buffer: Optional[CounterBuffer] = None
+        # mysql 的一条多行 INSERT 分到的自增 id 是否连续，首次多行插入时查询
+        self._autoinc_consecutive: Optional[bool] = None
+
+    def add_index(self, field: RecordMappingField, lower=False):
+        """
+        声明列上的索引，lower 为 True 时为 lower(列) 上的表达式索引
+        """
+        key = 'lower_index_fields' if lower else 'index_fields'
+        self._table_cache[field.table][key].add(field.name)
+
+    def add_fts_index(self, fields: Sequence[RecordMappingField]):
+        """
+        声明已建有全文索引的列，之后才能对这些列使用 match。索引本身由 create_fts_index 创建
+        """
+        for i in fields:
+            self._table_cache[i.table]['fts_fields'].add(i.name)
+
+    def fts_index_sql(self, table: Type[RecordMapping], fields: Sequence[RecordMappingField]) -> List[str]:
+        """
+        创建全文索引的语句，可用于迁移脚本。
+        sqlite 为外部内容（external content）的 fts5 影子表，以触发器随原表同步；postgres 为表达式上的 GIN 索引；
+        mysql 为 FULLTEXT 索引
+        """
+        dialect = self.get_dialect()
+        if dialect is None:
+            raise UnsupportedQueryOperator('full-text search is not supported by %s' % type(self).__name__)
+
+        table_name = self.mapping2model[table].get_table_name()
+        names = [x.name for x in fields]
+        q = lambda x: format_quotes(x, '"')
+
+        if dialect == SQLDialect.SQLITE:
+            fts = q(table_name + '_fts')
+            columns = ', '.join(map(q, names))
+            new_values = ', '.join('new.%s' % q(x) for x in names)
+            old_values = ', '.join('old.%s' % q(x) for x in names)
+            insert_new = 'INSERT INTO %s(rowid, %s) VALUES (new."id", %s);' % (fts, columns, new_values)
+            delete_old = "INSERT INTO %s(%s, rowid, %s) VALUES ('delete', old.\"id\", %s);" % (fts, fts, columns, old_values)
+
+            return [
+                "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, content='%s', content_rowid='id')" % (
+                    fts, columns, table_name.replace("'", "''")),
+                'CREATE TRIGGER IF NOT EXISTS %s AFTER INSERT ON %s BEGIN %s END' % (
+                    q(table_name + '_fts_ai'), q(table_name), insert_new),
+                'CREATE TRIGGER IF NOT EXISTS %s AFTER DELETE ON %s BEGIN %s END' % (
+                    q(table_name + '_fts_ad'), q(table_name), delete_old),
+                'CREATE TRIGGER IF NOT EXISTS %s AFTER UPDATE ON %s BEGIN %s %s END' % (
+                    q(table_name + '_fts_au'), q(table_name), delete_old, insert_new),
+                # 写入原表中已有的行
+                "INSERT INTO %s(%s) VALUES ('rebuild')" % (fts, fts),
+            ]
+
+        if dialect == SQLDialect.POSTGRESQL:
+            config = "'%s'" % self.fts_config.replace("'", "''")
+            return ['CREATE INDEX IF NOT EXISTS %s ON %s USING GIN (to_tsvector(%s, %s))' % (
+                q('%s_%s_fts' % (table_name, x)), q(table_name), config, q(x)) for x in names]
+
+        return ['ALTER TABLE `%s` ADD FULLTEXT INDEX `%s_%s_fts` (`%s`)' % (table_name, table_name, x, x) for x in names]
+
+    async def create_fts_index(self, table: Type[RecordMapping], fields: Sequence[RecordMappingField]):
+        """
+        创建并声明 fields 上的全文索引，已存在的索引不会重建
+        """
+        dialect = self.get_dialect()
+        table_name = self.mapping2model[table].get_table_name()
+
+        async def exists(sql: str, name: str) -> bool:
+            phg = self.get_placeholder_generator()
+            sql = sql % phg.next(name).get_sql()
+            return next(iter(await self.execute_sql(sql, phg)), None) is not None
+
+        if dialect == SQLDialect.SQLITE:
+            sql_lst = []
+            if not await exists("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", table_name + '_fts'):
+                sql_lst = self.fts_index_sql(table, fields)
+        elif dialect == SQLDialect.POSTGRESQL:
+            # 语句本身带有 IF NOT EXISTS
+            sql_lst = self.fts_index_sql(table, fields)
+        elif dialect == SQLDialect.MYSQL:
+            sql_lst = []
+            for i in fields:
+                sql = 'SELECT 1 FROM information_schema.statistics WHERE table_schema = DATABASE() AND index_name = %s'
+                if not await exists(sql, '%s_%s_fts' % (table_name, i.name)):
+                    sql_lst.extend(self.fts_index_sql(table, [i]))
+
+        else:
+            sql_lst = self.fts_index_sql(table, fields)
+
+        for i in sql_lst:
+            await self.execute_sql(i, self.get_placeholder_generator())
+
+        self.add_fts_index(fields)
+
+    async def _tx_savepoint(self, tx: Transaction):
+        await self.execute_sql('SAVEPOINT %s' % tx.savepoint, self.get_placeholder_generator())
+
+    async def _tx_release_savepoint(self, tx: Transaction):
+        await self.execute_sql('RELEASE SAVEPOINT %s' % tx.savepoint, self.get_placeholder_generator())
+
+    async def _tx_rollback_to_savepoint(self, tx: Transaction):
+        await self.execute_sql('ROLLBACK TO SAVEPOINT %s' % tx.savepoint, self.get_placeholder_generator())
+
+    def get_max_bind_params(self) -> int:
+        """
+        单条语句允许的参数（占位符）数量上限
+        """
+        if self.get_dialect() == SQLDialect.SQLITE:
+            return 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+        return 65535
+
+    @staticmethod
+    def _insert_query(model, tc, columns: Tuple[str, ...], rows: List[ValuesToWrite], phg: PlaceHolderGenerator):
+        sql = Query().into(model).columns(*columns)
+
+        for i in rows:
+            sql = sql.insert(
+                *[phg.next(i[_a], left_is_array=_a in tc['array_fields'], left_is_json=_a in tc['json_fields']) for _a in columns]
+            )
+
+        return sql
+
+    @staticmethod
+    def _has_ids(columns: Tuple[str, ...], rows: List[ValuesToWrite]) -> bool:
+        return 'id' in columns and all(x['id'] is not None for x in rows)
+
+    async def _mysql_autoinc_consecutive(self) -> bool:
+        """
+        mysql 的一条多行 INSERT 分到的自增 id 是否连续：需要 auto_increment_increment 为 1，
+        且 innodb_autoinc_lock_mode 不是 2（交错模式下并发的插入交错分配 id，8.0 起为默认值）
+        """
+        if self._autoinc_consecutive is None:
+            sql = 'SELECT @@auto_increment_increment, @@innodb_autoinc_lock_mode'
+            try:
+                row = next(iter(await self.execute_sql(sql, self.get_placeholder_generator())), None)
+            except Exception:
+                # 变量不存在（非 innodb 等）时按不连续处理
+                row = None
+            self._autoinc_consecutive = bool(row) and int(row[0]) == 1 and int(row[1]) != 2
+        return self._autoinc_consecutive
+
+    async def _multi_row_ids_known(self, columns: Tuple[str, ...], rows: List[ValuesToWrite]) -> bool:
+        """
+        多行 INSERT 之后能否得到与 rows 一一对应的 id，不能时逐行插入
+        """
+        if 'id' in columns:
+            # 部分行的 id 为 None 时，这些行的自增 id 无从对应
+            return self._has_ids(columns, rows)
+
+        dialect = self.get_dialect()
+        if dialect in (SQLDialect.POSTGRESQL, SQLDialect.SQLITE):
+            return True
+        if dialect == SQLDialect.MYSQL:
+            return await self._mysql_autoinc_consecutive()
+        return False
+
+    async def _insert_rows(self, model, tc, columns: Tuple[str, ...], rows: List[ValuesToWrite]) -> IDList:
+        """
+        以一条多行 INSERT 写入一组列相同的数据，返回与 rows 顺序一致的 id 列表。
+        未给出 id 时：postgres 由后端附加的 RETURNING id 取得，顺序与 VALUES 一致；
+        sqlite 3.35+ 附加 RETURNING，同一条语句中的行依次分配 max(rowid)+1，排序后即为 VALUES 的顺序，
+        较旧的 sqlite 同理由 lastrowid（最后一行）倒推；mysql 在 id 连续分配时（见 _mysql_autoinc_consecutive）
+        由 lastrowid（第一行）推算。其余情况逐行插入，各取 lastrowid
+        """
+        if len(rows) > 1 and not await self._multi_row_ids_known(columns, rows):
+            id_lst = []
+            for i in rows:
+                id_lst.extend(await self._insert_rows(model, tc, columns, [i]))
+            return id_lst
+
+        dialect = self.get_dialect()
+        has_ids = self._has_ids(columns, rows)
+        phg = self.get_placeholder_generator()
+        sql = self._insert_query(model, tc, columns, rows, phg).get_sql()
+
+        sqlite_returning = not has_ids and len(rows) > 1 and dialect == SQLDialect.SQLITE and \
+            sqlite3.sqlite_version_info >= (3, 35, 0)
+        if sqlite_returning:
+            sql += ' RETURNING "id"'
+
+        r = await self.execute_sql(sql, phg)
+
+        if has_ids:
+            return [x['id'] for x in rows]
+
+        if r.values is not None:
+            # RETURNING id
+            id_lst = [x[0] for x in r]
+            if len(id_lst) == len(rows):
+                # sqlite 的 RETURNING 不保证顺序
+                return sorted(id_lst) if sqlite_returning else id_lst
+
+        if len(rows) == 1:
+            return [r.lastrowid]
+
+        if dialect == SQLDialect.MYSQL:
+            # mysql 返回的是第一行的 id
+            return list(range(r.lastrowid, r.lastrowid + len(rows)))
+
+        # sqlite 返回的是最后一行的 id
+        return list(range(r.lastrowid - len(rows) + 1, r.lastrowid + 1))
+
+    async def _insert_rows_by_execute_many(self, model, tc, columns: Tuple[str, ...], rows: List[ValuesToWrite]):
+        sql = None
+        values_lst = []
+
+        for i in rows:
+            phg = self.get_placeholder_generator()
+            q = Query().into(model).columns(*columns).insert(
+                *[phg.next(i[_a], left_is_array=_a in tc['array_fields'], left_is_json=_a in tc['json_fields']) for _a in columns]
+            )
+            if sql is None:
+                sql = q.get_sql()
+            values_lst.append(phg.values)
+
+        await self.execute_many(sql, values_lst)
+
+    async def _insert_rows_chunked(self, model, tc, columns: Tuple[str, ...], rows: List[ValuesToWrite]) -> IDList:
+        """
+        按 insert_batch_size 与参数个数上限分成多条 INSERT 写入
+        """
+        size = max(1, min(self.insert_batch_size, self.get_max_bind_params() // max(len(columns), 1)))
+        id_lst = []
+        for n in range(0, len(rows), size):
+            id_lst.extend(await self._insert_rows(model, tc, columns, rows[n:n + size]))
+        return id_lst
+
     async def insert_many(self, table: Type[RecordMapping], values_list: Iterable[ValuesToWrite], *, _perm=None) -> IDList:
+        values_list = list(values_list)
         when_complete = []
         await table.on_insert(values_list, when_complete, _perm)
 
         model = self.mapping2model[table]
         tc = self._table_cache[table]
-        sql_lst = []
 
+        # 按列分组，同一组的数据可以合并为多行 INSERT
+        groups: Dict[Tuple[str, ...], List[int]] = {}
+        for index, i in enumerate(values_list):
+            groups.setdefault(tuple(i.keys()), []).append(index)
+
+        id_lst = [None] * len(values_list)
+        coalescer = self.insert_coalescer if self.get_transaction() is None else None
+
+        for columns, indexes in groups.items():
+            rows = [values_list[x] for x in indexes]
+
+            if coalescer and len(rows) < coalescer.max_rows:
+                ids = await coalescer.insert(self, model, tc, columns, rows)
+            elif self._has_ids(columns, rows) and len(indexes) > 1:
+                # id 已知，不需要取回自增值，同一条语句以 execute_many 批量执行
+                await self._insert_rows_by_execute_many(model, tc, columns, rows)
+                ids = [x['id'] for x in rows]
+            else:
+                ids = await self._insert_rows_chunked(model, tc, columns, rows)
+
+            for index, id_ in zip(indexes, ids):
+                id_lst[index] = id_
+
+        await self._run_when_complete(when_complete, id_lst)
+
+        return id_lst
+
+    def _upsert_clause(self, conflict: List[str], update_columns: List[str]) -> str:
+        """
+        INSERT 之后的 ON CONFLICT DO UPDATE / ON DUPLICATE KEY UPDATE 子句。
+        没有要更新的列时为 DO NOTHING，不会触发更新触发器（如全文索引的同步）；
+        mysql 没有对应的写法，以 "id"="id" 代替，BEFORE UPDATE 触发器仍会执行
+        """
+        q = lambda x: format_quotes(x, '"')
+
+        if self.get_dialect() == SQLDialect.MYSQL:
+            sets = ['%s=VALUES(%s)' % (q(x), q(x)) for x in update_columns] or ['"id"="id"']
+            return ' ON DUPLICATE KEY UPDATE ' + ','.join(sets)
+
+        if not update_columns:
+            return ' ON CONFLICT (%s) DO NOTHING' % ','.join(map(q, conflict))
+
+        sets = ['%s=excluded.%s' % (q(x), q(x)) for x in update_columns]
+        return ' ON CONFLICT (%s) DO UPDATE SET %s' % (','.join(map(q, conflict)), ','.join(sets))
+
+    async def _upsert_rows(self, sql: str, phg: PlaceHolderGenerator, model, conflict: List[str],
+                           keys: List[Tuple], returning: bool) -> Dict[Tuple, Any]:
+        """
+        执行一块 upsert，返回冲突列的值到 id 的映射。
+        returning 为 True 时每一行都会出现在 RETURNING 中：postgres 的后端为 INSERT 附加 RETURNING id，
+        顺序与 VALUES 一致（与 _insert_rows 相同）；sqlite 3.35+ 的 RETURNING 顺序不确定，连同冲突列一起返回。
+        其余情况（mysql、较旧的 sqlite、DO NOTHING）写入后再以冲突列查询
+        """
+        dialect = self.get_dialect()
+
+        if returning and dialect == SQLDialect.POSTGRESQL:
+            r = await self.execute_sql(sql, phg)
+            if r.values is not None:
+                rows = list(r)
+                if len(rows) == len(keys):
+                    return dict(zip(keys, [x[0] for x in rows]))
+
+        elif returning and dialect == SQLDialect.SQLITE and sqlite3.sqlite_version_info >= (3, 35, 0):
+            columns = ','.join(format_quotes(x, '"') for x in ['id'] + conflict)
+            r = await self.execute_sql(sql + ' RETURNING ' + columns, phg)
+            found = {tuple(x[1:]): x[0] for x in r}
+            # 排序规则（如 NOCASE）下返回的值可能与写入的不同，这些行再查询一次
+            missing = [x for x in keys if x not in found]
+            if missing:
+                found.update(await self._select_ids_by_keys(model, conflict, missing))
+            return found
+
+        else:
+            await self.execute_sql(sql, phg)
+
+        return await self._select_ids_by_keys(model, conflict, keys)
+
+    async def _select_ids_by_keys(self, model, conflict: List[str], keys: List[Tuple]) -> Dict[Tuple, Any]:
+        """
+        以冲突列的值查出对应行的 id
+        """
+        phg = self.get_placeholder_generator()
+        fields = [PypikaField(x) for x in conflict]
+
+        if len(fields) == 1:
+            cond = self._in_list_criterion(fields[0], [x[0] for x in keys], phg)
+        else:
+            cond = PypikaTuple(*fields).isin([PypikaTuple(*[phg.next(v) for v in k]) for k in keys])
+
+        sql = Query().from_(model).select(model.id, *fields).where(cond)
+        cursor = await self.execute_sql(sql.get_sql(), phg)
+        return {tuple(x[1:]): x[0] for x in cursor}
+
+    async def upsert_many(self, table: Type[RecordMapping], values_list: Iterable[ValuesToWrite],
+                          conflict_columns: Sequence[Union[str, RecordMappingField]],
+                          update_columns: Sequence[Union[str, RecordMappingField]] = None, *, _perm=None) -> IDList:
+        """
+        postgres/sqlite 编译为 INSERT ... ON CONFLICT (...) DO UPDATE，mysql 为 INSERT ... ON DUPLICATE KEY UPDATE
+        （冲突由表上的唯一索引决定），与 insert_many 一样按列分组分块，全部在一个事务中执行。
+        各行的 id 尽量由 RETURNING 取得，见 _upsert_rows。只触发 on_insert 钩子
+        """
+        values_list = list(values_list)
+        conflict = self._column_names(conflict_columns)
+        updates = None if update_columns is None else self._column_names(update_columns)
+
+        keys = []
         for i in values_list:
-            phg = self.get_placeholder_generator()
-            sql = Query().into(model).columns(*i.keys()).insert(
-                *[phg.next(_b, left_is_array=_a in tc['array_fields'], left_is_json=_a in tc['json_fields']) for _a, _b in i.items()]
-            )
-            sql_lst.append([sql, phg])
+            if any(k not in i for k in conflict):
+                raise InvalidQueryValue('conflict columns are required: %s' % ', '.join(conflict))
+            keys.append(tuple(i[k] for k in conflict))
 
-        ret = []
-        for i in sql_lst:
-            ret.append(await self.execute_sql(i[0].get_sql(), i[1]))
+        if len(set(keys)) != len(keys):
+            # 同一条语句不能两次更新同一行
+            raise InvalidQueryValue('duplicated conflict key in upsert_many')
 
-        id_lst = [x.lastrowid for x in ret]
-        for i in when_complete:
-            await i(id_lst)
+        when_complete = []
+        await table.on_insert(values_list, when_complete, _perm)
+
+        model = self.mapping2model[table]
+        tc = self._table_cache[table]
+
+        groups: Dict[Tuple[str, ...], List[int]] = {}
+        for index, i in enumerate(values_list):
+            groups.setdefault(tuple(i.keys()), []).append(index)
+
+        id_map = {}
+        by_id = conflict == ['id']
+
+        if groups and self.counter_buffer:
+            await self.counter_buffer.flush_columns(self, table, {k for x in groups for k in x})
+
+        if groups:
+            async with self.transaction():
+                for columns, indexes in groups.items():
+                    cols = [x for x in (columns if updates is None else updates)
+                            if x in columns and x not in conflict and x != 'id']
+                    clause = self._upsert_clause(conflict, cols)
+                    size = max(1, min(self.insert_batch_size, self.get_max_bind_params() // max(len(columns), 1)))
+
+                    for n in range(0, len(indexes), size):
+                        chunk = indexes[n:n + size]
+                        phg = self.get_placeholder_generator()
+                        sql = self._insert_query(model, tc, columns, [values_list[x] for x in chunk], phg)
+
+                        if by_id:
+                            await self.execute_sql(sql.get_sql() + clause, phg)
+                        else:
+                            id_map.update(await self._upsert_rows(sql.get_sql() + clause, phg, model, conflict,
+                                                                  [keys[x] for x in chunk], bool(cols)))
+
+        id_lst = [x[0] if by_id else id_map.get(x) for x in keys]
+        await self._run_when_complete(when_complete, id_lst)
 
         return id_lst
 
+    @staticmethod
+    def _set_value_expr(column, vflag: Optional[ValuesDataFlag], val):
+        """
+        SET 子句中 column 的新值，val 为写入的值（参数或其他列）
+        """
+        if vflag == ValuesDataFlag.INCR:
+            # f'{k} + {val}'
+            return ArithmeticExpression(Arithmetic.add, column, val)
+
+        elif vflag == ValuesDataFlag.DECR:
+            # f'{k} - {val}'
+            return ArithmeticExpression(Arithmetic.sub, column, val)
+
+        elif vflag == ValuesDataFlag.ARRAY_EXTEND:
+            # f'{k} || {val}'
+            return ArithmeticExpression(ArithmeticExt.concat, column, val)
+
+        elif vflag == ValuesDataFlag.ARRAY_PRUNE:
+            # TODO: 现在prune也会去重，这是不对的
+            # f'array(SELECT unnest({k}) EXCEPT SELECT unnest({val}))'
+            return PostgresArrayDifference(column, val)
+
+        elif vflag == ValuesDataFlag.ARRAY_EXTEND_DISTINCT:
+            # f'ARRAY(SELECT DISTINCT unnest({k} || {val}))'
+            return PostgresArrayDistinct(ArithmeticExpression(ArithmeticExt.concat, column, val))
+
+        elif vflag == ValuesDataFlag.ARRAY_PRUNE_DISTINCT:
+            return PostgresArrayDifference(column, val)
+
+        return val
+
+    def _update_set_values(self, sql, values: ValuesToWrite, tc, phg: PlaceHolderGenerator):
+        """
+        将 values 转换为 UPDATE 语句的 SET 部分
+        """
+        for k, v in values.items():
+            val = phg.next(v, left_is_array=k in tc['array_fields'], left_is_json=k in tc['json_fields'])
+            sql = sql.set(k, self._set_value_expr(PypikaField(k), values.data_flag.get(k), val))
+
+        return sql
+
+    async def _execute_by_ids(self, build: Callable[[PlaceHolderGenerator, IDList], Any], id_lst: IDList):
+        """
+        执行以 id IN (...) 为条件的语句，id 须为语句的最后一组参数。
+        参数数量超出上限时将 id 等长分块（末块以重复 id 补齐），以 execute_many 执行同一条语句
+        """
+        phg = self.get_placeholder_generator()
+        sql = build(phg, id_lst)
+        max_params = self.get_max_bind_params()
+
+        if len(phg.values) <= max_params:
+            return await self.execute_sql(sql.get_sql(), phg)
+
+        other_values = phg.values[:len(phg.values) - len(id_lst)]
+        size = max_params - len(other_values)
+        chunks = []
+        for n in range(0, len(id_lst), size):
+            chunk = id_lst[n:n + size]
+            chunk = chunk + chunk[-1:] * (size - len(chunk))
+            chunks.append((*other_values, *chunk))
+
+        phg = self.get_placeholder_generator()
+        sql = build(phg, chunks[0][len(other_values):])
+
+        if len(phg.values) == len(chunks[0]):
+            await self.execute_many(sql.get_sql(), chunks)
+        else:
+            # 分块后的 id 列表改用了其他绑定方式，形状不再一致
+            for n in range(0, len(id_lst), size):
+                phg = self.get_placeholder_generator()
+                sql = build(phg, id_lst[n:n + size])
+                await self.execute_sql(sql.get_sql(), phg)
+
+    def _support_returning(self) -> bool:
+        dialect = self.get_dialect()
+        if dialect == SQLDialect.POSTGRESQL:
+            return True
+        if dialect == SQLDialect.SQLITE:
+            return sqlite3.sqlite_version_info >= (3, 35, 0)
+        return False
+
+    @classmethod
+    def _is_single_table_condition(cls, c, table: Type[RecordMapping]) -> bool:
+        if c is None:
+            return True
+
+        if isinstance(c, (QueryConditions, ConditionLogicExpr)):
+            return all(cls._is_single_table_condition(x, table) for x in c.items)
+
+        elif isinstance(c, NegatedExpr):
+            return cls._is_single_table_condition(c.expr, table)
+
+        elif isinstance(c, ConditionExpr):
+            if c.column.table != table:
+                return False
+            if isinstance(c.value, RecordMappingField) and c.value.table != table:
+                return False
+            return True
+
+        return False
+
+    def _can_write_directly(self, info: QueryInfo) -> bool:
+        """
+        能否将查询条件直接编译进 UPDATE/DELETE 语句，并以 RETURNING 取回 id
+        """
+        if not (self.direct_write and self._support_returning()):
+            return False
+        if info.join:
+            return False
+        return self._is_single_table_condition(info.conditions, info.from_table)
+
+    def _direct_write_where(self, sql, info: QueryInfo, phg: PlaceHolderGenerator):
+        model = self.mapping2model[info.from_table]
+
+        if info.limit == -1 and not info.offset:
+            where = self._solve_condition(info.conditions, phg) if info.conditions else None
+            return sql.where(where) if where else sql
+
+        # 与 get_list 保持一致的分页语义
+        qi = info.clone()
+        qi.select = []
+        sub = self._apply_order_and_limit(self._build_select_query(qi, phg), info, phg)
+        return sql.where(model.id.isin(sub))
+
     async def update(self, info: QueryInfo, values: ValuesToWrite, *, _perm=None) -> IDList:
         # hook
         await info.from_table.on_query(info, _perm)
@@ -180,95 +819,352 @@ class SQLCrud(BaseCrud):
 
         model = self.mapping2model[info.from_table]
         tc = self._table_cache[info.from_table]
-        qi = info.clone()
-        qi.select = []
-        lst = await self.get_list(qi, _perm=_perm)
-        id_lst = [x.id for x in lst]
 
-        for i in when_before_update:
-            await i(id_lst)
+        buffer = self.counter_buffer
+        buffered = buffer and self.get_transaction() is None and buffer.accepts(values)
+        if buffer and not buffered:
+            # 缓冲中这些列的增量须先于本次写入
+            await buffer.flush_columns(self, info.from_table, values.keys())
 
-        if id_lst:
-            # 选择项
+        if buffered:
+            qi = info.clone()
+            qi.select = []
+            id_lst = [x.id for x in await self.get_list(qi, _perm=_perm)]
+
+            for i in when_before_update:
+                await i(id_lst)
+
+            if id_lst:
+                buffer.add(self, info.from_table, id_lst, values)
+
+        elif not when_before_update and self._can_write_directly(info):
             phg = self.get_placeholder_generator()
-            sql = Query().update(model)
-            for k, v in values.items():
-                vflag = values.data_flag.get(k)
+            sql = self._update_set_values(Query().update(model), values, tc, phg)
+            sql = self._direct_write_where(sql, info, phg)
+            cursor = await self.execute_sql(sql.get_sql() + ' RETURNING id', phg)
+            id_lst = [x[0] for x in cursor]
+        else:
+            qi = info.clone()
+            qi.select = []
+            lst = await self.get_list(qi, _perm=_perm)
+            id_lst = [x.id for x in lst]
 
-                val = phg.next(v, left_is_array=k in tc['array_fields'], left_is_json=k in tc['json_fields'])
+            for i in when_before_update:
+                await i(id_lst)
 
-                if vflag:
-                    if vflag == ValuesDataFlag.INCR:
-                        # f'{k} + {val}'
-                        sql = sql.set(k, ArithmeticExpression(Arithmetic.add, PypikaField(k), val))
+            if id_lst:
+                def build(phg, ids):
+                    sql = self._update_set_values(Query().update(model), values, tc, phg)
+                    # 注意：生成的SQL顺序和values顺序的对应关系
+                    return sql.where(self._in_list_criterion(model.id, ids, phg))
 
-                    elif vflag == ValuesDataFlag.DECR:
-                        # f'{k} - {val}'
-                        sql = sql.set(k, ArithmeticExpression(Arithmetic.sub, PypikaField(k), val))
+                await self._execute_by_ids(build, id_lst)
 
-                    elif vflag == ValuesDataFlag.ARRAY_EXTEND:
-                        # f'{k} || {val}'
-                        vexpr = ArithmeticExpression(ArithmeticExt.concat, PypikaField(k), val)
-                        sql = sql.set(k, vexpr)
+        await self._run_when_complete(when_complete)
 
-                    elif vflag == ValuesDataFlag.ARRAY_PRUNE:
-                        # TODO: 现在prune也会去重，这是不对的
-                        # f'array(SELECT unnest({k}) EXCEPT SELECT unnest({val}))'
-                        vexpr = PostgresArrayDifference(PypikaField(k), val)
-                        sql = sql.set(k, vexpr)
+        return id_lst
 
-                    elif vflag == ValuesDataFlag.ARRAY_EXTEND_DISTINCT:
-                        # f'ARRAY(SELECT DISTINCT unnest({k} || {val}))'
-                        vexpr = PostgresArrayDistinct(ArithmeticExpression(ArithmeticExt.concat, PypikaField(k), val))
-                        sql = sql.set(k, vexpr)
+    def _bulk_update_case_sql(self, model, tc, columns: Tuple, rows: List[Tuple[Any, ValuesToWrite]]):
+        """
+        UPDATE t SET a=CASE WHEN id=? THEN ? ... END, ... WHERE id IN (...)
+        """
+        phg = self.get_placeholder_generator()
+        sql = Query().update(model)
+
+        for k, vflag in columns:
+            case = Case()
+            for id_, values in rows:
+                cond = model.id == phg.next(id_)
+                val = phg.next(values[k], left_is_array=k in tc['array_fields'], left_is_json=k in tc['json_fields'])
+                case = case.when(cond, self._set_value_expr(PypikaField(k), vflag, val))
+            sql = sql.set(k, case)
+
+        sql = sql.where(self._in_list_criterion(model.id, [x[0] for x in rows], phg))
+        return sql.get_sql(), phg
+
+    def _bulk_update_values_sql(self, model, tc, columns: Tuple, rows: List[Tuple[Any, ValuesToWrite]]):
+        """
+        UPDATE t SET a=v.a, ... FROM (VALUES (...), ...) AS v(id, a, ...) WHERE t.id=v.id
+        """
+        phg = self.get_placeholder_generator()
+        table_name = model.get_table_name()
+        names = ['id'] + [k for k, _ in columns]
+        q = lambda x: format_quotes(x, '"')
+
+        # 首行为表的行类型的 NULL，各列参数随之取得与表中的列相同的类型，且这一行不会匹配任何行
+        values_lst = ['(%s)' % ', '.join('(NULL::%s).%s' % (q(table_name), q(x)) for x in names)]
+        for id_, values in rows:
+            params = [phg.next(id_)]
+            for k, _ in columns:
+                params.append(phg.next(values[k], left_is_array=k in tc['array_fields'], left_is_json=k in tc['json_fields']))
+            values_lst.append('(%s)' % ', '.join(x.get_sql() for x in params))
+
+        target, source = pypika.Table(table_name), pypika.Table('pycrud_v')
+        sets = []
+        for k, vflag in columns:
+            expr = self._set_value_expr(PypikaField(k, table=target), vflag, PypikaField(k, table=source))
+            sets.append('%s=%s' % (q(k), expr.get_sql(quote_char='"', with_namespace=True)))
+
+        sql = 'UPDATE %s SET %s FROM (VALUES %s) AS "pycrud_v"(%s) WHERE %s."id"="pycrud_v"."id"' % (
+            q(table_name), ','.join(sets), ', '.join(values_lst), ','.join(map(q, names)), q(table_name))
+        return sql, phg
+
+    async def bulk_update(self, table: Type[RecordMapping], items: Iterable[Tuple[Any, ValuesToWrite]], *,
+                          _perm=None) -> IDList:
+        """
+        按 id 分别更新多行，写入的列与标记相同的行合为一组，每组分块编译为一条语句并在一个事务中执行：
+        postgres 为 UPDATE ... FROM (VALUES ...)，其他数据库为 CASE WHEN id=? THEN ? 。
+        on_update 钩子对每一行分别调用
+        """
+        items = [(id_, values) for id_, values in items if values]
+        if not items:
+            return []
+
+        ids = [x[0] for x in items]
+        if len(set(ids)) != len(ids):
+            raise InvalidQueryValue('duplicated id in bulk_update')
 
-                    elif vflag == ValuesDataFlag.ARRAY_PRUNE_DISTINCT:
-                        vexpr = PostgresArrayDifference(PypikaField(k), val)
-                        sql = sql.set(k, vexpr)
+        when_before_update, when_complete = [], []
+        for id_, values in items:
+            qi = QueryInfo(table, [], conditions=QueryConditions([ConditionExpr(table.id, QUERY_OP_COMPARE.EQ, id_)]))
+            await table.on_update(qi, values, when_before_update, when_complete, _perm)
 
-                else:
-                    sql = sql.set(k, val)
+        # 只更新存在的行，on_query 附加的条件同样生效
+        info = QueryInfo(table, [], conditions=QueryConditions([ConditionExpr(table.id, QUERY_OP_RELATION.IN, ids)]))
+        info.limit = -1
+        existing = {x.id for x in await self.get_list(info, _perm=_perm)}
+        items = [x for x in items if x[0] in existing]
+        id_lst = [x[0] for x in items]
 
-            # 注意：生成的SQL顺序和values顺序的对应关系
-            sql = sql.where(model.id.isin(phg.next(id_lst)))
-            await self.execute_sql(sql.get_sql(), phg)
+        for i in when_before_update:
+            await i(id_lst)
 
-        for i in when_complete:
-            await i()
+        groups: Dict[Tuple, List[Tuple[Any, ValuesToWrite]]] = {}
+        for id_, values in items:
+            groups.setdefault(tuple((k, values.data_flag.get(k)) for k in sorted(values.keys())), []).append((id_, values))
+
+        model = self.mapping2model[table]
+        tc = self._table_cache[table]
+        from_values = self.get_dialect() == SQLDialect.POSTGRESQL
+
+        if groups and self.counter_buffer:
+            await self.counter_buffer.flush_columns(self, table, {k for x in groups for k, _ in x})
+
+        if groups:
+            async with self.transaction():
+                for columns, rows in groups.items():
+                    per_row = len(columns) + 1 if from_values else len(columns) * 2 + 1
+                    size = max(1, min(self.insert_batch_size, self.get_max_bind_params() // per_row))
+
+                    for n in range(0, len(rows), size):
+                        build = self._bulk_update_values_sql if from_values else self._bulk_update_case_sql
+                        sql, phg = build(model, tc, columns, rows[n:n + size])
+                        await self.execute_sql(sql, phg)
+
+        await self._run_when_complete(when_complete)
 
         return id_lst
 
+    async def _write_counter_deltas(self, table: Type[RecordMapping], deltas: Dict[Any, Dict[str, Union[int, float]]]):
+        """
+        写入 CounterBuffer 中一张表的增量：UPDATE t SET a=a+?, b=b+? WHERE id=?，以 execute_many 执行
+        """
+        columns = sorted({k for d in deltas.values() for k in d})
+        model = self.mapping2model[table]
+        sql = None
+        values_lst = []
+
+        for id_, d in deltas.items():
+            phg = self.get_placeholder_generator()
+            q = Query().update(model)
+            for k in columns:
+                q = q.set(k, ArithmeticExpression(Arithmetic.add, PypikaField(k), phg.next(d.get(k, 0))))
+            q = q.where(model.id == phg.next(id_))
+            if sql is None:
+                sql = q.get_sql()
+            values_lst.append(phg.values)
+
+        async with self.transaction():
+            await self.execute_many(sql, values_lst)
+
     async def delete(self, info: QueryInfo, *, _perm=None) -> IDList:
         model = self.mapping2model[info.from_table]
         when_before_delete, when_complete = [], []
         await info.from_table.on_delete(info, when_before_delete, when_complete, _perm)
 
-        qi = info.clone()
-        qi.select = []
-        lst = await self.get_list(qi, _perm=_perm)
+        if not when_before_delete and self._can_write_directly(info):
+            await info.from_table.on_query(info, _perm)
+            phg = self.get_placeholder_generator()
+            sql = self._direct_write_where(Query().from_(model).delete(), info, phg)
+            cursor = await self.execute_sql(sql.get_sql() + ' RETURNING id', phg)
+            id_lst = [x[0] for x in cursor]
+        else:
+            qi = info.clone()
+            qi.select = []
+            lst = await self.get_list(qi, _perm=_perm)
 
-        # 选择项
-        id_lst = [x.id for x in lst]
+            # 选择项
+            id_lst = [x.id for x in lst]
 
-        for i in when_before_delete:
-            await i(id_lst)
+            for i in when_before_delete:
+                await i(id_lst)
 
-        if id_lst:
-            phg = self.get_placeholder_generator()
-            sql = Query().from_(model).delete().where(model.id.isin(phg.next(id_lst)))
-            await self.execute_sql(sql.get_sql(), phg)
+            if id_lst:
+                await self._execute_by_ids(
+                    lambda phg, ids: Query().from_(model).delete().where(self._in_list_criterion(model.id, ids, phg)),
+                    id_lst
+                )
 
-        for i in when_complete:
-            await i()
+        await self._run_when_complete(when_complete)
 
         return id_lst
 
-    async def get_list(self, info: QueryInfo, with_count=False, *, _perm=None) -> QueryResultRowList:
-        # hook
-        await info.from_table.on_query(info, _perm)
-        when_complete = []
-        await info.from_table.on_read(info, when_complete, _perm)
+    def _in_list_mode(self, value) -> Optional[str]:
+        """
+        IN 列表的绑定方式：'array' 单个数组参数，'json' 单个 json 参数，'inline' 整数直接写入语句，None 逐个展开
+        """
+        dialect = self.get_dialect()
+
+        if dialect == SQLDialect.POSTGRESQL:
+            return 'array'
+
+        if len(value) <= self.in_list_inline_max:
+            return None
+
+        if dialect == SQLDialect.SQLITE and all(isinstance(x, (int, str)) for x in value):
+            return 'json'
+
+        if all(type(x) is int for x in value):
+            return 'inline'
+
+    def _in_list_criterion(self, field, value, phg: PlaceHolderGenerator, negated=False):
+        """
+        编译 IN/NOT IN。postgres 总是以单个数组参数传入，sqlite 中较长的列表以单个 json 参数传入，
+        语句长度与列表长度无关，也不会超出参数数量上限。
+        mysql 等较长的整数列表直接写入语句，不占用参数；其余的列表逐个绑定，超过 get_max_bind_params() 时由数据库报错
+        """
+        mode = self._in_list_mode(value)
+
+        if mode == 'array':
+            return PostgresArrayAnyAll(field, phg.next(list(value), left_is_array=True), negated)
 
+        if mode == 'inline':
+            return field.notin(list(value)) if negated else field.isin(list(value))
+
+        if mode == 'json':
+            p = phg.next(list(value), left_is_json=True)
+            p = Parameter('(SELECT value FROM json_each(%s))' % p.get_sql())
+        else:
+            p = phg.next(value)
+
+        return field.notin(p) if negated else field.isin(p)
+
+    def _prefix_mode(self, c: ConditionExpr) -> str:
+        """
+        prefix/iprefix 的编译方式：range 为区间，like 为 LIKE，ilike 为 ILIKE（postgres），lower_like 为 lower(列) LIKE
+        """
+        ignore_case = c.op == QUERY_OP_RELATION.IPREFIX
+        if self.prefix_as_range and prefix_upper_bound(c.value) is not None:
+            key = 'lower_index_fields' if ignore_case else 'index_fields'
+            if c.column.name in self._table_cache[c.column.table][key]:
+                return 'range'
+
+        if not ignore_case:
+            return 'like'
+        return 'ilike' if self.get_dialect() == SQLDialect.POSTGRESQL else 'lower_like'
+
+    def _prefix_values(self, c: ConditionExpr, mode: str) -> List[str]:
+        value = c.value.lower() if c.op == QUERY_OP_RELATION.IPREFIX and mode != 'ilike' else c.value
+        if mode == 'range':
+            return [value, prefix_upper_bound(value)]
+        return [escape_like(value) + '%']
+
+    def _prefix_criterion(self, c: ConditionExpr, field, phg: PlaceHolderGenerator):
+        mode = self._prefix_mode(c)
+        values = [phg.next(x) for x in self._prefix_values(c, mode)]
+
+        if c.op == QUERY_OP_RELATION.IPREFIX and mode != 'ilike':
+            # 以 lower(列) 比较，可以使用其上的表达式索引
+            field = Lower(field)
+        if mode == 'range':
+            return (field >= values[0]) & (field < values[1])
+        return LikeEscape(field, values[0], mode == 'ilike')
+
+    def _match_value(self, c: ConditionExpr) -> str:
+        if c.column.name not in self._table_cache[c.column.table]['fts_fields']:
+            raise UnsupportedQueryOperator('column has no full-text index: %s' % c.column.name)
+        if not isinstance(c.value, str):
+            raise InvalidQueryValue('right value of match should be str: %r' % c.value)
+        return fts5_query(c.value) if self.get_dialect() == SQLDialect.SQLITE else c.value
+
+    def _match_criterion(self, c: ConditionExpr, phg: PlaceHolderGenerator, rank=False):
+        model = self.mapping2model[c.column.table]
+        return FullTextMatch(self.get_dialect(), model.id, getattr(model, c.column.name),
+                             phg.next(self._match_value(c)), self.fts_config, rank)
+
+    def _solve_condition(self, c, phg: PlaceHolderGenerator):
+        """
+        将条件树编译为 pypika 的 Criterion，参数依编译顺序写入 phg
+        """
+        if isinstance(c, QueryConditions):
+            items = list([self._solve_condition(x, phg) for x in c.items])
+            if items:
+                return reduce(ComplexCriterion.__and__, items)  # 部分orm在实现join条件的时候拼接的语句不正确
+
+        elif isinstance(c, (QueryConditions, ConditionLogicExpr)):
+            items = [self._solve_condition(x, phg) for x in c.items]
+            if items:
+                if c.type == 'and':
+                    return reduce(ComplexCriterion.__and__, items)
+                else:
+                    return reduce(ComplexCriterion.__or__, items)
+
+        elif isinstance(c, ConditionExpr):
+            field = getattr(self.mapping2model[c.column.table], c.column.name)
+
+            if c.op == QUERY_OP_RELATION.MATCH:
+                return self._match_criterion(c, phg)
+
+            if c.op in (QUERY_OP_RELATION.IN, QUERY_OP_RELATION.NOT_IN) and isinstance(c.value, (List, Set, Tuple)):
+                return self._in_list_criterion(field, c.value, phg, c.op == QUERY_OP_RELATION.NOT_IN)
+
+            if isinstance(c.value, RecordMappingField):
+                real_value = getattr(self.mapping2model[c.value.table], c.value.name)
+            else:
+                contains_relation = c.op in (QUERY_OP_RELATION.CONTAINS,
+                                             QUERY_OP_RELATION.CONTAINS_ANY)
+
+                if c.op in (QUERY_OP_RELATION.PREFIX, QUERY_OP_RELATION.IPREFIX):
+                    return self._prefix_criterion(c, field, phg)
+
+                # value = [c.value] if c.op == QUERY_OP_RELATION.CONTAINS_ANY else c.value
+                real_value = phg.next(c.value, contains_relation=contains_relation)
+
+            if c.op == QUERY_OP_RELATION.PREFIX:
+                cond = field.like(real_value)
+            elif c.op == QUERY_OP_RELATION.IPREFIX:
+                cond = field.ilike(real_value)
+
+            elif c.op == QUERY_OP_RELATION.IS:
+                cond = BasicCriterion(ArrayMatchingExt.is_, field, field.wrap_constant(real_value))
+            elif c.op == QUERY_OP_RELATION.IS_NOT:
+                cond = BasicCriterion(ArrayMatchingExt.is_not, field, field.wrap_constant(real_value))
+
+            elif c.op == QUERY_OP_RELATION.CONTAINS_ANY:
+                # &&
+                cond = BasicCriterion(ArrayMatchingExt.contains_any, field, field.wrap_constant(real_value))
+            else:
+                cond = getattr(field, _sql_method_map[c.op])(real_value)
+
+            return cond
+
+        elif isinstance(c, NegatedExpr):
+            return ~self._solve_condition(c.expr, phg)
+
+    def _build_select_query(self, info: QueryInfo, phg: PlaceHolderGenerator):
+        """
+        构造 SELECT 语句的选择项与条件部分，不含排序和分页
+        """
         model = self.mapping2model[info.from_table]
 
         # 选择项
@@ -280,88 +1176,62 @@ class SQLCrud(BaseCrud):
             select_fields.append(getattr(self.mapping2model[i.table], i.name))
 
         q = q.select(*select_fields)
-        phg = self.get_placeholder_generator()
 
         # 构造条件
         if info.conditions:
-            def solve_condition(c):
-                if isinstance(c, QueryConditions):
-                    items = list([solve_condition(x) for x in c.items])
-                    if items:
-                        return reduce(ComplexCriterion.__and__, items)  # 部分orm在实现join条件的时候拼接的语句不正确
-
-                elif isinstance(c, (QueryConditions, ConditionLogicExpr)):
-                    items = [solve_condition(x) for x in c.items]
-                    if items:
-                        if c.type == 'and':
-                            return reduce(ComplexCriterion.__and__, items)
-                        else:
-                            return reduce(ComplexCriterion.__or__, items)
-
-                elif isinstance(c, ConditionExpr):
-                    field = getattr(self.mapping2model[c.column.table], c.column.name)
-
-                    if isinstance(c.value, RecordMappingField):
-                        real_value = getattr(self.mapping2model[c.value.table], c.value.name)
-                    else:
-                        contains_relation = c.op in (QUERY_OP_RELATION.CONTAINS,
-                                                     QUERY_OP_RELATION.CONTAINS_ANY)
-
-                        # value = [c.value] if c.op == QUERY_OP_RELATION.CONTAINS_ANY else c.value
-                        if c.op in (QUERY_OP_RELATION.PREFIX, QUERY_OP_RELATION.IPREFIX):
-                            # TODO: 更好的安全机制，防止利用like语句
-                            c.value = c.value.replace('%', '')
-                            c.value = c.value + '%'
-                        real_value = phg.next(c.value, contains_relation=contains_relation)
-
-                    if c.op == QUERY_OP_RELATION.PREFIX:
-                        cond = field.like(real_value)
-                    elif c.op == QUERY_OP_RELATION.IPREFIX:
-                        cond = field.ilike(real_value)
-
-                    elif c.op == QUERY_OP_RELATION.IS:
-                        cond = BasicCriterion(ArrayMatchingExt.is_, field, field.wrap_constant(real_value))
-                    elif c.op == QUERY_OP_RELATION.IS_NOT:
-                        cond = BasicCriterion(ArrayMatchingExt.is_not, field, field.wrap_constant(real_value))
-
-                    elif c.op == QUERY_OP_RELATION.CONTAINS_ANY:
-                        # &&
-                        cond = BasicCriterion(ArrayMatchingExt.contains_any, field, field.wrap_constant(real_value))
-                    else:
-                        cond = getattr(field, _sql_method_map[c.op])(real_value)
-
-                    return cond
-
-                elif isinstance(c, NegatedExpr):
-                    return ~solve_condition(c.expr)
-
             if info.join:
                 for ji in info.join:
                     jtable = self.mapping2model[ji.table]
-                    where = solve_condition(ji.conditions)
+                    where = self._solve_condition(ji.conditions, phg)
 
                     if ji.limit == -1:
                         q = q.inner_join(jtable).on(where)
                     else:
-                        q = q.inner_join(jtable).on(
-                            jtable.id == Query.from_(jtable).select(jtable.id).where(where).limit(ji.limit)
+                        sub = self._build_ranked_join(info, ji, where, phg)
+                        q = q.inner_join(sub).on(
+                            (PypikaField('__pid', table=sub) == model.id) &
+                            (PypikaField('__rn', table=sub) <= ji.limit)
                         )
 
-            ret = solve_condition(info.conditions)
+            ret = self._solve_condition(info.conditions, phg)
             if ret:
                 q = q.where(ret)
 
-        ret = QueryResultRowList()
+        return q
 
-        # count
-        if with_count:
-            bak = q._selects
-            q._selects = [Count('1')]
-            cursor = await self.execute_sql(q.get_sql(), phg)
-            ret.rows_count = next(iter(cursor))[0]
-            q._selects = bak
+    def _ranked_join_with_filter(self, info: QueryInfo, ji: QueryJoinInfo) -> bool:
+        # 主表条件只涉及主表时，在排名子查询中也应用一次，缩小参与排名的范围
+        return ji.limit != -1 and self._is_single_table_condition(info.conditions, info.from_table)
 
-        # 一些限制
+    def _build_ranked_join(self, info: QueryInfo, ji: QueryJoinInfo, where, phg: PlaceHolderGenerator):
+        """
+        每个上级只取前 N 条的 join：以 ROW_NUMBER() OVER (PARTITION BY 上级.id) 为子表排名，
+        子查询别名与子表同名，外层的选择项无需改写
+        """
+        model = self.mapping2model[info.from_table]
+        jtable = self.mapping2model[ji.table]
+
+        rn = RowNumber().over(model.id)
+        for i in (ji.order_by or [QueryOrder(ji.table.id)]):
+            rn = rn.orderby(getattr(jtable, i.column.name), order=Order.desc if i.order == 'desc' else Order.asc)
+
+        sub = Query.from_(model).inner_join(jtable).on(where)
+        sub = sub.select(jtable.star, model.id.as_('__pid'), rn.as_('__rn'))
+
+        if self._ranked_join_with_filter(info, ji):
+            ret = self._solve_condition(info.conditions, phg)
+            if ret:
+                sub = sub.where(ret)
+
+        return sub.as_(jtable.get_table_name())
+
+    def _rank_condition(self, info: QueryInfo, order: QueryOrder) -> ConditionExpr:
+        c = info.get_match_condition(order.column)
+        if c is None:
+            raise InvalidOrderSyntax('rank order requires a match condition on column: %s' % order.column.name)
+        return c
+
+    def _apply_order(self, q, info: QueryInfo, phg: PlaceHolderGenerator):
         if info.order_by:
             order_dict = {
                 'default': None,
@@ -369,23 +1239,363 @@ class SQLCrud(BaseCrud):
                 'asc': Order.asc
             }
             for i in info.order_by:
-                q = q.orderby(i.column.name, order=order_dict[i.order])
+                if i.rank:
+                    term = self._match_criterion(self._rank_condition(info, i), phg, rank=True)
+                    q = q.orderby(term, order=Order.asc if i.order == 'asc' else Order.desc)
+                else:
+                    q = q.orderby(i.column.name, order=order_dict[i.order])
+        return q
+
+    def _bind_order_values(self, info: QueryInfo, phg: PlaceHolderGenerator):
+        for i in info.order_by:
+            if i.rank:
+                phg.next(self._match_value(self._rank_condition(info, i)))
+
+    def _apply_order_and_limit(self, q, info: QueryInfo, phg: PlaceHolderGenerator):
+        # 一些限制
+        q = self._apply_order(q, info, phg)
         if info.limit != -1:
             q = q.limit(info.limit)
         q = q.offset(info.offset)
+        return q
+
+    def _condition_shape(self, c):
+        """
+        条件树的结构，不含具体的值。结构相同的条件编译出的 SQL 相同，参数顺序也相同
+        """
+        if isinstance(c, (QueryConditions, ConditionLogicExpr)):
+            return type(c), c.type, tuple(self._condition_shape(x) for x in c.items)
+
+        elif isinstance(c, NegatedExpr):
+            return NegatedExpr, self._condition_shape(c.expr)
+
+        elif isinstance(c, ConditionExpr):
+            if c.op in (QUERY_OP_RELATION.IN, QUERY_OP_RELATION.NOT_IN) and isinstance(c.value, (List, Set, Tuple)):
+                value_shape = self._in_list_mode(c.value) or len(c.value)
+                if value_shape == 'inline':
+                    # 值在语句之中
+                    value_shape = tuple(c.value)
+            elif isinstance(c.value, RecordMappingField):
+                value_shape = (c.value.table, c.value.name)
+            elif c.op in (QUERY_OP_RELATION.PREFIX, QUERY_OP_RELATION.IPREFIX):
+                value_shape = self._prefix_mode(c)
+            elif isinstance(c.value, (List, Set, Tuple)) and \
+                    c.op not in (QUERY_OP_RELATION.CONTAINS, QUERY_OP_RELATION.CONTAINS_ANY):
+                # 与 _bind_condition_values 一致，列表按元素展开为多个参数
+                value_shape = len(c.value)
+            else:
+                value_shape = None
+            return c.column.table, c.column.name, c.op, value_shape
+
+        return c
+
+    def _bind_condition_values(self, c, phg: PlaceHolderGenerator):
+        """
+        按 _solve_condition 的顺序与规则绑定参数，但不构造语句
+        """
+        if isinstance(c, (QueryConditions, ConditionLogicExpr)):
+            for i in c.items:
+                self._bind_condition_values(i, phg)
+
+        elif isinstance(c, NegatedExpr):
+            self._bind_condition_values(c.expr, phg)
+
+        elif isinstance(c, ConditionExpr):
+            if c.op in (QUERY_OP_RELATION.IN, QUERY_OP_RELATION.NOT_IN) and isinstance(c.value, (List, Set, Tuple)):
+                mode = self._in_list_mode(c.value)
+                if mode == 'array':
+                    phg.next(list(c.value), left_is_array=True)
+                elif mode == 'json':
+                    phg.next(list(c.value), left_is_json=True)
+                elif mode != 'inline':
+                    phg.next(c.value)
+
+            elif c.op == QUERY_OP_RELATION.MATCH:
+                phg.next(self._match_value(c))
+
+            elif not isinstance(c.value, RecordMappingField):
+                contains_relation = c.op in (QUERY_OP_RELATION.CONTAINS,
+                                             QUERY_OP_RELATION.CONTAINS_ANY)
+
+                if c.op in (QUERY_OP_RELATION.PREFIX, QUERY_OP_RELATION.IPREFIX):
+                    for i in self._prefix_values(c, self._prefix_mode(c)):
+                        phg.next(i)
+                else:
+                    phg.next(c.value, contains_relation=contains_relation)
+
+    def _select_shape(self, info: QueryInfo, count_strategy: Optional[COUNT_STRATEGY]):
+        join_shape = None
+        if info.conditions and info.join:
+            join_shape = tuple((ji.table, ji.limit, self._condition_shape(ji.conditions),
+                                tuple((x.column.name, x.order) for x in ji.order_by or [])) for ji in info.join)
+
+        return (
+            info.from_table,
+            tuple((x.table, x.name) for x in info.select_for_crud),
+            join_shape,
+            self._condition_shape(info.conditions) if info.conditions else None,
+            tuple((x.column.name, x.order, x.rank) for x in info.order_by),
+            info.limit != -1,
+            bool(info.offset),
+            count_strategy
+        )
+
+    @staticmethod
+    def _limit_values(info: QueryInfo) -> List[int]:
+        values = []
+        if info.limit != -1:
+            values.append(info.limit)
+        if info.offset:
+            values.append(info.offset)
+        return values
+
+    def _compile_select(self, info: QueryInfo, count_strategy: Optional[COUNT_STRATEGY],
+                        phg: PlaceHolderGenerator) -> Tuple[Optional[str], str, List]:
+        """
+        编译 get_list 的语句，返回 (count_sql, sql, tail_values)。
+        tail_values 为排序（按相关度排序时）与分页部分的参数，count_sql 中没有这部分，
+        需在执行 count_sql 之后追加到 phg.values。启用 sql_cache 时 LIMIT/OFFSET 以参数形式出现
+        """
+        key = None
+
+        # 无 LIMIT 只有 OFFSET 的写法各数据库不一致，不做缓存
+        if self.sql_cache is not None and (info.limit != -1 or not info.offset):
+            key = self._select_shape(info, count_strategy)
+            hit = self.sql_cache.get(key)
+
+            if hit is not None:
+                if info.conditions:
+                    for ji in info.join or []:
+                        self._bind_condition_values(ji.conditions, phg)
+                        if self._ranked_join_with_filter(info, ji):
+                            self._bind_condition_values(info.conditions, phg)
+                    self._bind_condition_values(info.conditions, phg)
+
+                n = len(phg.values)
+                self._bind_order_values(info, phg)
+                tail_values = phg.values[n:] + self._limit_values(info)
+                del phg.values[n:]
+                return hit[0], hit[1], tail_values
+
+        q = self._build_select_query(info, phg)
+        count_sql = None
+
+        if count_strategy:
+            bak = q._selects
+            q._selects = [Count('1')]
+            count_sql = q.get_sql()
+            q._selects = bak
+
+            if count_strategy == COUNT_STRATEGY.WINDOW:
+                q = q.select(CountOver())
+
+        n = len(phg.values)
+        if key is None:
+            sql = self._apply_order_and_limit(q, info, phg).get_sql()
+        else:
+            sql = self._apply_order(q, info, phg).get_sql()
+            if info.limit != -1:
+                sql += ' LIMIT %s' % phg.next(info.limit).get_sql()
+            if info.offset:
+                sql += ' OFFSET %s' % phg.next(info.offset).get_sql()
+            self.sql_cache.set(key, (count_sql, sql))
+
+        tail_values = phg.values[n:]
+        del phg.values[n:]
+        return count_sql, sql, tail_values
+
+    async def _estimate_count(self, info: QueryInfo, count_sql: str, phg: PlaceHolderGenerator) -> Optional[int]:
+        """
+        从数据库的统计信息估算行数，无法估算时返回 None
+        """
+        dialect = self.get_dialect()
+        table_name = self.mapping2model[info.from_table].get_table_name()
+        no_filter = not info.join and not (info.conditions and info.conditions.items)
+
+        if dialect == SQLDialect.POSTGRESQL:
+            if no_filter:
+                phg = self.get_placeholder_generator()
+                sql = 'SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)' % phg.next(table_name).get_sql()
+                row = next(iter(await self.execute_sql(sql, phg)), None)
+                return int(row[0]) if row and row[0] >= 0 else None
+
+            row = next(iter(await self.execute_sql('EXPLAIN (FORMAT JSON) ' + count_sql, phg)))
+            plan = json.loads(row[0]) if isinstance(row[0], str) else row[0]
+            plan = plan[0]['Plan']
+            # COUNT 之下一层的行数
+            return int(plan['Plans'][0]['Plan Rows'] if plan.get('Plans') else plan['Plan Rows'])
+
+        if not no_filter:
+            return None
+
+        if dialect == SQLDialect.SQLITE:
+            phg = self.get_placeholder_generator()
+            sql = "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+            if next(iter(await self.execute_sql(sql, phg)), None) is None:
+                # 没有执行过 ANALYZE
+                return None
+
+            sql = 'SELECT stat FROM sqlite_stat1 WHERE tbl = %s' % phg.next(table_name).get_sql()
+            row = next(iter(await self.execute_sql(sql, phg)), None)
+            return int(row[0].split(' ', 1)[0]) if row else None
+
+        if dialect == SQLDialect.MYSQL:
+            phg = self.get_placeholder_generator()
+            sql = 'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() ' \
+                  'AND table_name = %s' % phg.next(table_name).get_sql()
+            row = next(iter(await self.execute_sql(sql, phg)), None)
+            return int(row[0]) if row and row[0] is not None else None
+
+    def _optimize_query(self, info: QueryInfo) -> Optional[QueryInfo]:
+        """
+        化简查询条件，条件不可能成立时返回 None
+        """
+        if not self.condition_optimizer or not info.conditions:
+            return info
+
+        conditions = optimize_conditions(info.conditions)
+        if conditions is None:
+            return None
+
+        info = info.clone()
+        info.conditions = conditions
+        return info
+
+    async def get_list(self, info: QueryInfo, with_count=False, *, _perm=None) -> QueryResultRowList:
+        # hook
+        await info.from_table.on_query(info, _perm)
+        when_complete = []
+        await info.from_table.on_read(info, when_complete, _perm)
+
+        count_strategy = None
+        if with_count:
+            count_strategy = with_count if isinstance(with_count, COUNT_STRATEGY) else self.count_strategy
+
+        query = self._optimize_query(info)
+        if query is None:
+            ret = QueryResultRowList()
+            if count_strategy:
+                ret.rows_count = 0
+            for i in when_complete:
+                await i(ret)
+            return ret
+
+        keyset = query.cursor is not None
+        if keyset:
+            query = query.to_keyset_query()
+
+        phg = self.get_placeholder_generator()
+        count_sql, sql, tail_values = self._compile_select(query, count_strategy, phg)
+        count_phg = copy.copy(phg)
+        count_phg.values = list(phg.values)
+        phg.values.extend(tail_values)
+        ret = QueryResultRowList()
 
-        # 查询结果
-        cursor = await self.execute_sql(q.get_sql(), phg)
+        async def count():
+            cursor = await self.execute_sql(count_sql, count_phg)
+            return next(iter(cursor))[0]
 
-        for i in cursor:
-            it = iter(i)
-            ret.append(QueryResultRow(next(it), list(it), info, info.from_table))
+        # count
+        if count_strategy == COUNT_STRATEGY.CONCURRENT:
+            ret.rows_count, cursor = await asyncio.gather(count(), self.execute_sql(sql, phg))
+        else:
+            if count_strategy == COUNT_STRATEGY.ESTIMATED:
+                ret.rows_count = await self._estimate_count(query, count_sql, count_phg)
+                ret.rows_count_estimated = ret.rows_count is not None
+
+            if count_strategy == COUNT_STRATEGY.SEPARATE or \
+                    (count_strategy == COUNT_STRATEGY.ESTIMATED and ret.rows_count is None):
+                ret.rows_count = await count()
+
+            # 查询结果
+            cursor = await self.execute_sql(sql, phg)
+
+        if count_strategy == COUNT_STRATEGY.WINDOW:
+            cursor = [tuple(x) for x in cursor]
+            if cursor:
+                ret.rows_count = cursor[0][-1]
+                cursor = [x[:-1] for x in cursor]
+            else:
+                # 页面为空时得不到计数
+                ret.rows_count = await count() if query.offset else 0
+
+        if not keyset:
+            for i in cursor:
+                it = iter(i)
+                ret.append(QueryResultRow(next(it), list(it), info, info.from_table))
+        else:
+            # 末尾为 keyset 排序列
+            n = len(info.select_for_crud)
+            raw_data = []
+            for i in cursor:
+                it = iter(i)
+                id_ = next(it)
+                raw_data = list(it)
+                ret.append(QueryResultRow(id_, raw_data[:n], info, info.from_table))
+
+            if info.limit != -1 and len(ret) == info.limit:
+                ret.next_cursor = info.make_cursor(raw_data[n:])
+
+        self._load_json_columns(info, ret)
+
+        if self.counter_buffer and self.counter_buffer.merge_reads:
+            self.counter_buffer.merge_rows(self, info, ret)
 
         for i in when_complete:
             await i(ret)
 
         return ret
 
+    async def get_list_iter(self, info: QueryInfo, batch_size=1000, *, _perm=None) -> AsyncIterator[QueryResultRow]:
+        # hook
+        await info.from_table.on_query(info, _perm)
+        when_complete = []
+        await info.from_table.on_read(info, when_complete, _perm)
+
+        query = self._optimize_query(info)
+        if query is None:
+            return
+        if query is info:
+            query = info.clone()
+        query.limit = -1
+        query.offset = 0
+
+        phg = self.get_placeholder_generator()
+        _, sql, tail_values = self._compile_select(query, None, phg)
+        phg.values.extend(tail_values)
+
+        async for rows in self.execute_sql_iter(sql, phg, batch_size):
+            ret = QueryResultRowList()
+            for i in rows:
+                it = iter(i)
+                ret.append(QueryResultRow(next(it), list(it), info, info.from_table))
+
+            self._load_json_columns(info, ret)
+
+            for i in when_complete:
+                await i(ret)
+
+            for i in ret:
+                yield i
+
+    def _load_json_columns(self, info: QueryInfo, rows: List[QueryResultRow]):
+        if self.json_loads_func is None or not rows:
+            return
+
+        json_fields = self._table_cache[info.from_table]['json_fields']
+        columns = [n for n, x in enumerate(info.select_for_crud) if x.table == info.from_table and x.name in json_fields]
+        for row in rows:
+            for n in columns:
+                if isinstance(row.raw_data[n], str):
+                    row.raw_data[n] = self.json_loads_func(row.raw_data[n])
+
+    def get_dialect(self) -> Optional[SQLDialect]:
+        """
+        数据库的方言，决定各处 SQL 的写法。各后端覆盖此方法；
+        返回 None 时只使用通用的 SQL：逐行插入并以 lastrowid 取得 id，不使用 RETURNING 与各数据库特有的写法
+        """
+        return None
+
     @abstractmethod
     def get_placeholder_generator(self) -> PlaceHolderGenerator:
         pass
@@ -393,3 +1603,33 @@ class SQLCrud(BaseCrud):
     @abstractmethod
     async def execute_sql(self, sql, phg: PlaceHolderGenerator):
         pass
+
+    async def execute_sql_iter(self, sql: str, phg: PlaceHolderGenerator, batch_size: int) -> AsyncIterator[List]:
+        """
+        分批返回查询结果，后端应以服务端游标实现。
+        默认实现对 execute_sql 的结果调用 fetchmany（如 sqlite 游标是逐步读取的），没有 fetchmany 时一次读出后分批
+        """
+        cursor = await self.execute_sql(sql, phg)
+        fetchmany = getattr(cursor, 'fetchmany', None)
+
+        if fetchmany is None:
+            rows = list(cursor)
+            for n in range(0, len(rows), batch_size):
+                yield rows[n:n + batch_size]
+            return
+
+        while True:
+            rows = fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+    async def execute_many(self, sql: str, values_lst: List[Sequence]):
+        """
+        以多组参数重复执行同一条语句，后端应以驱动的 executemany 实现。
+        默认实现为逐条执行
+        """
+        for i in values_lst:
+            phg = self.get_placeholder_generator()
+            phg.values = list(i)
+            await self.execute_sql(sql, phg)
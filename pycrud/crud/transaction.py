@@ -0,0 +1,50 @@
+import asyncio
+from contextvars import ContextVar
+from typing import Optional, List, Callable, Awaitable, Any, Dict
+
+# 当前上下文中各个 crud（以 id 区分）正在进行的事务
+_transactions: ContextVar[Dict[int, 'Transaction']] = ContextVar('pycrud_transactions', default={})
+
+
+class Transaction:
+    """
+    crud.transaction() 的作用域。
+    conn 为后端的连接或事务对象，嵌套的作用域以保存点实现，与外层共用 conn 与 lock；
+    state 为每一层各自的数据（如 MemoryCrud 的快照）
+    """
+
+    def __init__(self, parent: Optional['Transaction'] = None):
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent else 0
+        self.conn: Any = parent.conn if parent else None
+        self.state: Any = None
+        # 事务中的语句依次在同一个连接上执行，并发的子任务（如外键查询）也不例外
+        self.lock = parent.lock if parent else asyncio.Lock()
+        # 最外层提交之后执行，回滚时丢弃
+        self.after_commit: List[Callable[[], Awaitable]] = []
+        # 本层（或包含本层的外层）回滚之后执行
+        self.after_rollback: List[Callable[[], Awaitable]] = []
+
+    @property
+    def savepoint(self) -> str:
+        return 'pycrud_sp_%d' % self.depth
+
+
+def get_transaction(key: int) -> Optional[Transaction]:
+    return _transactions.get().get(key)
+
+
+def set_transaction(key: int, tx: Optional[Transaction]):
+    """
+    返回的 token 用于 reset_transaction
+    """
+    value = dict(_transactions.get())
+    if tx is None:
+        value.pop(key, None)
+    else:
+        value[key] = tx
+    return _transactions.set(value)
+
+
+def reset_transaction(token):
+    _transactions.reset(token)
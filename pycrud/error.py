@@ -41,3 +41,7 @@ class InvalidOrderSyntax(PyCrudException):
 
 class UnsupportedQueryOperator(PyCrudException):
     pass
+
+
+class InvalidCursor(PyCrudException):
+    pass
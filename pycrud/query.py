@@ -1,14 +1,19 @@
+import base64
+import binascii
 import dataclasses
+import datetime
+import hashlib
 import json
 from dataclasses import dataclass, field
-from typing import List, Union, Set, Dict, Any, Type, Mapping
+from typing import List, Union, Set, Dict, Any, Type, Mapping, Tuple, Optional
 
 from typing_extensions import Literal
 
 from pycrud.const import QUERY_OP_COMPARE, QUERY_OP_RELATION, QUERY_OP_FROM_TXT
 from pycrud.error import UnknownQueryOperator, InvalidQueryConditionValue, InvalidQueryConditionColumn, \
-    InvalidOrderSyntax, InvalidQueryConditionOperator
+    InvalidOrderSyntax, InvalidQueryConditionOperator, InvalidCursor, InvalidQueryValue
 from pycrud.types import RecordMapping, RecordMappingField
+from pycrud.utils.json_ex import json_dumps_ex
 
 
 class LogicRelation:
@@ -78,19 +83,23 @@ class QueryField:
 class QueryOrder:
     column: RecordMappingField
     order: Union[Literal['asc', 'desc', 'default']] = 'default'
+    # 按 column 上 match 条件的相关度排序，default 与 desc 均为相关度高的在前
+    rank: bool = False
 
     def __eq__(self, other):
         if isinstance(other, QueryOrder):
-            return self.column == other.column and self.order == other.order
+            return self.column == other.column and self.order == other.order and self.rank == other.rank
         return False
 
     def __repr__(self):
+        if self.rank:
+            return '<QueryOrder %r.rank.%s>' % (self.column, self.order)
         return '<QueryOrder %r.%s>' % (self.column, self.order)
 
     @classmethod
     def from_text(cls, table: Type[RecordMapping], text):
         """
-        :param text: order=id.desc, xxx.asc
+        :param text: order=id.desc, xxx.asc, title.rank.desc
         :return: [
             [<column>, asc|desc|default],
             [<column2>, asc|desc|default],
@@ -98,7 +107,10 @@ class QueryOrder:
         """
         orders = []
         for i in map(str.strip, text.split(',')):
-            items = i.split('.', 2)
+            items = i.split('.')
+            rank = len(items) > 1 and items[1].lower() == 'rank'
+            if rank:
+                del items[1]
 
             if len(items) == 1:
                 column_name, order = items[0], 'default'
@@ -115,9 +127,13 @@ class QueryOrder:
             if order not in ('asc', 'desc', 'default'):
                 raise InvalidOrderSyntax('Invalid order mode: %s' % order)
 
-            orders.append(cls(column, order))
+            orders.append(cls(column, order, rank))
         return orders
 
+    @property
+    def shape(self) -> str:
+        return '%r.%s%s' % (self.column, self.order, '.rank' if self.rank else '')
+
 
 @dataclass
 class UnaryExpr:
@@ -231,12 +247,111 @@ def check_same_expr(a: AllExprType, b: AllExprType) -> bool:
     return a == b
 
 
+_freeze_types = (list, tuple, set, frozenset, dict)
+
+
+def _freeze(value):
+    """
+    转换为可哈希的值
+    """
+    if not isinstance(value, _freeze_types):
+        return value
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(x) for x in value)
+    if isinstance(value, dict):
+        return _sorted_tuple((k, _freeze(v)) for k, v in value.items())
+    return _sorted_tuple(_freeze(x) for x in value)
+
+
+def _sorted_tuple(values, key=None) -> tuple:
+    values = list(values)
+    try:
+        return tuple(sorted(values, key=key))
+    except TypeError:
+        # 不同类型的值之间不能比较，按类型名与 repr 排序
+        return tuple(sorted(values, key=lambda x: (type(x).__name__, repr(x))))
+
+
+def _flatten_logic(c, logic_type: str, out: list):
+    for i in c.items:
+        if isinstance(i, (QueryConditions, ConditionLogicExpr)) and i.type == logic_type:
+            _flatten_logic(i, logic_type, out)
+        else:
+            out.append(condition_fingerprint(i))
+
+
+def condition_fingerprint(c: AllExprType) -> Tuple[str, tuple]:
+    """
+    规范化的条件树，返回 (结构, 参数值)：
+    and/or 的子项排序（同类嵌套展开），IN 列表排序去重，结构中不含参数值
+    """
+    if isinstance(c, ConditionExpr):
+        column = c.column
+        shape = '%s.%s.%s' % (column.table.table_name, column.name, c.op.value[0])
+        value = c.value
+
+        if isinstance(value, RecordMappingField):
+            return '%s=%s.%s' % (shape, value.table.table_name, value.name), ()
+
+        if isinstance(value, _freeze_types):
+            if c.op in (QUERY_OP_RELATION.IN, QUERY_OP_RELATION.NOT_IN) and isinstance(value, (list, set, tuple)):
+                value = _sorted_tuple({_freeze(x) for x in value})
+            else:
+                value = _freeze(value)
+        return shape, (value,)
+
+    elif isinstance(c, (QueryConditions, ConditionLogicExpr)):
+        items = []
+        _flatten_logic(c, c.type, items)
+        if len(items) > 1:
+            items = _sorted_tuple(items)
+        return '%s(%s)' % (c.type, ','.join([x[0] for x in items])), tuple([v for x in items for v in x[1]])
+
+    elif isinstance(c, NegatedExpr):
+        shape, values = condition_fingerprint(c.expr)
+        return 'not(%s)' % shape, values
+
+    return repr(c), ()
+
+
+@dataclass(frozen=True)
+class QueryFingerprint:
+    # 查询结构的摘要，参数值不同的同构查询结构相同
+    shape: str
+    values: tuple
+
+    @property
+    def digest(self) -> str:
+        """
+        结构与参数值一起的摘要，用作缓存的键
+        """
+        text = '%s:%r' % (self.shape, self.values)
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def parse_foreign_key_name(name: str) -> Tuple[str, int]:
+    """
+    解析外键名，返回 (表名, 每个上级取的数量)
+    topic -> 1, topic[] -> -1（不限）, topic[3] -> 3
+    """
+    if name.endswith(']') and '[' in name:
+        table_name, num = name[:-1].split('[', 1)
+        if not num:
+            return table_name, -1
+        if not num.isdigit() or int(num) <= 0:
+            raise InvalidQueryValue('invalid foreign key: %s' % name)
+        return table_name, int(num)
+    return name, 1
+
+
 @dataclass
 class QueryJoinInfo:
     table: Type[RecordMapping]
     conditions: QueryConditions
     type: Union[Literal['inner', 'left']] = 'left'
     limit: int = -1  # unlimited
+    # limit 不为 -1 时，每个上级按此排序取前 limit 条，默认按 id 升序
+    order_by: List[QueryOrder] = None
 
 
 @dataclass
@@ -315,6 +430,9 @@ class QueryInfo:
     join: List[QueryJoinInfo] = None
     select_hidden: Set[Union[RecordMappingField, Any]] = field(default_factory=lambda: set())
 
+    # keyset 分页，空字符串代表第一页，None 为不使用
+    cursor: str = None
+
     def __post_init__(self):
         self._select = None
 
@@ -326,6 +444,159 @@ class QueryInfo:
         #     d['conditions'] = QueryConditions(**d['conditions'])
         # return QueryInfo(d)
 
+    def _fingerprint_parts(self) -> Tuple[str, tuple]:
+        shape = [self.from_table.table_name, ','.join(map(repr, self.select_for_crud))]
+        values = []
+
+        if self.conditions:
+            a, b = condition_fingerprint(self.conditions)
+            shape.append(a)
+            values.extend(b)
+
+        shape.append(','.join(x.shape for x in self.order_by))
+
+        for ji in self.join or []:
+            a, b = condition_fingerprint(ji.conditions)
+            shape.append('join:%s.%s(%s)%s[%s]' % (ji.table.table_name, ji.type, a, ji.limit,
+                                                ','.join(x.shape for x in ji.order_by or [])))
+            values.extend(b)
+
+        for k in sorted(self.foreign_keys or {}):
+            a, b = self.foreign_keys[k]._fingerprint_parts()
+            shape.append('fk:%s{%s}' % (k, a))
+            values.extend(b)
+
+        # 分页参数作为参数值，只在结构中记录是否存在
+        shape.append('limit' if self.limit != -1 else '')
+        shape.append('offset' if self.offset else '')
+        shape.append('cursor' if self.cursor is not None else '')
+        values.extend(x for x in (self.limit if self.limit != -1 else None, self.offset or None, self.cursor)
+                      if x is not None)
+
+        return '|'.join(shape), tuple(values)
+
+    def fingerprint(self) -> 'QueryFingerprint':
+        """
+        规范化后的查询指纹，条件的书写顺序、IN 列表的顺序与重复项不影响结果。
+        shape 只取决于查询的结构，values 为按规范顺序排列的参数值
+        """
+        shape, values = self._fingerprint_parts()
+        return QueryFingerprint(hashlib.blake2b(shape.encode('utf-8'), digest_size=16).hexdigest(), values)
+
+    def get_match_condition(self, column: RecordMappingField) -> Optional['ConditionExpr']:
+        """
+        顶层（以 AND 连接的）条件中 column 上的 match 条件，用于按相关度排序
+        """
+        def find(c):
+            if isinstance(c, ConditionExpr):
+                if c.op == QUERY_OP_RELATION.MATCH and (c.column.table, c.column.name) == (column.table, column.name):
+                    return c
+            elif isinstance(c, QueryConditions) or (isinstance(c, ConditionLogicExpr) and c.type == 'and'):
+                for i in c.items:
+                    ret = find(i)
+                    if ret is not None:
+                        return ret
+
+        return find(self.conditions) if self.conditions else None
+
+    def get_keyset_orders(self) -> List[QueryOrder]:
+        """
+        keyset 分页使用的排序，末尾追加 id 保证顺序唯一。
+        可为 NULL 的列不能用于排序：与 NULL 的比较不成立，且各数据库中 NULL 的排序位置不同，会遗漏行
+        """
+        orders = list(self.order_by)
+        if any(x.rank for x in orders):
+            raise InvalidCursor('cursor is not supported when ordering by rank')
+        for o in orders:
+            model_field = o.column.table.__fields__.get(o.column.name)
+            if o.column.name != 'id' and model_field is not None and model_field.allow_none:
+                raise InvalidCursor('cursor is not supported when ordering by nullable column: %s' % o.column.name)
+        if not any(x.column.name == 'id' for x in orders):
+            last = orders[-1].order if orders else 'asc'
+            orders.append(QueryOrder(self.from_table.id, 'desc' if last == 'desc' else 'asc'))
+        return orders
+
+    def make_cursor(self, values: List[Any]) -> str:
+        """
+        :param values: 最后一行在 get_keyset_orders() 各列上的值
+        """
+        def convert(val):
+            if isinstance(val, (datetime.datetime, datetime.date, datetime.time)):
+                return val.isoformat()
+            return val
+
+        text = json_dumps_ex([convert(x) for x in values], separators=(',', ':'))
+        return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii').rstrip('=')
+
+    def parse_cursor(self) -> List[Any]:
+        orders = self.get_keyset_orders()
+
+        try:
+            text = base64.urlsafe_b64decode(self.cursor + '=' * (-len(self.cursor) % 4))
+            values = json.loads(text)
+        except (binascii.Error, ValueError):
+            raise InvalidCursor('invalid cursor: %s' % self.cursor)
+
+        if not isinstance(values, List) or len(values) != len(orders):
+            raise InvalidCursor('cursor does not match the order: %s' % self.cursor)
+
+        ret = []
+        for o, val in zip(orders, values):
+            model_field = o.column.table.__fields__.get(o.column.name)
+            val, err = model_field.validate(val, None, loc=o.column.name)
+            if err:
+                raise InvalidCursor('invalid cursor value: %r' % val)
+            ret.append(val)
+
+        return ret
+
+    def get_keyset_conditions(self) -> Union['ConditionLogicExpr', 'ConditionExpr', None]:
+        """
+        由 cursor 生成的定位条件：
+        (a > 1) or (a == 1 and id > 2)，并附加 a >= 1 以便利用索引
+        """
+        if not self.cursor:
+            return None
+
+        orders = self.get_keyset_orders()
+        values = self.parse_cursor()
+        items = []
+
+        for i, o in enumerate(orders):
+            and_items = [ConditionExpr(orders[j].column, QUERY_OP_COMPARE.EQ, values[j]) for j in range(i)]
+            op = QUERY_OP_COMPARE.LT if o.order == 'desc' else QUERY_OP_COMPARE.GT
+            and_items.append(ConditionExpr(o.column, op, values[i]))
+            items.append(ConditionLogicExpr('and', and_items) if len(and_items) > 1 else and_items[0])
+
+        if len(items) == 1:
+            return items[0]
+
+        op = QUERY_OP_COMPARE.LE if orders[0].order == 'desc' else QUERY_OP_COMPARE.GE
+        return ConditionLogicExpr('and', [
+            ConditionExpr(orders[0].column, op, values[0]),
+            ConditionLogicExpr('or', items)
+        ])
+
+    def to_keyset_query(self) -> 'QueryInfo':
+        """
+        转换为 keyset 分页的实际查询：附加定位条件和排序，并在选择项末尾追加排序列，用于生成下一页的 cursor
+        """
+        orders = self.get_keyset_orders()
+        conditions = list(self.conditions.items) if self.conditions else []
+
+        cond = self.get_keyset_conditions()
+        if cond:
+            conditions.append(cond)
+
+        return dataclasses.replace(
+            self,
+            select=[*self.select_for_crud, *[x.column for x in orders]],
+            select_exclude=None,
+            conditions=QueryConditions(conditions),
+            order_by=orders,
+            offset=0
+        )
+
     @property
     def select_for_crud(self):
         if self._select is None:
@@ -487,13 +758,15 @@ class QueryInfo:
             if key.startswith('$'):
                 if key == '$order-by':
                     q.order_by = QueryOrder.from_text(table, value)
+                elif key == '$cursor' or key == '$after':
+                    q.cursor = value or ''
                 elif key == '$fks' or key == '$foreign-keys':
                     value = http_value_try_parse(value)
                     assert isinstance(value, Mapping)
                     q.foreign_keys = {}
 
                     for k, v in value.items():
-                        k2 = k[:-2] if k.endswith('[]') else k
+                        k2, _ = parse_foreign_key_name(k)
                         t = table.all_mappings.get(k2)
 
                         if t:
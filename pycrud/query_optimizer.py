@@ -0,0 +1,231 @@
+from typing import Optional, List, Union, Dict, Tuple, Any
+
+from pycrud.const import QUERY_OP_COMPARE, QUERY_OP_RELATION
+from pycrud.query import QueryConditions, ConditionLogicExpr, ConditionExpr, NegatedExpr, AllExprType, \
+    condition_fingerprint
+from pycrud.types import RecordMappingField
+
+# 永远不成立的条件
+ALWAYS_FALSE = object()
+
+_compare_funcs = {
+    QUERY_OP_COMPARE.NE: lambda a, b: a != b,
+    QUERY_OP_COMPARE.LT: lambda a, b: a < b,
+    QUERY_OP_COMPARE.LE: lambda a, b: a <= b,
+    QUERY_OP_COMPARE.GE: lambda a, b: a >= b,
+    QUERY_OP_COMPARE.GT: lambda a, b: a > b,
+    QUERY_OP_RELATION.NOT_IN: lambda a, b: a not in b,
+}
+
+
+def _is_list(value) -> bool:
+    return isinstance(value, (list, set, tuple))
+
+
+def _literal_values(c) -> Optional[List]:
+    """
+    等值条件（eq / in）允许的取值，其他条件返回 None
+    """
+    if not isinstance(c, ConditionExpr) or isinstance(c.value, RecordMappingField):
+        return None
+    if c.op == QUERY_OP_COMPARE.EQ and c.value is not None:
+        return [c.value]
+    if c.op == QUERY_OP_RELATION.IN and _is_list(c.value) and None not in c.value:
+        return list(c.value)
+
+
+def _unique(values: List) -> List:
+    ret = []
+    for i in values:
+        if i not in ret:
+            ret.append(i)
+    return ret
+
+
+def _make_in(column: RecordMappingField, values: List) -> ConditionExpr:
+    if len(values) == 1:
+        return ConditionExpr(column, QUERY_OP_COMPARE.EQ, values[0])
+    return ConditionExpr(column, QUERY_OP_RELATION.IN, values)
+
+
+def _dedupe(items: List) -> List:
+    ret, seen = [], set()
+    for i in items:
+        try:
+            key = condition_fingerprint(i)
+            if key in seen:
+                continue
+            seen.add(key)
+        except TypeError:
+            # 值不可哈希
+            pass
+        ret.append(i)
+    return ret
+
+
+def _merge_or(items: List) -> List:
+    """
+    a == 1 OR a == 2 OR a IN (3, 4)  ->  a IN (1, 2, 3, 4)
+    """
+    groups: Dict[Tuple[Any, str], List[int]] = {}
+    for index, i in enumerate(items):
+        if _literal_values(i) is not None:
+            groups.setdefault((i.column.table, i.column.name), []).append(index)
+
+    merged = {}
+    for indexes in groups.values():
+        if len(indexes) > 1:
+            values = _unique([v for x in indexes for v in _literal_values(items[x])])
+            merged[indexes[0]] = _make_in(items[indexes[0]].column, values)
+            for x in indexes[1:]:
+                merged[x] = None
+
+    if not merged:
+        return items
+    return [merged.get(index, i) for index, i in enumerate(items) if merged.get(index, i) is not None]
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float))
+
+
+def _allowed_values(conds: List[ConditionExpr]) -> Optional[List]:
+    """
+    同一列上的一组 AND 条件允许的取值，没有等值条件或无法判断时返回 None。
+    只对数值做推断：字符串的相等与大小取决于数据库的排序规则（如 NOCASE），类型不同的值则取决于数据库的类型转换
+    """
+    lst = [_literal_values(x) for x in conds]
+    if all(x is None for x in lst):
+        return None
+
+    for c, values in zip(conds, lst):
+        items = values if values is not None else (list(c.value) if _is_list(c.value) else [c.value])
+        if not all(_is_number(x) or x is None for x in items):
+            return None
+
+    allowed = None
+    for c, values in zip(conds, lst):
+        if values is not None:
+            allowed = _unique(values) if allowed is None else [x for x in allowed if x in values]
+        elif c.op in (QUERY_OP_COMPARE.EQ, QUERY_OP_RELATION.IN):
+            # = NULL 或含 NULL 的 IN
+            return None
+
+    for c, values in zip(conds, lst):
+        if values is not None:
+            continue
+        if c.value is None or (c.op == QUERY_OP_RELATION.NOT_IN and not _is_list(c.value)):
+            return None
+        try:
+            allowed = [x for x in allowed if _compare_funcs[c.op](x, c.value)]
+        except TypeError:
+            return None
+
+    return allowed
+
+
+def _merge_and(items: List, negated: bool) -> Union[List, object]:
+    """
+    合并同一列上的等值条件与比较条件：a IN (1, 2, 3) AND a != 2  ->  a IN (1, 3)，
+    没有取值能满足时返回 ALWAYS_FALSE
+    """
+    groups: Dict[Tuple[Any, str], List[int]] = {}
+    for index, i in enumerate(items):
+        if isinstance(i, ConditionExpr) and not isinstance(i.value, RecordMappingField) and \
+                (i.op in _compare_funcs or i.op in (QUERY_OP_COMPARE.EQ, QUERY_OP_RELATION.IN)):
+            groups.setdefault((i.column.table, i.column.name), []).append(index)
+
+    merged = {}
+    for indexes in groups.values():
+        if len(indexes) < 2:
+            continue
+
+        conds = [items[x] for x in indexes]
+        allowed = _allowed_values(conds)
+        if allowed is None:
+            continue
+
+        if not allowed:
+            # 在 NOT 之下，NULL 与 FALSE 取反后结果不同，不能化简为 FALSE
+            if negated:
+                continue
+            return ALWAYS_FALSE
+
+        merged[indexes[0]] = _make_in(conds[0].column, allowed)
+        for x in indexes[1:]:
+            merged[x] = None
+
+    if not merged:
+        return items
+    return [merged.get(index, i) for index, i in enumerate(items) if merged.get(index, i) is not None]
+
+
+def _optimize(c, negated: bool):
+    """
+    返回化简后的条件，None 为不做限制，ALWAYS_FALSE 为永远不成立
+    """
+    if isinstance(c, NegatedExpr):
+        expr = _optimize(c.expr, True)
+        if expr is None:
+            return None
+        if isinstance(expr, NegatedExpr):
+            return expr.expr
+        return NegatedExpr(expr)
+
+    elif isinstance(c, ConditionExpr):
+        if c.op == QUERY_OP_RELATION.IN and _is_list(c.value) and not c.value and not negated:
+            return ALWAYS_FALSE
+        return c
+
+    elif isinstance(c, (QueryConditions, ConditionLogicExpr)):
+        items = []
+        has_false = False
+
+        for i in c.items:
+            r = _optimize(i, negated)
+            if r is None:
+                # 空分支（如权限过滤后留下的）视为没有写出
+                continue
+            if r is ALWAYS_FALSE:
+                if c.type == 'and':
+                    return ALWAYS_FALSE
+                has_false = True
+                continue
+
+            if isinstance(r, (QueryConditions, ConditionLogicExpr)) and r.type == c.type:
+                items.extend(r.items)
+            else:
+                items.append(r)
+
+        items = _dedupe(items)
+
+        if c.type == 'and':
+            items = _merge_and(items, negated)
+            if items is ALWAYS_FALSE:
+                return ALWAYS_FALSE
+        else:
+            items = _merge_or(items)
+
+        if not items:
+            return ALWAYS_FALSE if has_false else None
+        if len(items) == 1:
+            return items[0]
+        return ConditionLogicExpr(c.type, items)
+
+    return c
+
+
+def optimize_conditions(conditions: AllExprType) -> Optional[QueryConditions]:
+    """
+    化简条件树：展开同类嵌套、去掉空分支与重复条件、将等值的 OR 合并为 IN、合并同一列上的 AND 条件。
+    不修改传入的条件，条件不可能成立时返回 None
+    """
+    r = _optimize(conditions, False)
+
+    if r is ALWAYS_FALSE:
+        return None
+    if r is None:
+        return QueryConditions([])
+    if isinstance(r, ConditionLogicExpr) and r.type == 'and':
+        return QueryConditions(r.items)
+    return QueryConditions([r])
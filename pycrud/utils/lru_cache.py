@@ -0,0 +1,66 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class LRUCache:
+    """
+    带容量上限的 LRU 缓存，记录命中与未命中次数。
+    设置 ttl（秒）时，写入超过 ttl 的条目视为不存在
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._expire_at = {}
+
+    def _is_expired(self, key: Hashable) -> bool:
+        return self.ttl is not None and self._expire_at[key] <= time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if self._is_expired(key):
+            self.delete(key)
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if self.ttl is not None:
+            self._expire_at[key] = time.monotonic() + self.ttl
+
+        while len(self._data) > self.maxsize:
+            k, _ = self._data.popitem(last=False)
+            self._expire_at.pop(k, None)
+
+    def delete(self, key: Hashable):
+        self._data.pop(key, None)
+        self._expire_at.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+        self._expire_at.clear()
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __contains__(self, key: Hashable):
+        return key in self._data and not self._is_expired(key)
+
+    def __len__(self):
+        return len(self._data)
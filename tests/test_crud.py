@@ -1,13 +1,23 @@
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 import peewee
 import pytest
 
-from pycrud.const import QUERY_OP_COMPARE, QUERY_OP_RELATION
+from pycrud.const import QUERY_OP_COMPARE, QUERY_OP_RELATION, COUNT_STRATEGY
+from pycrud.crud.base_crud import BaseCrud
+from pycrud.crud.counter_buffer import CounterBuffer
 from pycrud.crud.ext.peewee_crud import PeeweeCrud
+from pycrud.crud.insert_coalescer import InsertCoalescer
 from pycrud.crud.query_result_row import QueryResultRow
+from pycrud.crud.sql_crud import SQLCrud, SQLDialect, SQLExecuteResult, PlaceHolderGenerator
+from pycrud.error import InvalidCursor, InvalidQueryValue, DBException, UnsupportedQueryOperator, InvalidOrderSyntax
 from pycrud.query import QueryInfo, QueryConditions, ConditionExpr
 from pycrud.types import RecordMapping
+from pycrud.utils.lru_cache import LRUCache
 from pycrud.values import ValuesToWrite
 
 pytestmark = [pytest.mark.asyncio]
@@ -28,12 +38,12 @@ class Topic(RecordMapping):
     time: int
 
 
-def crud_db_init():
+def crud_db_init(url="sqlite:///:memory:"):
     from playhouse.db_url import connect
 
     # 创建数据库
     # db = connect("sqlite:///database.db")
-    db = connect("sqlite:///:memory:")
+    db = connect(url)
 
     class Users(peewee.Model):
         username = peewee.TextField(index=True)
@@ -85,6 +95,45 @@ def crud_db_init():
     return db, Users, Topics, Topics2
 
 
+class RecordingCrud(PeeweeCrud):
+    """
+    记录执行的语句：sql_lst/values_lst 为 execute_sql 的 SQL 与参数，many_lst 为 execute_many 的 (SQL, 参数列表)。
+    设置 dialect 后按该方言编译，语句不再执行，execute_sql 的结果由 fake_rows(sql) 给出
+    """
+
+    def __post_init__(self):
+        super().__post_init__()
+        self.sql_lst = []
+        self.values_lst = []
+        self.many_lst = []
+        self.dialect = None
+        self.fake_rows = lambda sql: []
+
+    @property
+    def last_sql(self):
+        return self.sql_lst[-1]
+
+    @property
+    def last_values(self):
+        return self.values_lst[-1]
+
+    def get_dialect(self):
+        return self.dialect or super().get_dialect()
+
+    async def execute_sql(self, sql: str, phg):
+        self.sql_lst.append(sql)
+        self.values_lst.append(phg.values)
+        if self.dialect is not None:
+            return SQLExecuteResult(None, self.fake_rows(sql))
+        return await super().execute_sql(sql, phg)
+
+    async def execute_many(self, sql: str, values_lst):
+        self.many_lst.append((sql, values_lst))
+        if self.dialect is not None:
+            return
+        return await super().execute_many(sql, values_lst)
+
+
 async def test_crud_simple():
     db, MUsers, MTopics, MTopics2 = crud_db_init()
 
@@ -133,6 +182,33 @@ async def test_crud_simple():
     assert len(d['$extra']['topic[]']) == 2
 
 
+async def test_crud_generic_dialect():
+    # 第三方后端只实现必需的方法，没有 get_dialect
+    class GenericCrud(SQLCrud):
+        def get_placeholder_generator(self):
+            return PlaceHolderGenerator('?', self.json_dumps_func)
+
+        async def execute_sql(self, sql: str, phg):
+            cursor = conn.execute(sql, phg.values)
+            return SQLExecuteResult(cursor.lastrowid, cursor.fetchall() if cursor.description else None)
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, nickname TEXT, username TEXT, password TEXT)')
+    c = GenericCrud(None, {User: 'users'})
+    assert c.get_dialect() is None
+
+    ids = await c.insert_many(User, [ValuesToWrite({'nickname': 'n%d' % i, 'username': 'u%d' % i}, User).bind()
+                                     for i in range(3)])
+    assert ids == [1, 2, 3]
+    ret = await c.get_list(QueryInfo.from_json(User, {'id.in': [1, 3]}), with_count=True)
+    assert [x.id for x in ret] == [1, 3] and ret.rows_count == 2
+    assert await c.update(QueryInfo.from_json(User, {'id.eq': 2}), ValuesToWrite({'nickname': 'x'}, User).bind()) == [2]
+    assert await c.delete(QueryInfo.from_json(User, {'id.ge': 2})) == [2, 3]
+
+    with pytest.raises(UnsupportedQueryOperator):
+        await c.create_fts_index(User, [User.nickname])
+
+
 async def test_crud_read_2():
     db, MUsers, MTopics, MTopics2 = crud_db_init()
 
@@ -183,6 +259,36 @@ async def test_crud_read_by_prefix():
     assert ret[0].to_dict()['username'] == 'test4'
 
 
+async def test_crud_read_by_prefix_range():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+    MUsers.create(username='a_b', nickname='Ab', password='pass')
+    MUsers.create(username='axb', nickname='ab', password='pass')
+
+    c = RecordingCrud(None, {User: MUsers}, db)
+    assert c._table_cache[User]['index_fields'] == {'id', 'username'}
+
+    async def query(data):
+        return [x.id for x in await c.get_list(QueryInfo.from_json(User, data))]
+
+    # 通配符按字面匹配
+    assert await query({'username.prefix': 'a_'}) == [6]
+    assert await query({'username.prefix': 'te%'}) == []
+    assert c.last_sql.endswith('WHERE "username" LIKE ? ESCAPE \'!\' LIMIT 20')
+
+    c.prefix_as_range = True
+    assert await query({'username.prefix': 'test'}) == [1, 2, 3, 4, 5]
+    assert await query({'username.prefix': 'a_'}) == [6]
+    assert c.last_sql.endswith('WHERE "username">=? AND "username"<? LIMIT 20')
+
+    # 没有索引的列
+    assert await query({'nickname.iprefix': 'AB'}) == [6, 7]
+    assert c.last_sql.endswith('WHERE LOWER("nickname") LIKE ? ESCAPE \'!\' LIMIT 20')
+
+    c.add_index(User.nickname, lower=True)
+    assert await query({'nickname.iprefix': 'AB'}) == [6, 7]
+    assert c.last_sql.endswith('WHERE LOWER("nickname")>=? AND LOWER("nickname")<? LIMIT 20')
+
+
 async def test_crud_read_with_count():
     db, MUsers, MTopics, MTopics2 = crud_db_init()
 
@@ -274,3 +380,999 @@ async def test_crud_delete_success():
 
     assert len(ret) == 1
     assert MTopics.select().where(MTopics.id == 1).count() == 0
+
+
+async def test_crud_insert_many_batch():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    c = RecordingCrud(None, {
+        Topic: MTopics,
+    }, db)
+    c.insert_batch_size = 2
+
+    values_lst = []
+    for i in range(5):
+        if i == 2:
+            v = ValuesToWrite({'content': 'c', 'title': 'batch%d' % i, 'user_id': 1, 'time': i}, Topic)
+        else:
+            v = ValuesToWrite({'title': 'batch%d' % i, 'user_id': 1, 'time': i, 'content': 'c'}, Topic)
+        values_lst.append(v)
+
+    ret = await c.insert_many(Topic, values_lst)
+    # 列顺序不同的行单独成组
+    assert ret == [5, 6, 9, 7, 8]
+    assert len(c.sql_lst) == 3
+    assert c.sql_lst[0].count('),(') == 1
+
+    for i, id_ in zip(values_lst, ret):
+        assert MTopics.get_by_id(id_).title == i['title']
+
+
+async def test_crud_insert_many_ids():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+    c = RecordingCrud(None, {Topic: MTopics}, db)
+
+    def values(*ids):
+        return [ValuesToWrite({'id': x, 'title': 'ids%d' % n, 'user_id': 1, 'time': n, 'content': 'c'}, Topic)
+                for n, x in enumerate(ids)]
+
+    def values_without_id(count):
+        return [ValuesToWrite({'title': 'ids%d' % n, 'user_id': 1, 'time': n, 'content': 'c'}, Topic)
+                for n in range(count)]
+
+    # 部分行未给出 id，逐行插入
+    assert await c.insert_many(Topic, values(10, None, 20)) == [10, 11, 20]
+    assert len(c.sql_lst) == 3 and not c.many_lst
+    assert MTopics.get_by_id(11).title == 'ids1'
+
+    c.sql_lst = []
+    ret = await c.insert_many(Topic, values_without_id(3))
+    assert ret == [21, 22, 23]
+    assert len(c.sql_lst) == 1
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        assert c.last_sql.endswith(' RETURNING "id"')
+
+    # mysql 交错分配自增 id 时逐行插入，变量只查询一次
+    c.dialect, c.sql_lst = SQLDialect.MYSQL, []
+    c.fake_rows = lambda sql: [(1, 2)] if sql.startswith('SELECT @@') else []
+    await c.insert_many(Topic, values_without_id(2))
+    await c.insert_many(Topic, values_without_id(2))
+    assert c.sql_lst[0].startswith('SELECT @@auto_increment_increment')
+    assert [x.startswith('INSERT') and x.count('),(') == 0 for x in c.sql_lst[1:]] == [True] * 4
+
+
+async def test_crud_execute_many():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    class SmallParamsCrud(RecordingCrud):
+        def get_max_bind_params(self) -> int:
+            return 3
+
+    c = SmallParamsCrud(None, {
+        Topic: MTopics,
+    }, db)
+
+    values_lst = [ValuesToWrite({'id': 10 + i, 'title': 'many%d' % i, 'user_id': 2, 'time': 1, 'content': 'c'}, Topic)
+                  for i in range(3)]
+    ret = await c.insert_many(Topic, values_lst)
+    assert ret == [10, 11, 12]
+    assert len(c.many_lst) == 1
+    assert MTopics.select().where(MTopics.user_id == 2).count() == 5
+
+    # 5 个 id，1 个 SET 参数，每块 2 个 id
+    info = QueryInfo.from_json(Topic, {'user_id.eq': 2})
+    ret = await c.update(info, ValuesToWrite({'content': 'updated'}, Topic).bind())
+    assert len(ret) == 5
+    assert c.many_lst[-1][0] == 'UPDATE "topic" SET "content"=? WHERE "id" IN (?, ?)'
+    assert c.many_lst[-1][1][-1] == ('updated', ret[-1], ret[-1])
+    assert MTopics.select().where(MTopics.content == 'updated').count() == 5
+
+    ret = await c.delete(QueryInfo.from_json(Topic, {'user_id.eq': 2}))
+    assert len(ret) == 5
+    assert MTopics.select().where(MTopics.user_id == 2).count() == 0
+
+
+async def test_crud_insert_coalescer():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    c = RecordingCrud(None, {Topic: MTopics}, db)
+    c.insert_coalescer = InsertCoalescer(window=0.01, max_rows=100)
+
+    def new_topic(i, **kwargs):
+        return ValuesToWrite({'title': 'co%d' % i, 'user_id': 1, 'time': i, 'content': 'c', **kwargs}, Topic)
+
+    lst = await asyncio.gather(*[c.insert_many(Topic, [new_topic(i)]) for i in range(10)])
+    # 十个调用合并为一条 INSERT，各自取回自己的 id
+    assert lst == [[5 + i] for i in range(10)]
+    assert len(c.sql_lst) == 1
+    assert (c.insert_coalescer.batches, c.insert_coalescer.rows) == (1, 10)
+    for i in range(10):
+        assert MTopics.get_by_id(5 + i).title == 'co%d' % i
+
+    # 整批失败时只有出错的调用者收到异常
+    c.sql_lst = []
+    lst = await asyncio.gather(*[c.insert_many(Topic, [new_topic(i, id=20 + i)]) for i in range(3)],
+                               c.insert_many(Topic, [new_topic(9, id=1)]),
+                               return_exceptions=True)
+    assert lst[:3] == [[20], [21], [22]]
+    assert isinstance(lst[3], DBException)
+    assert len(c.sql_lst) == 5
+    assert MTopics.select().where(MTopics.id >= 20).count() == 3
+    assert MTopics.get_by_id(1).title == 'test'
+
+    # 事务中不合并
+    c.sql_lst = []
+    async with c.transaction():
+        assert await c.insert_many(Topic, [new_topic(30)]) == [23]
+    assert c.insert_coalescer.batches == 2
+    assert len(c.sql_lst) == 1
+
+
+async def test_crud_counter_buffer():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    c = RecordingCrud(None, {Topic: MTopics}, db)
+    c.counter_buffer = CounterBuffer(interval=60, merge_reads=True)
+
+    for _ in range(3):
+        ret = await c.update(QueryInfo.from_json(Topic, {'id.le': 2}), ValuesToWrite({'time.incr': 2}, Topic).bind())
+        assert ret == [1, 2]
+    await c.update(QueryInfo.from_json(Topic, {'id.eq': 2}), ValuesToWrite({'time.decr': 1, 'user_id.incr': 5}, Topic).bind())
+
+    # 尚未写入数据库，读取时合并缓冲的增量
+    assert MTopics.get_by_id(1).time == 1
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'id.le': 3}))
+    assert [(x.to_dict()['time'], x.to_dict()['user_id']) for x in ret] == [(7, 1), (6, 6), (1, 2)]
+    assert c.counter_buffer.pending_keys == 2
+
+    await c.counter_buffer.flush()
+    assert c.many_lst == [('UPDATE "topic" SET "time"="time"+?,"user_id"="user_id"+? WHERE "id"=?',
+                           [[6, 0, 1], [5, 5, 2]])]
+    assert (MTopics.get_by_id(1).time, MTopics.get_by_id(2).time, MTopics.get_by_id(2).user_id) == (7, 6, 6)
+    assert c.counter_buffer.pending_keys == 0
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'id.le': 2}))
+    assert [x.to_dict()['time'] for x in ret] == [7, 6]
+
+    # 累积到 max_keys 时立即写入
+    c.counter_buffer.max_keys = 2
+    await c.update(QueryInfo.from_json(Topic, {'id.le': 2}), ValuesToWrite({'time.incr': 1}, Topic).bind())
+    await asyncio.sleep(0.01)
+    assert (MTopics.get_by_id(1).time, MTopics.get_by_id(2).time) == (8, 7)
+
+
+async def test_crud_counter_buffer_then_set():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+    c = PeeweeCrud(None, {Topic: MTopics}, db)
+    c.counter_buffer = CounterBuffer(interval=60)
+
+    # 普通的写入覆盖缓冲中的列之前，先写入这些列的增量
+    await c.update(QueryInfo.from_json(Topic, {'id.eq': 1}), ValuesToWrite({'time.incr': 2, 'user_id.incr': 1}, Topic).bind())
+    await c.update(QueryInfo.from_json(Topic, {'id.eq': 1}), ValuesToWrite({'time': 10}, Topic).bind())
+    assert c.counter_buffer.pending_keys == 1
+    await c.counter_buffer.flush()
+    assert (MTopics.get_by_id(1).time, MTopics.get_by_id(1).user_id) == (10, 2)
+
+    await c.update(QueryInfo.from_json(Topic, {'id.eq': 2}), ValuesToWrite({'time.incr': 2}, Topic).bind())
+    await c.bulk_update(Topic, [(2, ValuesToWrite({'time': 20}, Topic).bind())])
+    await c.update(QueryInfo.from_json(Topic, {'id.eq': 3}), ValuesToWrite({'time.incr': 2}, Topic).bind())
+    await c.upsert_many(Topic, [ValuesToWrite({'id': 3, 'time': 30, 'title': 't', 'user_id': 1, 'content': 'c'}, Topic)], ['id'])
+    await c.counter_buffer.flush()
+    assert (MTopics.get_by_id(2).time, MTopics.get_by_id(3).time) == (20, 30)
+
+    # 事务中写入的增量在回滚时放回缓冲
+    await c.update(QueryInfo.from_json(Topic, {'id.eq': 4}), ValuesToWrite({'time.incr': 2}, Topic).bind())
+    with pytest.raises(ValueError):
+        async with c.transaction():
+            await c.update(QueryInfo.from_json(Topic, {'id.eq': 4}), ValuesToWrite({'time': 40}, Topic).bind())
+            raise ValueError()
+    assert c.counter_buffer.pending_keys == 1
+    await c.counter_buffer.flush()
+    assert MTopics.get_by_id(4).time == 3
+
+
+async def test_crud_bulk_update():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    c = RecordingCrud(None, {Topic: MTopics}, db)
+
+    def updates():
+        return [x for x in c.sql_lst if x.startswith('UPDATE')]
+
+    ret = await c.bulk_update_with_perm(Topic, [
+        (1, ValuesToWrite({'title': 'a', 'time': 10})),
+        (2, ValuesToWrite({'title': 'b', 'time': '20'})),
+        (3, ValuesToWrite({'time.incr': 5})),
+        (4, ValuesToWrite({'time.incr': 6})),
+        (99, ValuesToWrite({'title': 'none'})),
+    ])
+    # 不存在的行不返回
+    assert ret == [1, 2, 3, 4]
+    assert updates() == [
+        'UPDATE "topic" SET "time"=CASE WHEN "id"=? THEN ? WHEN "id"=? THEN ? END,'
+        '"title"=CASE WHEN "id"=? THEN ? WHEN "id"=? THEN ? END WHERE "id" IN (?, ?)',
+        'UPDATE "topic" SET "time"=CASE WHEN "id"=? THEN "time"+? WHEN "id"=? THEN "time"+? END WHERE "id" IN (?, ?)',
+    ]
+    assert [(x.title, x.time) for x in MTopics.select().order_by(MTopics.id)] == \
+           [('a', 10), ('b', 20), ('test3', 6), ('test4', 7)]
+
+    # 按参数数量上限分块
+    c.sql_lst = []
+    c.insert_batch_size = 1
+    await c.bulk_update(Topic, [(1, ValuesToWrite({'title': 'x'}, Topic).bind()),
+                                (2, ValuesToWrite({'title': 'y'}, Topic).bind())])
+    assert len(updates()) == 2
+    assert [x.title for x in MTopics.select().order_by(MTopics.id)][:2] == ['x', 'y']
+
+    with pytest.raises(InvalidQueryValue):
+        await c.bulk_update(Topic, [(1, ValuesToWrite({'title': 'x'}, Topic).bind()),
+                                    (1, ValuesToWrite({'title': 'y'}, Topic).bind())])
+
+
+async def test_crud_bulk_update_postgres():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    c = RecordingCrud(None, {Topic: MTopics}, db)
+    c.dialect = SQLDialect.POSTGRESQL
+    c.fake_rows = lambda sql: [(1,), (2,)] if sql.startswith('SELECT') else []
+
+    await c.bulk_update(Topic, [(1, ValuesToWrite({'title': 'a', 'time.decr': 1}, Topic).bind()),
+                                (2, ValuesToWrite({'title': 'b', 'time.decr': 2}, Topic).bind())])
+    assert c.last_sql == 'UPDATE "topic" SET "time"="topic"."time"-"pycrud_v"."time","title"="pycrud_v"."title" ' \
+                         'FROM (VALUES ((NULL::"topic")."id", (NULL::"topic")."time", (NULL::"topic")."title"), ' \
+                         '(%s, %s, %s), (%s, %s, %s)) AS "pycrud_v"("id","time","title") ' \
+                         'WHERE "topic"."id"="pycrud_v"."id"'
+    assert c.last_values == [1, 1, 'a', 2, 2, 'b']
+
+
+async def test_crud_upsert():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+    db.execute_sql('CREATE UNIQUE INDEX users_username_unique ON users(username)')
+
+    c = RecordingCrud(None, {User: MUsers}, db)
+
+    ret = await c.upsert_many_with_perm(User, [
+        ValuesToWrite({'username': 'test', 'nickname': 'changed', 'password': 'p'}),
+        ValuesToWrite({'username': 'new1', 'nickname': 'n', 'password': 'p'}),
+        ValuesToWrite({'username': 'test3', 'nickname': 'changed', 'password': 'p'}),
+    ], [User.username], [User.nickname])
+    assert ret == [1, 6, 3]
+    # ids 由 RETURNING 取得，不需要再查询
+    assert c.sql_lst == [
+        'INSERT INTO "users" ("nickname","username","password") VALUES (?,?,?),(?,?,?),(?,?,?) '
+        'ON CONFLICT ("username") DO UPDATE SET "nickname"=excluded."nickname" RETURNING "id","username"',
+    ]
+    assert [(x.username, x.nickname, x.password) for x in MUsers.select().where(MUsers.id << [1, 3, 6])] == \
+           [('test', 'changed', 'pass'), ('test3', 'changed', 'pass'), ('new1', 'n', 'p')]
+
+    # 不更新任何列时为 DO NOTHING，已有的行保持不变，id 另行查询
+    c.sql_lst = []
+    ret = await c.upsert_many_with_perm(User, [
+        ValuesToWrite({'username': 'test2', 'nickname': 'changed', 'password': 'p'}),
+        ValuesToWrite({'username': 'new2', 'nickname': 'n', 'password': 'p'}),
+    ], ['username'], [])
+    assert ret == [2, 7]
+    assert c.sql_lst == [
+        'INSERT INTO "users" ("nickname","username","password") VALUES (?,?,?),(?,?,?) '
+        'ON CONFLICT ("username") DO NOTHING',
+        'SELECT "id","username" FROM "users" WHERE "username" IN (?, ?)',
+    ]
+    assert MUsers.get_by_id(2).nickname == '2'
+
+    # 以 id 为冲突列时不需要再查询
+    c.sql_lst = []
+    ret = await c.upsert_many(User, [ValuesToWrite({'id': 1, 'username': 'test', 'nickname': 'a', 'password': 'p'}, User),
+                                     ValuesToWrite({'id': 10, 'username': 'u10', 'nickname': 'b', 'password': 'p'}, User)],
+                              ['id'])
+    assert ret == [1, 10]
+    assert len(c.sql_lst) == 1
+    assert (MUsers.get_by_id(1).nickname, MUsers.get_by_id(10).username) == ('a', 'u10')
+
+    with pytest.raises(InvalidQueryValue):
+        await c.upsert_many(User, [ValuesToWrite({'username': 'x', 'nickname': 'n'}, User),
+                                   ValuesToWrite({'username': 'x', 'nickname': 'm'}, User)], ['username'])
+
+    with pytest.raises(InvalidQueryValue):
+        await c.upsert_many(User, [ValuesToWrite({'nickname': 'n'}, User)], ['username'])
+
+
+async def test_crud_upsert_dialects():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    def fake_rows(sql):
+        if sql.startswith('SELECT'):
+            return [(5, 'a', '1'), (2, 'b', '2')]
+        if c.dialect == SQLDialect.POSTGRESQL:
+            # 后端附加的 RETURNING id
+            return [(2,), (5,)]
+        return []
+
+    c = RecordingCrud(None, {User: MUsers}, db)
+    c.fake_rows = fake_rows
+    values_lst = [ValuesToWrite({'username': 'b', 'nickname': '2', 'password': 'p'}, User),
+                  ValuesToWrite({'username': 'a', 'nickname': '1', 'password': 'p'}, User)]
+
+    c.dialect, c.sql_lst = SQLDialect.POSTGRESQL, []
+    assert await c.upsert_many(User, values_lst, ['username', 'nickname']) == [2, 5]
+    assert c.sql_lst == [
+        'INSERT INTO "users" ("username","nickname","password") VALUES (%s,%s,%s),(%s,%s,%s) '
+        'ON CONFLICT ("username","nickname") DO UPDATE SET "password"=excluded."password"',
+    ]
+
+    c.sql_lst = []
+    assert await c.upsert_many(User, values_lst, ['username', 'nickname'], []) == [2, 5]
+    assert c.sql_lst == [
+        'INSERT INTO "users" ("username","nickname","password") VALUES (%s,%s,%s),(%s,%s,%s) '
+        'ON CONFLICT ("username","nickname") DO NOTHING',
+        'SELECT "id","username","nickname" FROM "users" WHERE ("username","nickname") IN ((%s,%s),(%s,%s))',
+    ]
+
+    c.dialect, c.sql_lst = SQLDialect.MYSQL, []
+    assert await c.upsert_many(User, values_lst, ['username', 'nickname'], []) == [2, 5]
+    assert c.sql_lst[0].endswith(') ON DUPLICATE KEY UPDATE "id"="id"')
+    assert c.sql_lst[1].startswith('SELECT')
+
+
+async def test_crud_direct_write():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    c = RecordingCrud(None, {
+        Topic: MTopics,
+    }, db)
+    c.direct_write = True
+
+    info = QueryInfo.from_json(Topic, {'user_id.eq': 1})
+    info.limit = -1
+    ret = await c.update(info, ValuesToWrite({'time.incr': 5}, Topic).bind())
+    assert sorted(ret) == [1, 2]
+    assert c.sql_lst == ['UPDATE "topic" SET "time"="time"+? WHERE "user_id"=? RETURNING id']
+    assert [x.time for x in MTopics.select().order_by(MTopics.id)] == [6, 6, 1, 1]
+
+    info = QueryInfo.from_json(Topic, {'user_id.eq': 2, '$order-by': 'id.desc'})
+    info.limit = 1
+    ret = await c.delete(info)
+    assert ret == [4]
+    assert c.sql_lst[-1] == 'DELETE FROM "topic" WHERE "id" IN ' \
+                            '(SELECT "id" FROM "topic" WHERE "user_id"=? ORDER BY "id" DESC LIMIT 1) RETURNING id'
+    assert MTopics.select().count() == 3
+
+    # when_before_delete 需要 id，回退为先查询再删除
+    class TopicWithHook(Topic):
+        @classmethod
+        async def on_delete(cls, info, when_before_delete, when_complete, perm=None):
+            async def func(id_lst):
+                cls.deleted = id_lst
+            when_before_delete.append(func)
+
+    c2 = RecordingCrud(None, {TopicWithHook: MTopics}, db)
+    c2.direct_write = True
+    ret = await c2.delete(QueryInfo.from_json(TopicWithHook, {'id.eq': 3}))
+    assert ret == TopicWithHook.deleted == [3]
+    assert c2.sql_lst[0].startswith('SELECT')
+
+
+async def test_crud_large_in_list():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    c = RecordingCrud(None, {
+        Topic: MTopics,
+    }, db)
+
+    ids = list(range(2, 5000))
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'id.in': ids}))
+    assert [x.id for x in ret] == [2, 3, 4]
+    assert c.last_sql == 'SELECT "id","id","title","user_id","content","time" FROM "topic" ' \
+                         'WHERE "id" IN (SELECT value FROM json_each(?)) LIMIT 20'
+
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'id.notin': ids}))
+    assert [x.id for x in ret] == [1]
+
+    ret = await c.delete(QueryInfo.from_json(Topic, {'id.in': ids}))
+    assert ret == [2, 3, 4]
+    assert MTopics.select().count() == 1
+
+    # mysql 中较长的整数列表直接写入语句，不受参数数量上限的限制
+    c.dialect = SQLDialect.MYSQL
+    ids = list(range(1, 70001))
+    await c.get_list(QueryInfo.from_json(Topic, {'id.in': ids}))
+    assert c.last_sql.startswith('SELECT "id","id","title","user_id","content","time" FROM "topic" '
+                                 'WHERE "id" IN (1,2,3,')
+    assert c.last_values == []
+
+    await c.get_list(QueryInfo.from_json(Topic, {'id.in': ids[:100], 'title.notin': ['a', 'b']}))
+    assert len(c.last_values) == 102
+
+    c.sql_cache = LRUCache(10)
+    for i in [ids, ids[1:], ids[1:]]:
+        await c.get_list(QueryInfo.from_json(Topic, {'id.notin': i, 'user_id.eq': 1}))
+        assert ' NOT IN (%d,' % i[0] in c.last_sql
+        assert c.last_values == [1, 20]
+
+
+async def test_crud_condition_optimizer():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    c = RecordingCrud(None, {User: MUsers}, db)
+
+    ret = await c.get_list(QueryInfo.from_json(User, {'id.eq': 1, '$and': {'id.eq': 2}}), with_count=True)
+    assert list(ret) == [] and ret.rows_count == 0
+    assert [x async for x in c.get_list_iter(QueryInfo.from_json(User, {'id.in': []}))] == []
+    assert c.sql_lst == []
+
+    ret = await c.get_list(QueryInfo.from_json(User, {'$or': {'id.eq': 1, '$or': {'id.in': [2, 3]}}}))
+    assert [x.id for x in ret] == [1, 2, 3]
+    assert c.sql_lst[-1] == 'SELECT "id","id","nickname","username","password" FROM "users" ' \
+                            'WHERE "id" IN (?, ?, ?) LIMIT 20'
+
+
+async def test_crud_in_list_postgres():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    c = RecordingCrud(None, {
+        Topic: MTopics,
+    }, db)
+    c.dialect = SQLDialect.POSTGRESQL
+
+    await c.get_list(QueryInfo.from_json(Topic, {'$select': 'id', 'id.in': [1, 2, 3], 'user_id.notin': [4]}))
+    assert c.last_sql == 'SELECT "id","id" FROM "topic" WHERE "id"=ANY(%s) AND "user_id"<>ALL(%s) LIMIT 20'
+    assert c.last_values == [[1, 2, 3], [4]]
+
+
+async def test_crud_full_text_search():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+    MTopics.create(title='hello world', time=2, content='the world is big, world', user_id=1)
+    MTopics.create(title='world peace', time=2, content='hello', user_id=2)
+
+    c = RecordingCrud(None, {Topic: MTopics}, db)
+
+    with pytest.raises(UnsupportedQueryOperator):
+        await c.get_list(QueryInfo.from_json(Topic, {'title.match': 'world'}))
+
+    await c.create_fts_index(Topic, [Topic.title, Topic.content])
+    # 再次调用不会重建
+    await c.create_fts_index(Topic, [Topic.title, Topic.content])
+
+    async def query(data, with_count=False):
+        ret = await c.get_list(QueryInfo.from_json(Topic, data), with_count=with_count)
+        return [x.id for x in ret]
+
+    assert await query({'title.match': 'world'}) == [5, 6]
+    assert c.last_sql.endswith('WHERE "topic"."id" IN (SELECT rowid FROM "topic_fts" WHERE "title" MATCH ?) LIMIT 20')
+    assert await query({'title.match': 'WORLD hello'}) == [5]
+    assert await query({'title.match': '" OR *'}) == []
+    assert await query({'content.match': 'world', '$order-by': 'content.rank'}) == [5]
+    assert await query({'title.match': 'world', 'content.match': 'hello'}) == [6]
+
+    # match 出现在 OR 之中
+    info = QueryInfo.from_json(Topic, {'content.match': 'world', '$or': {'title.match': 'world', 'id.eq': 1}})
+    assert [x.id for x in await c.get_list(info)] == [5]
+
+    # 按相关度排序
+    MTopics.create(title='x', time=3, content='world world world', user_id=1)
+    assert await query({'content.match': 'world', '$order-by': 'content.rank.desc'}, with_count=True) == [7, 5]
+    assert await query({'content.match': 'world', '$order-by': 'content.rank.asc'}) == [5, 7]
+
+    c.sql_cache = LRUCache()
+    for _ in range(2):
+        assert await query({'content.match': 'world', '$order-by': 'content.rank', '$select': 'id'},
+                           with_count=True) == [7, 5]
+    assert c.sql_cache.hits == 1
+
+    # 触发器随原表同步
+    MTopics.update(content='nothing').where(MTopics.id == 7).execute()
+    MTopics.delete().where(MTopics.id == 5).execute()
+    assert await query({'content.match': 'world'}) == []
+
+    with pytest.raises(InvalidOrderSyntax):
+        await query({'$order-by': 'title.rank'})
+    with pytest.raises(InvalidCursor):
+        await query({'title.match': 'world', '$order-by': 'title.rank', '$cursor': ''})
+
+
+async def test_crud_full_text_search_postgres():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    c = RecordingCrud(None, {Topic: MTopics}, db)
+    c.dialect = SQLDialect.POSTGRESQL
+    assert c.fts_index_sql(Topic, [Topic.title]) == [
+        'CREATE INDEX IF NOT EXISTS "topic_title_fts" ON "topic" USING GIN (to_tsvector(\'simple\', "title"))'
+    ]
+    c.add_fts_index([Topic.title])
+
+    await c.get_list(QueryInfo.from_json(Topic, {'$select': 'id', 'title.match': 'a b', '$order-by': 'title.rank'}))
+    assert c.last_sql == 'SELECT "id","id" FROM "topic" ' \
+                         'WHERE to_tsvector(\'simple\', "title") @@ plainto_tsquery(\'simple\', %s) ' \
+                         'ORDER BY ts_rank(to_tsvector(\'simple\', "title"), plainto_tsquery(\'simple\', %s)) DESC LIMIT 20'
+    assert c.last_values == ['a b', 'a b']
+
+
+async def test_crud_sql_cache():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    c = RecordingCrud(None, {
+        Topic: MTopics,
+    }, db)
+    c.sql_cache = LRUCache(16)
+
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'user_id.eq': 1, 'title.prefix': 'test'}), with_count=True)
+    assert [x.id for x in ret] == [1, 2]
+    assert ret.rows_count == 2
+    assert c.sql_cache.misses == 1
+
+    info = QueryInfo.from_json(Topic, {'user_id.eq': 2, 'title.prefix': 'test4'})
+    info.offset = 0
+    ret = await c.get_list(info, with_count=True)
+    assert [x.id for x in ret] == [4]
+    assert ret.rows_count == 1
+    assert c.sql_cache.hits == 1
+    assert c.last_sql == 'SELECT "id","id","title","user_id","content","time" FROM "topic" ' \
+                         'WHERE "user_id"=? AND "title" LIKE ? ESCAPE \'!\' LIMIT ?'
+
+    info = QueryInfo.from_json(Topic, {'user_id.eq': 1, 'title.prefix': 'test'})
+    info.offset = 1
+    ret = await c.get_list(info)
+    assert [x.id for x in ret] == [2]
+    assert c.last_sql.endswith('LIMIT ? OFFSET ?')
+
+    # IN 列表长度不同，结构不同
+    await c.get_list(QueryInfo.from_json(Topic, {'id.in': [1, 2]}))
+    await c.get_list(QueryInfo.from_json(Topic, {'id.in': [1, 2, 3]}))
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'id.in': [3, 4]}))
+    assert [x.id for x in ret] == [3, 4]
+    assert c.sql_cache.hits == 2
+    assert c.sql_cache.misses == 4
+
+    # 其他运算符的列表值同样按元素展开为多个参数，长度不同时结构不同
+    def compile_eq(value):
+        info = QueryInfo.from_json(Topic, {})
+        info.conditions = QueryConditions([ConditionExpr(Topic.id, QUERY_OP_COMPARE.EQ, value)])
+        phg = c.get_placeholder_generator()
+        return c._compile_select(info, None, phg)[1], phg.values
+
+    assert compile_eq([1, 2])[0].count('?') == 3
+    sql, values = compile_eq([1, 2, 3])
+    assert sql.count('?') == 4
+    assert values == [1, 2, 3]
+    assert c._condition_shape(ConditionExpr(Topic.id, QUERY_OP_RELATION.CONTAINS, [1, 2])) == \
+        c._condition_shape(ConditionExpr(Topic.id, QUERY_OP_RELATION.CONTAINS, [1, 2, 3]))
+
+
+async def test_crud_keyset_pagination():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+    MTopics.update(time=MTopics.id % 2).execute()
+    for i in range(5, 12):
+        MTopics.create(title='test%d' % i, time=i % 2, content='content', user_id=3)
+
+    c = PeeweeCrud(None, {
+        Topic: MTopics,
+    }, db)
+
+    expected = [x.id for x in MTopics.select().order_by(MTopics.time.desc(), MTopics.id.desc())]
+
+    ids = []
+    cursor = ''
+    while cursor is not None:
+        info = QueryInfo.from_json(Topic, {'$select': 'title', '$order-by': 'time.desc', '$cursor': cursor})
+        info.limit = 3
+        ret = await c.get_list(info)
+        assert all(x.to_dict().keys() == {'title'} for x in ret)
+        ids.extend([x.id for x in ret])
+        cursor = ret.next_cursor
+
+    assert ids == expected
+
+    info = QueryInfo.from_json(Topic, {'$after': 'invalid'})
+    with pytest.raises(InvalidCursor):
+        await c.get_list(info)
+
+    # 可为 NULL 的列无法可靠地定位，拒绝而不是遗漏行
+    for cursor in ['', QueryInfo(Topic).make_cursor([None, 3])]:
+        with pytest.raises(InvalidCursor):
+            await c.get_list(QueryInfo.from_json(Topic, {'$order-by': 'content', '$cursor': cursor}))
+
+    with pytest.raises(InvalidCursor):
+        await BaseCrud.get_list_iter(c, QueryInfo.from_json(Topic, {'$order-by': 'content'})).__anext__()
+
+
+async def test_crud_count_strategy():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    c = RecordingCrud(None, {
+        Topic: MTopics,
+    }, db)
+
+    info = QueryInfo.from_json(Topic, {'user_id.eq': 1})
+    info.limit = 1
+    ret = await c.get_list(info, with_count=COUNT_STRATEGY.WINDOW)
+    assert len(ret) == 1
+    assert ret.rows_count == 2
+    assert ret[0].to_dict()['user_id'] == 1
+    assert c.sql_lst == ['SELECT "id","id","title","user_id","content","time",COUNT(*) OVER() FROM "topic" '
+                         'WHERE "user_id"=? LIMIT 1']
+
+    info.offset = 10
+    ret = await c.get_list(info, with_count=COUNT_STRATEGY.WINDOW)
+    assert len(ret) == 0
+    assert ret.rows_count == 2
+
+    c.count_strategy = COUNT_STRATEGY.CONCURRENT
+    info.offset = 1
+    ret = await c.get_list(info, with_count=True)
+    assert [x.id for x in ret] == [2]
+    assert ret.rows_count == 2
+
+    # 没有统计信息时退回精确计数
+    ret = await c.get_list(QueryInfo.from_json(Topic, {}), with_count=COUNT_STRATEGY.ESTIMATED)
+    assert ret.rows_count == 4
+    assert not ret.rows_count_estimated
+
+    db.execute_sql('ANALYZE')
+    MTopics.create(title='test5', time=1, content='content5', user_id=1)
+
+    ret = await c.get_list(QueryInfo.from_json(Topic, {}), with_count=COUNT_STRATEGY.ESTIMATED)
+    assert ret.rows_count == 4
+    assert ret.rows_count_estimated
+
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'user_id.eq': 1}), with_count=COUNT_STRATEGY.ESTIMATED)
+    assert ret.rows_count == 3
+    assert not ret.rows_count_estimated
+
+
+async def test_crud_get_list_iter():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+    batches = []
+
+    class TopicWithHook(Topic):
+        @classmethod
+        async def on_read(cls, info, when_complete, perm=None):
+            async def func(lst):
+                batches.append([x.id for x in lst])
+            when_complete.append(func)
+
+    c = PeeweeCrud(None, {
+        TopicWithHook: MTopics,
+    }, db)
+
+    info = QueryInfo.from_json(TopicWithHook, {'$select': 'title', 'time.eq': 1})
+    info.limit = 1
+    ids = [x.id async for x in c.get_list_iter(info, batch_size=3)]
+    assert ids == [1, 2, 3, 4]
+    assert batches == [[1, 2, 3], [4]]
+
+    # 基于 keyset 分页的默认实现
+    batches.clear()
+    ret = [x async for x in BaseCrud.get_list_iter(c, info, batch_size=3)]
+    assert [x.id for x in ret] == [1, 2, 3, 4]
+    assert ret[0].to_dict() == {'title': 'test'}
+    assert batches == [[1, 2, 3], [4]]
+
+
+async def test_crud_foreign_keys_batched():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    c = RecordingCrud(None, {
+        User: MUsers,
+        Topic: MTopics,
+    }, db)
+
+    info = QueryInfo.from_json(Topic, {
+        '$select': 'id, title, user_id',
+        '$order-by': 'id',
+    })
+    info.foreign_keys = {
+        'user': QueryInfo(User, [User.id, User.username], conditions=QueryConditions([
+            ConditionExpr(Topic.user_id, QUERY_OP_COMPARE.EQ, User.id),
+        ])),
+        'user2': QueryInfo(User, [User.username], conditions=QueryConditions([
+            ConditionExpr(User.id, QUERY_OP_COMPARE.EQ, Topic.user_id),
+            ConditionExpr(User.username, QUERY_OP_COMPARE.NE, 'test2'),
+        ])),
+    }
+
+    ret = await c.get_list_with_foreign_keys(info)
+    assert [x.id for x in ret] == [1, 2, 3, 4]
+    assert [x.to_dict()['$extra']['user']['username'] for x in ret] == ['test', 'test', 'test2', 'test2']
+    assert [x.to_dict()['$extra']['user2'] for x in ret] == [{'id': 1, 'username': 'test'}] * 2 + [None] * 2
+
+    # 每个外键一次查询，且不再 join 上级表
+    assert len(c.sql_lst) == 3
+    assert all('JOIN' not in x for x in c.sql_lst)
+
+    # 一对多外键，并继续向下解析
+    c.sql_lst = []
+    info = QueryInfo.from_json(User, {'$select': 'id, username', 'id.in': [1, 2, 3]})
+    info.foreign_keys = {
+        'topic[]': QueryInfo(Topic, [Topic.title, Topic.user_id], conditions=QueryConditions([
+            ConditionExpr(Topic.user_id, QUERY_OP_COMPARE.EQ, User.id),
+        ]), order_by=QueryInfo.from_json(Topic, {'$order-by': 'id.desc'}).order_by, foreign_keys={
+            'user': QueryInfo(User, [User.nickname], conditions=QueryConditions([
+                ConditionExpr(Topic.user_id, QUERY_OP_COMPARE.EQ, User.id),
+            ]))
+        }),
+    }
+
+    ret = await c.get_list_with_foreign_keys(info)
+    d = [x.to_dict() for x in ret]
+    assert [[t['title'] for t in x['$extra']['topic[]']] for x in d[:2]] == [['test2', 'test'], ['test4', 'test3']]
+    assert d[2]['$extra']['topic[]'] is None
+    assert d[0]['$extra']['topic[]'][0]['$extra']['user'] == {'id': 1, 'nickname': '2'}
+    assert len(c.sql_lst) == 3
+    assert all('JOIN' not in x for x in c.sql_lst)
+
+
+async def test_crud_foreign_keys_top_n():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+    MTopics.create(title='test5', time=1, content='content5', user_id=1)
+
+    c = RecordingCrud(None, {
+        User: MUsers,
+        Topic: MTopics,
+    }, db)
+
+    info = QueryInfo.from_json(User, {'$select': 'id, username', 'id.in': [1, 2, 3]})
+    link = QueryConditions([ConditionExpr(Topic.user_id, QUERY_OP_COMPARE.EQ, User.id)])
+    info.foreign_keys = {
+        'topic[2]': QueryInfo(Topic, [Topic.id, Topic.title], conditions=link,
+                              order_by=QueryInfo.from_json(Topic, {'$order-by': 'id.desc'}).order_by),
+        'topic': QueryInfo(Topic, [Topic.title], conditions=link),
+    }
+
+    ret = await c.get_list_with_foreign_keys(info)
+    d = [x.to_dict() for x in ret]
+    assert [x['title'] for x in d[0]['$extra']['topic[2]']] == ['test5', 'test2']
+    assert [x['title'] for x in d[1]['$extra']['topic[2]']] == ['test4', 'test3']
+    assert d[2]['$extra']['topic[2]'] is None
+    assert [x['$extra']['topic']['title'] for x in d[:2]] == ['test', 'test3']
+
+    sqls = [x for x in c.sql_lst if 'ROW_NUMBER' in x]
+    assert len(sqls) == 2
+    assert 'ORDER BY "topic"."id" DESC' in sqls[0] + sqls[1]
+
+    with pytest.raises(InvalidQueryValue):
+        QueryInfo.from_json(User, {'$fks': {'topic[x]': {}}})
+
+
+async def test_crud_peewee_executor(tmp_path):
+    # 每个线程各自连接，内存数据库无法共享，使用文件数据库
+    db, MUsers, MTopics, MTopics2 = crud_db_init('sqlite:///%s' % (tmp_path / 'test.db'))
+    db.close()
+    threads = set()
+
+    class RecordCrud(PeeweeCrud):
+        def _execute_sql_sync(self, sql: str, values):
+            threads.add(threading.get_ident())
+            return super()._execute_sql_sync(sql, values)
+
+    executor = ThreadPoolExecutor(4)
+    c = RecordCrud(None, {
+        User: MUsers,
+        Topic: MTopics,
+    }, db, executor=executor)
+
+    lst = await asyncio.gather(*[c.get_list(QueryInfo.from_json(Topic, {'user_id.eq': 1}), with_count=True)
+                                 for _ in range(8)])
+    assert all([x.id for x in ret] == [1, 2] and ret.rows_count == 2 for ret in lst)
+    assert threading.get_ident() not in threads
+
+    ids = await c.insert_many(Topic, [ValuesToWrite({'title': 't%d' % i, 'time': 1, 'user_id': 3, 'content': ''}) for i in range(3)])
+    assert ids == [5, 6, 7]
+    assert [x.id async for x in c.get_list_iter(QueryInfo.from_json(Topic, {'user_id.eq': 3}), batch_size=2)] == ids
+
+    with pytest.raises(DBException):
+        await c.execute_sql('SELECT * FROM not_exists', c.get_placeholder_generator())
+
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'user_id.eq': 3}))
+    assert len(ret) == 3
+    executor.shutdown()
+
+
+async def test_crud_transaction():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+    events = []
+
+    class Post(RecordMapping):
+        id: Optional[int]
+        title: str
+        user_id: int
+        content: Optional[str] = None
+        time: int
+
+        @classmethod
+        async def on_insert(cls, values_lst, when_complete, perm=None):
+            async def done(ids):
+                events.append(ids)
+            when_complete.append(done)
+
+    c = PeeweeCrud(None, {Post: MTopics}, db)
+
+    def new_post(title):
+        return ValuesToWrite({'title': title, 'time': 1, 'user_id': 1, 'content': ''})
+
+    async def titles():
+        return [x.to_dict()['title'] for x in await c.get_list(QueryInfo.from_json(Post, {'id.gt': 4}))]
+
+    async with c.transaction():
+        await c.insert_many(Post, [new_post('a')])
+        # 事务中可以读到未提交的写入，钩子推迟到提交之后
+        assert await titles() == ['a']
+        assert events == []
+
+        async with c.transaction():
+            await c.insert_many(Post, [new_post('b')])
+
+        with pytest.raises(DBException):
+            async with c.transaction():
+                await c.insert_many(Post, [new_post('c')])
+                await c.execute_sql('SELECT * FROM not_exists', c.get_placeholder_generator())
+
+        assert await titles() == ['a', 'b']
+
+    assert await titles() == ['a', 'b']
+    assert events == [[5], [6]]
+    assert c.get_transaction() is None
+
+    with pytest.raises(ValueError):
+        async with c.transaction():
+            await c.update(QueryInfo.from_json(Post, {'id.eq': 5}), ValuesToWrite({'title': 'x'}))
+            await c.insert_many(Post, [new_post('d')])
+            raise ValueError()
+
+    assert await titles() == ['a', 'b']
+    assert events == [[5], [6]]
+
+
+async def test_crud_transaction_commit_failed():
+    db = peewee.SqliteDatabase(':memory:', pragmas={'foreign_keys': 1})
+    db.execute_sql('CREATE TABLE parent (id INTEGER PRIMARY KEY)')
+    db.execute_sql('CREATE TABLE child (id INTEGER PRIMARY KEY, n INTEGER NOT NULL, '
+                   'parent_id INTEGER REFERENCES parent (id) DEFERRABLE INITIALLY DEFERRED)')
+    db.execute_sql('INSERT INTO child (id, n) VALUES (1, 0)')
+
+    class Child(RecordMapping):
+        id: Optional[int]
+        n: int
+        parent_id: Optional[int]
+
+    c = PeeweeCrud(None, {Child: 'child'}, db)
+    c.counter_buffer = CounterBuffer(interval=60)
+    info = QueryInfo.from_json(Child, {'id.eq': 1})
+    await c.update(info, ValuesToWrite({'n.incr': 5}, Child).bind())
+
+    # 延迟的外键约束在提交时才检查，提交失败
+    with pytest.raises(DBException):
+        async with c.transaction():
+            await c.update(info, ValuesToWrite({'n': 10, 'parent_id': 99}, Child).bind())
+
+    assert c.get_transaction() is None
+    assert db.execute_sql('SELECT n, parent_id FROM child').fetchall() == [(0, None)]
+    # 事务中写入的缓冲增量随回滚放回缓冲
+    assert c.counter_buffer.pending_keys == 1
+    await c.counter_buffer.flush()
+    assert db.execute_sql('SELECT n FROM child').fetchall() == [(5,)]
+
+    # 连接已释放，之后的事务照常进行
+    async with c.transaction():
+        await c.update(info, ValuesToWrite({'n': 7}, Child).bind())
+    assert db.execute_sql('SELECT n FROM child').fetchall() == [(7,)]
+
+
+async def test_crud_transaction_executor(tmp_path):
+    db, MUsers, MTopics, MTopics2 = crud_db_init('sqlite:///%s' % (tmp_path / 'test.db'))
+    db.close()
+
+    executor = ThreadPoolExecutor(4)
+    c = PeeweeCrud(None, {Topic: MTopics}, db, executor=executor)
+    other = PeeweeCrud(None, {Topic: MTopics}, db, executor=executor)
+
+    async with c.transaction():
+        await c.update(QueryInfo.from_json(Topic, {'id.eq': 1}), ValuesToWrite({'title': 'changed'}))
+        assert (await c.get_list(QueryInfo.from_json(Topic, {'id.eq': 1})))[0].to_dict()['title'] == 'changed'
+        # 其他连接读不到未提交的写入
+        assert (await other.get_list(QueryInfo.from_json(Topic, {'id.eq': 1})))[0].to_dict()['title'] == 'test'
+
+    assert (await other.get_list(QueryInfo.from_json(Topic, {'id.eq': 1})))[0].to_dict()['title'] == 'changed'
+    executor.shutdown()
+
+
+async def test_crud_transaction_isolation():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+    c = PeeweeCrud(None, {Topic: MTopics}, db)
+    started = asyncio.Event()
+
+    async def tx():
+        with pytest.raises(ValueError):
+            async with c.transaction():
+                await c.update(QueryInfo.from_json(Topic, {'id.eq': 1}), ValuesToWrite({'title': 'tx'}))
+                started.set()
+                await asyncio.sleep(0.01)
+                raise ValueError()
+
+    async def other():
+        # 未设置 executor 时与事务共用一个连接，等待事务结束后执行，不会被一同回滚
+        await started.wait()
+        await c.update(QueryInfo.from_json(Topic, {'id.eq': 2}), ValuesToWrite({'title': 'other'}))
+
+    await asyncio.gather(tx(), other())
+    lst = await c.get_list(QueryInfo.from_json(Topic, {'id.in': [1, 2]}))
+    assert [x.to_dict()['title'] for x in lst] == ['test', 'other']
+
+
+async def test_crud_transaction_executor_reuse(tmp_path):
+    db, MUsers, MTopics, MTopics2 = crud_db_init('sqlite:///%s' % (tmp_path / 'test.db'))
+    db.close()
+
+    executor = ThreadPoolExecutor(2)
+    c = PeeweeCrud(None, {Topic: MTopics}, db, executor=executor, tx_workers=1)
+    threads = []
+
+    async def tx(title):
+        async with c.transaction() as t:
+            threads.append(t.conn[0])
+            await c.update(QueryInfo.from_json(Topic, {'id.eq': 1}), ValuesToWrite({'title': title}))
+            await asyncio.sleep(0.01)
+
+    # 专用线程只有一个，两个事务依次使用同一个线程
+    await asyncio.gather(tx('a'), tx('b'))
+    assert threads[0] is threads[1]
+    assert (await c.get_list(QueryInfo.from_json(Topic, {'id.eq': 1})))[0].to_dict()['title'] == 'b'
+
+    threads[0].shutdown()
+    executor.shutdown()
+
+
+async def test_crud_lazy_locks(tmp_path):
+    from pycrud.crud.ext.aiosqlite_crud import AioSqliteCrud
+
+    # 在当前事件循环中创建，之后在另一个线程的事件循环中使用
+    db, MUsers, MTopics, MTopics2 = crud_db_init('sqlite:///%s' % (tmp_path / 'test.db'))
+    db.close()
+    c = PeeweeCrud(None, {Topic: MTopics}, db)
+    c.counter_buffer = CounterBuffer(interval=10)
+    c2 = AioSqliteCrud(None, {Topic: 'topic'}, ':memory:', readers=0)
+
+    async def main():
+        async with c.transaction():
+            await c.update(QueryInfo.from_json(Topic, {'id.eq': 1}), ValuesToWrite({'title': 'x'}))
+        await c.update(QueryInfo.from_json(Topic, {'id.eq': 1}), ValuesToWrite({'time.incr': 1}, Topic).bind())
+        await c.counter_buffer.flush()
+        await c2.connect()
+        await c2.close()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(main())
+        finally:
+            loop.close()
+
+    await asyncio.get_event_loop().run_in_executor(None, run)
+
+
+async def test_crud_json_loads():
+    import json
+    from playhouse.sqlite_ext import JSONField
+
+    db = peewee.SqliteDatabase(':memory:')
+
+    class Docs(peewee.Model):
+        extra = JSONField()
+
+        class Meta:
+            database = db
+            table_name = 'docs'
+
+    class Doc(RecordMapping):
+        id: Optional[int]
+        extra: dict
+
+    db.create_tables([Docs])
+    c = PeeweeCrud(None, {Doc: Docs}, db)
+    await c.insert_many(Doc, [ValuesToWrite({'extra': {'a': 1}}, Doc).bind()])
+
+    # 未设置 json_loads_func 时原样返回驱动给出的字符串
+    ret = await c.get_list(QueryInfo.from_json(Doc, {}))
+    assert ret[0].to_dict()['extra'] == '{"a": 1}'
+
+    c.json_loads_func = json.loads
+    ret = await c.get_list(QueryInfo.from_json(Doc, {}))
+    assert ret[0].to_dict()['extra'] == {'a': 1}
+    assert [x.to_dict()['extra'] async for x in c.get_list_iter(QueryInfo.from_json(Doc, {}))] == [{'a': 1}]
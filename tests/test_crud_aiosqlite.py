@@ -0,0 +1,137 @@
+import asyncio
+from typing import Optional
+
+import pytest
+
+from pycrud.error import DBException
+from pycrud.query import QueryInfo
+from pycrud.types import RecordMapping
+from pycrud.values import ValuesToWrite
+
+aiosqlite = pytest.importorskip('aiosqlite')
+
+from pycrud.crud.ext.aiosqlite_crud import AioSqliteCrud
+
+pytestmark = [pytest.mark.asyncio]
+
+
+class User(RecordMapping):
+    id: Optional[int]
+    nickname: str
+    username: str
+    password: str = 'password'
+
+
+async def crud_db_init(path, readers=2):
+    c = AioSqliteCrud(None, {User: 'users'}, str(path), readers=readers)
+    await c.connect()
+    await c._writer.execute('CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                            "nickname TEXT NOT NULL, username TEXT NOT NULL, "
+                            "password TEXT NOT NULL DEFAULT 'password')")
+    return c
+
+
+async def test_aiosqlite_crud(tmp_path):
+    c = await crud_db_init(tmp_path / 'test.db')
+
+    try:
+        row = await (await c._writer.execute('PRAGMA journal_mode')).fetchone()
+        assert row[0] == 'wal'
+
+        ids = await c.insert_many(User, [ValuesToWrite({'nickname': 'n%d' % i, 'username': 'u%d' % i}, table=User)
+                                         for i in range(5)])
+        assert ids == [1, 2, 3, 4, 5]
+
+        # 只读连接可以同时查询
+        lst = await asyncio.gather(*[c.get_list(QueryInfo.from_json(User, {'id.le': 3}), with_count=True)
+                                     for _ in range(6)])
+        assert all([x.id for x in ret] == [1, 2, 3] and ret.rows_count == 3 for ret in lst)
+
+        ret = await c.update(QueryInfo.from_json(User, {'id.eq': 2}), ValuesToWrite({'nickname': 'changed'}, table=User))
+        assert ret == [2]
+        ret = await c.get_list(QueryInfo.from_json(User, {'id.eq': 2}))
+        assert ret[0].to_dict()['nickname'] == 'changed'
+
+        await c.insert_many(User, [ValuesToWrite({'id': 10 + i, 'nickname': 'n', 'username': 'u'}, table=User)
+                                   for i in range(3)])
+        assert [x.id async for x in c.get_list_iter(QueryInfo(User), batch_size=2)] == [1, 2, 3, 4, 5, 10, 11, 12]
+
+        assert await c.delete(QueryInfo.from_json(User, {'id.ge': 10})) == [10, 11, 12]
+    finally:
+        await c.close()
+
+
+async def test_aiosqlite_crud_memory():
+    c = AioSqliteCrud(None, {User: 'users'}, ':memory:', readers=0)
+    await c.connect()
+    await c._writer.execute('CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                            "nickname TEXT NOT NULL, username TEXT NOT NULL, "
+                            "password TEXT NOT NULL DEFAULT 'password')")
+
+    try:
+        ids = await c.insert_many(User, [ValuesToWrite({'nickname': 'n', 'username': 'u'}, table=User)])
+        assert ids == [1]
+        assert [x.id for x in await c.get_list(QueryInfo(User))] == [1]
+    finally:
+        await c.close()
+
+
+async def test_aiosqlite_crud_transaction(tmp_path):
+    c = await crud_db_init(tmp_path / 'test.db')
+
+    try:
+        await c.insert_many(User, [ValuesToWrite({'nickname': 'n', 'username': 'u'}, table=User)])
+
+        # 在事务之外创建的任务不属于该事务
+        started = asyncio.Event()
+
+        async def read_outside():
+            await started.wait()
+            return (await c.get_list(QueryInfo.from_json(User, {'id.eq': 1})))[0].to_dict()['nickname']
+
+        outside = asyncio.ensure_future(read_outside())
+
+        async with c.transaction():
+            await c.update(QueryInfo.from_json(User, {'id.eq': 1}), ValuesToWrite({'nickname': 'changed'}, table=User))
+            lst = await asyncio.gather(*[c.get_list(QueryInfo.from_json(User, {'id.eq': 1})) for _ in range(3)])
+            assert all(x[0].to_dict()['nickname'] == 'changed' for x in lst)
+
+            started.set()
+            assert await outside == 'n'
+
+            with pytest.raises(ValueError):
+                async with c.transaction():
+                    await c.insert_many(User, [ValuesToWrite({'nickname': 'n', 'username': 'u'}, table=User)])
+                    raise ValueError()
+
+        ret = await c.get_list(QueryInfo.from_json(User, {}))
+        assert [(x.id, x.to_dict()['nickname']) for x in ret] == [(1, 'changed')]
+    finally:
+        await c.close()
+
+
+
+async def test_aiosqlite_crud_commit_failed(tmp_path):
+    c = await crud_db_init(tmp_path / 'test.db', readers=0)
+
+    try:
+        await c._writer.execute('PRAGMA foreign_keys=ON')
+        await c._writer.execute('CREATE TABLE parent (id INTEGER PRIMARY KEY)')
+        await c._writer.execute('ALTER TABLE users ADD COLUMN parent_id INTEGER '
+                                'REFERENCES parent (id) DEFERRABLE INITIALLY DEFERRED')
+        await c.insert_many(User, [ValuesToWrite({'nickname': 'n', 'username': 'u'}, table=User)])
+
+        # 延迟的外键约束在提交时才检查，提交失败后事务已回滚，写连接可以继续使用
+        with pytest.raises(DBException):
+            async with c.transaction():
+                await c.update(QueryInfo.from_json(User, {'id.eq': 1}), ValuesToWrite({'nickname': 'changed'}, table=User))
+                await c._writer.execute('UPDATE users SET parent_id = 99')
+
+        assert not c._writer.in_transaction
+        async with c.transaction():
+            await c.update(QueryInfo.from_json(User, {'id.eq': 1}), ValuesToWrite({'username': 'u2'}, table=User))
+
+        ret = await c.get_list(QueryInfo.from_json(User, {}))
+        assert [(x.to_dict()['nickname'], x.to_dict()['username']) for x in ret] == [('n', 'u2')]
+    finally:
+        await c.close()
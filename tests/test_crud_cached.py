@@ -0,0 +1,113 @@
+import pytest
+
+from pycrud.crud.base_crud import PermInfo
+from pycrud.crud.cached_crud import CachedCrud, LocalCacheStorage, MemorySharedCacheStorage, TieredCacheStorage
+from pycrud.crud.ext.memory_crud import MemoryCrud
+from pycrud.permission import RoleDefine, TablePerm, A
+from pycrud.query import QueryInfo
+from pycrud.values import ValuesToWrite
+from tests.test_crud_memory import User, Topic, crud_init
+
+pytestmark = [pytest.mark.asyncio]
+
+
+class CountingCrud(MemoryCrud):
+    def __post_init__(self):
+        super().__post_init__()
+        self.queries = 0
+
+    async def get_list(self, info: QueryInfo, with_count=False, *, _perm=None):
+        self.queries += 1
+        return await super().get_list(info, with_count, _perm=_perm)
+
+
+async def counting_crud_init():
+    inner = CountingCrud(None)
+    inner._tables = (await crud_init())._tables
+    return inner
+
+
+async def test_cached_crud_hit_and_invalidate():
+    inner = await counting_crud_init()
+    c = CachedCrud(None, inner)
+
+    for _ in range(3):
+        ret = await c.get_list(QueryInfo.from_json(User, {'id.le': 2}), with_count=True)
+        assert [x.id for x in ret] == [1, 2]
+        assert ret.rows_count == 2
+        assert ret[0].to_dict()['username'] == 'test1'
+
+    assert inner.queries == 1
+    assert (c.hits, c.misses) == (2, 1)
+
+    # 写入其他表不影响
+    await c.update(QueryInfo.from_json(Topic, {'id.eq': 1}), ValuesToWrite({'title': 'x'}, table=Topic))
+    n = inner.queries
+    await c.get_list(QueryInfo.from_json(User, {'id.le': 2}), with_count=True)
+    assert inner.queries == n
+
+    await c.update(QueryInfo.from_json(User, {'id.eq': 1}), ValuesToWrite({'username': 'changed'}, table=User))
+    ret = await c.get_list(QueryInfo.from_json(User, {'id.le': 2}), with_count=True)
+    assert ret[0].to_dict()['username'] == 'changed'
+
+    await c.insert_many(User, [ValuesToWrite({'nickname': 'n', 'username': 'u'}, table=User)])
+    await c.delete(QueryInfo.from_json(User, {'id.eq': 2}))
+    ret = await c.get_list(QueryInfo.from_json(User, {'id.le': 2}), with_count=True)
+    assert [x.id for x in ret] == [1]
+    assert (c.hits, c.misses) == (3, 3)
+
+
+async def test_cached_crud_role():
+    permission = {
+        'visitor': RoleDefine({User: TablePerm({User.id: {A.READ}})}),
+        'admin': RoleDefine({User: TablePerm({User.id: {A.READ}, User.username: {A.READ}})}),
+    }
+
+    inner = await counting_crud_init()
+    c = CachedCrud(permission, inner)
+
+    for name, keys in [('visitor', {'id'}), ('admin', {'id', 'username'}), ('visitor', {'id'})]:
+        ret = await c.get_list_with_perm(QueryInfo.from_json(User, {}), perm=PermInfo(True, None, permission[name]))
+        assert ret[0].to_dict().keys() == keys
+
+    assert inner.queries == 2
+
+
+async def test_cached_crud_tiered_storage():
+    shared = MemorySharedCacheStorage()
+    inner = await counting_crud_init()
+
+    # 两个进程各自的本地缓存，共享同一个共享层
+    c1 = CachedCrud(None, inner, TieredCacheStorage(LocalCacheStorage(), shared))
+    c2 = CachedCrud(None, inner, TieredCacheStorage(LocalCacheStorage(), shared))
+
+    info = QueryInfo.from_json(User, {'id.eq': 1})
+    await c1.get_list(info)
+    ret = await c2.get_list(info)
+    assert ret[0].to_dict()['username'] == 'test1'
+    assert inner.queries == 1
+
+    await c1.update(QueryInfo.from_json(User, {'id.eq': 1}), ValuesToWrite({'username': 'changed'}, table=User))
+    n = inner.queries
+    ret = await c2.get_list(info)
+    assert ret[0].to_dict()['username'] == 'changed'
+    assert inner.queries == n + 1
+
+
+async def test_cached_crud_transaction():
+    inner = await counting_crud_init()
+    c = CachedCrud(None, inner)
+    info = QueryInfo.from_json(User, {'id.eq': 1})
+    await c.get_list(info)
+
+    async with c.transaction():
+        await c.update(QueryInfo.from_json(User, {'id.eq': 1}), ValuesToWrite({'username': 'changed'}, table=User))
+        n = inner.queries
+        # 事务中不经过缓存
+        for _ in range(2):
+            assert (await c.get_list(info))[0].to_dict()['username'] == 'changed'
+        assert inner.queries == n + 2
+
+    assert (await c.get_list(info))[0].to_dict()['username'] == 'changed'
+    assert (await c.get_list(info))[0].to_dict()['username'] == 'changed'
+    assert inner.queries == n + 3
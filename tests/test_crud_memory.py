@@ -0,0 +1,262 @@
+from typing import Optional, List
+
+import pytest
+from pydantic import Field
+
+from pycrud.const import INDEX_TYPE, QUERY_OP_COMPARE
+from pycrud.crud.ext.memory_crud import MemoryCrud
+from pycrud.error import DBException, InvalidCursor
+from pycrud.query import QueryInfo, QueryConditions, ConditionExpr, QueryOrder
+from pycrud.types import RecordMapping
+from pycrud.values import ValuesToWrite
+
+pytestmark = [pytest.mark.asyncio]
+
+
+class User(RecordMapping):
+    id: Optional[int]
+    nickname: str
+    username: str
+    password: str = 'password'
+
+
+class Topic(RecordMapping):
+    id: Optional[int]
+    title: str
+    user_id: int
+    time: int
+    tags: List[str] = Field(default_factory=lambda: [])
+
+
+async def crud_init():
+    c = MemoryCrud(None, {
+        User: {'username': INDEX_TYPE.SORTED},
+        Topic: {'user_id': INDEX_TYPE.HASH, 'time': INDEX_TYPE.SORTED},
+    })
+
+    await c.insert_many(User, [ValuesToWrite({'nickname': 'n%d' % i, 'username': 'test%d' % i}, table=User)
+                               for i in range(1, 6)])
+    await c.insert_many(Topic, [ValuesToWrite({'title': 'test%d' % i, 'user_id': i % 3 + 1, 'time': i * 10,
+                                               'tags': ['a', 't%d' % i]}, table=Topic)
+                                for i in range(1, 9)])
+    return c
+
+
+async def test_crud_memory_read():
+    c = await crud_init()
+
+    ret = await c.get_list(QueryInfo.from_json(User, {}), with_count=True)
+    assert [x.id for x in ret] == [1, 2, 3, 4, 5]
+    assert ret.rows_count == 5
+    assert ret[0].to_dict() == {'id': 1, 'nickname': 'n1', 'username': 'test1', 'password': 'password'}
+
+    ret = await c.get_list(QueryInfo.from_json(User, {'username.prefix': 'test4'}))
+    assert [x.id for x in ret] == [4]
+
+    ret = await c.get_list(QueryInfo.from_json(User, {
+        '$or': {
+            'id.in': [1, 2],
+            '$and': {
+                'id.ge': 4,
+                'id.le': 5
+            }
+        }
+    }))
+    assert [x.id for x in ret] == [1, 2, 4, 5]
+
+    ret = await c.get_list(QueryInfo.from_json(User, {'$not': {'id.eq': 1}}))
+    assert [x.id for x in ret] == [2, 3, 4, 5]
+
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'time.gt': 30, 'user_id.in': [1, 2], '$order-by': 'time.desc'}))
+    assert [x.id for x in ret] == [7, 6, 4]
+
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'tags.contains': ['a', 't2']}))
+    assert [x.id for x in ret] == [2]
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'tags.contains_any': ['t2', 't3']}))
+    assert [x.id for x in ret] == [2, 3]
+
+
+async def test_crud_memory_index():
+    c = await crud_init()
+    t = c.get_table(Topic)
+
+    assert t.lookup('user_id', QUERY_OP_COMPARE.GT, 1) is None
+    assert t.lookup('time', QUERY_OP_COMPARE.GT, 60) == {7, 8}
+    info = QueryInfo.from_json(Topic, {'user_id.eq': 2, 'time.ge': 40})
+    assert c._lookup(info.conditions, Topic, {}) == {4, 7}
+
+    # 没有索引的列需要全表扫描
+    info = QueryInfo.from_json(Topic, {'$or': {'user_id.eq': 2, 'title.eq': 'test3'}})
+    assert c._lookup(info.conditions, Topic, {}) is None
+    assert [x.id for x in await c.get_list(info)] == [1, 3, 4, 7]
+
+    # 索引随写入更新
+    await c.update(QueryInfo.from_json(Topic, {'id.eq': 4}), ValuesToWrite({'user_id': 3}, table=Topic))
+    await c.delete(QueryInfo.from_json(Topic, {'id.eq': 7}))
+    info = QueryInfo.from_json(Topic, {'user_id.eq': 2, 'time.ge': 40})
+    assert c._lookup(info.conditions, Topic, {}) == set()
+    assert c._lookup(QueryInfo.from_json(Topic, {'user_id.eq': 3}).conditions, Topic, {}) == {2, 4, 5, 8}
+
+
+async def test_crud_memory_match():
+    c = await crud_init()
+    await c.insert_many(Topic, [ValuesToWrite({'title': t, 'user_id': 1, 'time': 0}, table=Topic)
+                                for t in ['Hello world', 'world, world peace', 'hello']])
+
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'title.match': 'world'}))
+    assert [x.id for x in ret] == [9, 10]
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'title.match': 'WORLD hello'}))
+    assert [x.id for x in ret] == [9]
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'title.match': 'world', '$order-by': 'title.rank'}))
+    assert [x.id for x in ret] == [10, 9]
+
+
+async def test_crud_memory_write():
+    c = await crud_init()
+
+    ret = await c.update(QueryInfo.from_json(Topic, {'user_id.eq': 1}), ValuesToWrite({
+        'time.incr': 5,
+        'tags.array_extend': ['b'],
+    }, table=Topic, try_parse=True))
+    assert ret == [3, 6]
+
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'id.in': [3, 6]}))
+    assert [(x.to_dict()['time'], x.to_dict()['tags']) for x in ret] == [(35, ['a', 't3', 'b']), (65, ['a', 't6', 'b'])]
+
+    await c.update(QueryInfo.from_json(Topic, {'id.eq': 3}), ValuesToWrite({
+        'tags.array_prune': ['a'],
+    }, table=Topic, try_parse=True))
+    ret = await c.get_list(QueryInfo.from_json(Topic, {'id.eq': 3}))
+    assert ret[0].to_dict()['tags'] == ['t3', 'b']
+
+    assert await c.insert_many(User, [ValuesToWrite({'id': 10, 'nickname': 'n', 'username': 'u'}, table=User),
+                                      ValuesToWrite({'nickname': 'n', 'username': 'u'}, table=User)]) == [10, 6]
+
+    with pytest.raises(DBException):
+        await c.insert_many(User, [ValuesToWrite({'id': 1, 'nickname': 'n', 'username': 'u'}, table=User)])
+
+    assert await c.delete(QueryInfo.from_json(User, {'id.ge': 6})) == [10, 6]
+    ret = await c.get_list(QueryInfo.from_json(User, {}))
+    assert [x.id for x in ret] == [1, 2, 3, 4, 5]
+
+
+async def test_crud_memory_write_invalid_index_value():
+    c = MemoryCrud(None, {Topic: {'user_id': INDEX_TYPE.HASH, 'time': INDEX_TYPE.SORTED}})
+    await c.insert_many(Topic, [ValuesToWrite({'title': 't%d' % i, 'user_id': i, 'time': i * 10}, table=Topic)
+                                for i in range(1, 3)])
+    t = c.get_table(Topic)
+
+    def check():
+        assert sorted(t.rows) == [1, 2]
+        assert t.rows[1]['user_id'] == 1 and t.rows[1]['time'] == 10
+        assert t.indexes['user_id']._data == {1: {1}, 2: {2}}
+        assert (t.indexes['time']._keys, t.indexes['time']._ids) == ([10, 20], [1, 2])
+
+    # 未经校验的值无法与索引中已有的值比较，整批写入均不生效
+    with pytest.raises(DBException):
+        await c.insert_many(Topic, [ValuesToWrite({'title': 'a', 'user_id': 3, 'time': 30}, table=Topic),
+                                    ValuesToWrite({'title': 'b', 'user_id': 4, 'time': 'x'}, table=Topic)])
+    check()
+
+    with pytest.raises(DBException):
+        await c.update(QueryInfo.from_json(Topic, {'id.eq': 1}),
+                       ValuesToWrite({'user_id': 5, 'time': 'x'}, table=Topic))
+    check()
+
+    with pytest.raises(DBException):
+        await c.update(QueryInfo.from_json(Topic, {'id.eq': 1}),
+                       ValuesToWrite({'id': 9, 'user_id': 5, 'time': 'x'}, table=Topic))
+    check()
+    assert [x.id for x in await c.get_list(QueryInfo.from_json(Topic, {}))] == [1, 2]
+
+
+async def test_crud_memory_keyset_and_foreign_keys():
+    c = await crud_init()
+
+    info = QueryInfo.from_json(Topic, {'$order-by': 'time.desc'})
+    info.limit = 3
+    ids = [x.id async for x in c.get_list_iter(info, batch_size=3)]
+    assert ids == [8, 7, 6, 5, 4, 3, 2, 1]
+
+    info = QueryInfo.from_json(User, {'id.le': 2})
+    info.foreign_keys = {
+        'topic[]': QueryInfo(Topic, [Topic.id, Topic.user_id], conditions=QueryConditions([
+            ConditionExpr(Topic.user_id, QUERY_OP_COMPARE.EQ, User.id),
+        ])),
+        'topic[2]': QueryInfo(Topic, [Topic.id, Topic.time], conditions=QueryConditions([
+            ConditionExpr(Topic.user_id, QUERY_OP_COMPARE.EQ, User.id),
+        ]), order_by=[QueryOrder(Topic.time, 'desc')]),
+    }
+
+    ret = await c.get_list_with_foreign_keys(info)
+    d = ret[1].to_dict()
+    assert [x['id'] for x in d['$extra']['topic[]']] == [1, 4, 7]
+    assert [x['id'] for x in d['$extra']['topic[2]']] == [7, 4]
+
+
+async def test_crud_memory_keyset_nullable_order():
+    class Item(RecordMapping):
+        id: Optional[int]
+        rank: Optional[int]
+
+    c = MemoryCrud(None)
+    await c.insert_many(Item, [ValuesToWrite({'rank': x}, table=Item) for x in [2, None, 1, None]])
+
+    ret = await c.get_list(QueryInfo.from_json(Item, {'$order-by': 'rank'}))
+    assert [x.id for x in ret] == [2, 4, 3, 1]
+
+    # (rank > 1) 不包含 rank 为 NULL 的行，keyset 分页会遗漏这些行
+    info = QueryInfo.from_json(Item, {'$order-by': 'rank'})
+    info.limit = 2
+    with pytest.raises(InvalidCursor):
+        [x async for x in c.get_list_iter(info, batch_size=2)]
+
+
+async def test_crud_memory_update_keeps_order():
+    c = await crud_init()
+    await c.update(QueryInfo.from_json(User, {'id.eq': 1}), ValuesToWrite({'username': 'changed'}, table=User))
+    assert [x.id for x in await c.get_list(QueryInfo.from_json(User, {}))] == [1, 2, 3, 4, 5]
+    assert [x.id for x in await c.get_list(QueryInfo.from_json(User, {'username.prefix': 'ch'}))] == [1]
+
+
+async def test_crud_memory_transaction():
+    c = await crud_init()
+
+    with pytest.raises(ValueError):
+        async with c.transaction():
+            await c.update(QueryInfo.from_json(User, {'id.eq': 1}), ValuesToWrite({'username': 'changed'}, table=User))
+            await c.delete(QueryInfo.from_json(User, {'id.eq': 2}))
+            raise ValueError()
+
+    ret = await c.get_list(QueryInfo.from_json(User, {'id.le': 2}))
+    assert [x.to_dict()['username'] for x in ret] == ['test1', 'test2']
+
+    async with c.transaction():
+        await c.delete(QueryInfo.from_json(User, {'id.eq': 2}))
+        with pytest.raises(ValueError):
+            async with c.transaction():
+                await c.delete(QueryInfo.from_json(User, {'id.eq': 1}))
+                raise ValueError()
+
+    assert [x.id for x in await c.get_list(QueryInfo.from_json(User, {'id.le': 2}))] == [1]
+    assert [x.id for x in await c.get_list(QueryInfo.from_json(User, {'username.prefix': 'test'}))] == [1, 3, 4, 5]
+
+
+async def test_crud_memory_bulk_update():
+    c = await crud_init()
+    ret = await c.bulk_update_with_perm(User, [(1, ValuesToWrite({'username': 'a'})),
+                                               (2, ValuesToWrite({'username': 'b'})),
+                                               (99, ValuesToWrite({'username': 'c'}))])
+    assert ret == [1, 2]
+    ret = await c.get_list(QueryInfo.from_json(User, {'id.le': 3}))
+    assert [x.to_dict()['username'] for x in ret] == ['a', 'b', 'test3']
+
+
+async def test_crud_memory_upsert():
+    c = await crud_init()
+    ret = await c.upsert_many_with_perm(User, [ValuesToWrite({'username': 'test1', 'nickname': 'changed'}),
+                                               ValuesToWrite({'username': 'new', 'nickname': 'n'})],
+                                        [User.username])
+    assert ret == [1, 6]
+    ret = await c.get_list(QueryInfo.from_json(User, {'id.in': [1, 6]}))
+    assert [(x.to_dict()['username'], x.to_dict()['nickname']) for x in ret] == [('test1', 'changed'), ('new', 'n')]
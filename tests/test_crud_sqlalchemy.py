@@ -0,0 +1,106 @@
+from typing import Optional, List
+
+import pytest
+
+from pycrud.query import QueryInfo
+from pycrud.types import RecordMapping
+from pycrud.values import ValuesToWrite
+
+sqlalchemy = pytest.importorskip('sqlalchemy')
+pytest.importorskip('aiosqlite')
+pytest.importorskip('greenlet')
+
+from pycrud.crud.ext.sqlalchemy_crud import SQLAlchemyCrud
+
+pytestmark = [pytest.mark.asyncio]
+
+
+class User(RecordMapping):
+    id: Optional[int]
+    nickname: str
+    username: str
+    password: str = 'password'
+
+
+class Topic(RecordMapping):
+    id: Optional[int]
+    tags: List[str]
+    extra: dict
+
+
+async def test_sqlalchemy_crud_reflect():
+    from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+
+    metadata = sqlalchemy.MetaData()
+    topic = sqlalchemy.Table('topic', metadata,
+                             sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+                             sqlalchemy.Column('tags', ARRAY(sqlalchemy.Text)),
+                             sqlalchemy.Column('extra', JSONB),
+                             sqlalchemy.Column('title', sqlalchemy.Text, index=True),
+                             sqlalchemy.Column('author', sqlalchemy.Text))
+    sqlalchemy.Index('ix_topic_author_lower', sqlalchemy.func.lower(topic.c.author))
+
+    c = SQLAlchemyCrud(None, {Topic: topic, User: 'users'}, 'sqlite+aiosqlite://')
+    assert c._table_cache[Topic] == {'array_fields': {'tags'}, 'json_fields': {'extra'},
+                                     'index_fields': {'id', 'title'}, 'lower_index_fields': {'author'},
+                                     'fts_fields': set()}
+    assert c.mapping2model[Topic].get_table_name() == 'topic'
+    assert c.mapping2model[User].get_table_name() == 'users'
+
+
+async def test_sqlalchemy_crud(tmp_path):
+    c = SQLAlchemyCrud(None, {User: 'users'}, 'sqlite+aiosqlite:///%s' % (tmp_path / 'test.db'), pool_size=2)
+
+    try:
+        async with c.engine.begin() as conn:
+            await conn.exec_driver_sql('CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                       "nickname TEXT NOT NULL, username TEXT NOT NULL, "
+                                       "password TEXT NOT NULL DEFAULT 'password')")
+
+        ids = await c.insert_many(User, [ValuesToWrite({'nickname': 'n%d' % i, 'username': 'u%d' % i}, table=User)
+                                         for i in range(5)])
+        assert ids == [1, 2, 3, 4, 5]
+
+        ret = await c.get_list(QueryInfo.from_json(User, {'id.le': 3}), with_count=True)
+        assert [x.id for x in ret] == [1, 2, 3]
+        assert ret.rows_count == 3
+
+        ret = await c.update(QueryInfo.from_json(User, {'id.eq': 2}), ValuesToWrite({'nickname': 'changed'}, table=User))
+        assert ret == [2]
+        ret = await c.get_list(QueryInfo.from_json(User, {'id.eq': 2}))
+        assert ret[0].to_dict()['nickname'] == 'changed'
+
+        await c.insert_many(User, [ValuesToWrite({'id': 10 + i, 'nickname': 'n', 'username': 'u'}, table=User)
+                                   for i in range(3)])
+        assert [x.id async for x in c.get_list_iter(QueryInfo(User), batch_size=2)] == [1, 2, 3, 4, 5, 10, 11, 12]
+
+        assert await c.delete(QueryInfo.from_json(User, {'id.ge': 10})) == [10, 11, 12]
+    finally:
+        await c.close()
+
+
+async def test_sqlalchemy_crud_transaction(tmp_path):
+    c = SQLAlchemyCrud(None, {User: 'users'}, 'sqlite+aiosqlite:///%s' % (tmp_path / 'test.db'), pool_size=2)
+
+    try:
+        async with c.engine.begin() as conn:
+            await conn.exec_driver_sql('CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                       "nickname TEXT NOT NULL, username TEXT NOT NULL, "
+                                       "password TEXT NOT NULL DEFAULT 'password')")
+
+        async with c.transaction():
+            await c.insert_many(User, [ValuesToWrite({'nickname': 'a', 'username': 'u'}, table=User)])
+            with pytest.raises(ValueError):
+                async with c.transaction():
+                    await c.insert_many(User, [ValuesToWrite({'nickname': 'b', 'username': 'u'}, table=User)])
+                    raise ValueError()
+            assert [x.id for x in await c.get_list(QueryInfo(User))] == [1]
+
+        with pytest.raises(ValueError):
+            async with c.transaction():
+                await c.delete(QueryInfo.from_json(User, {'id.eq': 1}))
+                raise ValueError()
+
+        assert [x.to_dict()['nickname'] for x in await c.get_list(QueryInfo.from_json(User, {}))] == ['a']
+    finally:
+        await c.close()
@@ -0,0 +1,60 @@
+from typing import Optional
+
+import pytest
+
+from pycrud.const import COUNT_STRATEGY
+from pycrud.query import QueryInfo
+from pycrud.types import RecordMapping
+from pycrud.values import ValuesToWrite
+
+tortoise = pytest.importorskip('tortoise')
+
+from tortoise import Tortoise, fields
+from tortoise.models import Model
+
+from pycrud.crud.ext.tortoise_crud import TortoiseCrud
+
+pytestmark = [pytest.mark.asyncio]
+
+
+class User(RecordMapping):
+    id: Optional[int]
+    nickname: str
+    username: str
+    password: str = 'password'
+
+
+class MUsers(Model):
+    id = fields.IntField(pk=True)
+    username = fields.CharField(max_length=255, unique=True)
+    nickname = fields.TextField()
+    password = fields.TextField()
+
+    class Meta:
+        table = 'users'
+
+
+async def test_tortoise_crud(tmp_path):
+    await Tortoise.init(db_url='sqlite://%s' % (tmp_path / 'test.db'), modules={'models': [__name__]})
+    await Tortoise.generate_schemas()
+
+    try:
+        c = TortoiseCrud(None, {User: MUsers})
+
+        def new_user(name):
+            return ValuesToWrite({'username': name, 'nickname': name, 'password': 'p'}, User)
+
+        assert await c.insert_many(User, [new_user('a'), new_user('b')]) == [1, 2]
+
+        # DO NOTHING 时已有行的 id 按键查询取得，查询结果的行按位置访问
+        ids = await c.upsert_many(User, [new_user('b'), new_user('c')], ['username'], [])
+        ret = await c.get_list(QueryInfo.from_json(User, {}))
+        assert [x.to_dict()['username'] for x in ret] == ['a', 'b', 'c']
+        assert ids == [ret[1].id, ret[2].id]
+
+        await c.execute_sql('ANALYZE', c.get_placeholder_generator())
+        ret = await c.get_list(QueryInfo.from_json(User, {}), with_count=COUNT_STRATEGY.ESTIMATED)
+        assert ret.rows_count == 3
+        assert ret.rows_count_estimated
+    finally:
+        await Tortoise.close_connections()
@@ -6,9 +6,10 @@ from pycrud.crud.ext.peewee_crud import PeeweeCrud
 from pycrud.crud.query_result_row import QueryResultRow
 from pycrud.error import PermissionException, InvalidQueryValue
 from pycrud.permission import RoleDefine, TablePerm, A
-from pycrud.query import QueryInfo
+from pycrud.const import QUERY_OP_COMPARE
+from pycrud.query import QueryInfo, QueryConditions, ConditionExpr
 from pycrud.values import ValuesToWrite
-from tests.test_crud import crud_db_init, User
+from tests.test_crud import crud_db_init, User, Topic
 
 pytestmark = [pytest.mark.asyncio]
 
@@ -71,6 +72,42 @@ async def test_crud_perm_query_inside():
     pass
 
 
+async def test_crud_perm_foreign_keys():
+    db, MUsers, MTopics, MTopics2 = crud_db_init()
+
+    permission = {
+        'visitor': RoleDefine({
+            User: TablePerm({
+                User.id: {A.READ, A.QUERY},
+                User.nickname: {A.READ},
+            }),
+            Topic: TablePerm({
+                Topic.id: {A.READ, A.QUERY},
+                Topic.title: {A.READ},
+                Topic.user_id: {A.READ},
+            }),
+        }, match=None),
+    }
+
+    c = PeeweeCrud(permission, {User: MUsers, Topic: MTopics}, db)
+
+    def fk_query():
+        # 外键的关联条件与过滤条件不受 QUERY 权限影响
+        return QueryInfo(Topic, [Topic.id, Topic.title], conditions=QueryConditions([
+            ConditionExpr(Topic.user_id, QUERY_OP_COMPARE.EQ, User.id),
+            ConditionExpr(Topic.title, QUERY_OP_COMPARE.NE, 'test'),
+        ]))
+
+    info = QueryInfo.from_json(User, {'id.eq': 1})
+    # topic[] 直接查询外键表，topic 每个上级只取一条且关联列不是 id，以 join 查询，两者结果一致
+    info.foreign_keys = {'topic[]': fk_query(), 'topic': fk_query()}
+
+    ret = await c.get_list_with_foreign_keys(info, perm=PermInfo(True, None, permission['visitor']))
+    d = ret[0].to_dict()
+    assert d['$extra']['topic[]'] == [{'id': 2}]
+    assert d['$extra']['topic'] == {'id': 2}
+
+
 async def test_crud_perm_write():
     db, MUsers, MTopics, MTopics2 = crud_db_init()
 
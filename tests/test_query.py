@@ -26,3 +26,45 @@ def test_values_bug_2():
     }, from_http_query=True)
 
     assert qi.conditions.items[0].value[0] == binascii.unhexlify('5ef99253000000041d4164ef')
+
+
+def test_query_fingerprint():
+    a = QueryInfo.from_json(User, {
+        'id.in': [3, 1, 2, 2],
+        'username.eq': 'u',
+        '$or': {'id.gt': 1, 'nickname.prefix': 'a'},
+        '$order-by': 'id.desc',
+    })
+    b = QueryInfo.from_json(User, {
+        '$or': {'nickname.prefix': 'a', 'id.gt': 1},
+        'username.eq': 'u',
+        'id.in': [1, 2, 3],
+        '$order-by': 'id.desc',
+    })
+    assert a.fingerprint() == b.fingerprint()
+    assert a.fingerprint().digest == b.fingerprint().digest
+    assert a.fingerprint().values == (1, 'a', (1, 2, 3), 'u', 20)
+
+    # 参数值不同，结构相同
+    c = QueryInfo.from_json(User, {
+        'id.in': [4],
+        'username.eq': 'u2',
+        '$or': {'id.gt': 5, 'nickname.prefix': 'b'},
+        '$order-by': 'id.desc',
+    })
+    assert c.fingerprint().shape == a.fingerprint().shape
+    assert c.fingerprint().digest != a.fingerprint().digest
+
+    # 排序与选择项影响结构
+    d = QueryInfo.from_json(User, {'id.in': [1, 2, 3], '$order-by': 'id.asc'})
+    e = QueryInfo.from_json(User, {'id.in': [1, 2, 3], '$order-by': 'id.asc', '$select': 'id'})
+    assert len({a.fingerprint().shape, d.fingerprint().shape, e.fingerprint().shape}) == 3
+
+
+def test_query_fingerprint_nested_logic():
+    a = QueryInfo.from_table_raw(User, where=[(User.id == 1) & ((User.id == 2) & (User.nickname == 'a'))])
+    b = QueryInfo.from_table_raw(User, where=[User.nickname == 'a', User.id == 2, User.id == 1])
+    assert a.fingerprint() == b.fingerprint()
+
+    c = QueryInfo.from_table_raw(User, where=[(User.id == 1) | (User.id == 2)])
+    assert c.fingerprint() != a.fingerprint()
@@ -0,0 +1,90 @@
+from typing import Optional
+
+import peewee
+import pytest
+
+from pycrud.const import QUERY_OP_COMPARE, QUERY_OP_RELATION
+from pycrud.crud.ext.peewee_crud import PeeweeCrud
+from pycrud.query import QueryInfo, QueryConditions, ConditionExpr, ConditionLogicExpr, NegatedExpr, condition_fingerprint
+from pycrud.query_optimizer import optimize_conditions
+from pycrud.types import RecordMapping
+
+
+class User(RecordMapping):
+    id: Optional[int]
+    nickname: str
+    username: str
+
+
+def test_optimizer_flatten_and_dedupe():
+    c = QueryConditions([(User.id > 1) & ((User.nickname == 'a') & (User.id > 1)), User.username == 'b'])
+    r = optimize_conditions(c)
+    assert condition_fingerprint(r) == condition_fingerprint(
+        QueryConditions([User.id > 1, User.nickname == 'a', User.username == 'b']))
+
+    # 不修改传入的条件
+    assert len(c.items) == 2
+
+
+def test_optimizer_or_to_in():
+    c = QueryConditions([(User.id == 1) | (User.id == 2) | User.id.in_([2, 3]) | (User.nickname == 'a')])
+    r = optimize_conditions(c)
+    assert len(r.items) == 1
+    expr = r.items[0]
+    assert isinstance(expr, ConditionLogicExpr) and expr.type == 'or'
+    assert expr.items[0].op == QUERY_OP_RELATION.IN
+    assert expr.items[0].value == [1, 2, 3]
+
+
+def test_optimizer_contradiction():
+    assert optimize_conditions(QueryConditions([User.id == 1, User.id == 2])) is None
+    assert optimize_conditions(QueryConditions([User.id.in_([1, 2]), User.id > 5])) is None
+    assert optimize_conditions(QueryConditions([User.id.in_([])])) is None
+    assert optimize_conditions(QueryConditions([ConditionLogicExpr('or', [
+        (User.id == 1) & (User.id == 2),
+        (User.id == 1) & (User.id == 3),
+    ])])) is None
+
+    r = optimize_conditions(QueryConditions([User.id.in_([1, 2, 3]), User.id != 2]))
+    assert r.items[0].op == QUERY_OP_RELATION.IN
+    assert r.items[0].value == [1, 3]
+
+    # 一侧永远不成立的 OR
+    r = optimize_conditions(QueryConditions([ConditionLogicExpr('or', [
+        (User.id == 1) & (User.id == 2),
+        User.nickname == 'a',
+    ])]))
+    assert condition_fingerprint(r) == condition_fingerprint(QueryConditions([User.nickname == 'a']))
+
+    # NOT 之下 NULL 与 FALSE 不等价，保持原样
+    r = optimize_conditions(QueryConditions([NegatedExpr(ConditionLogicExpr('and', [User.id == 1, User.id == 2]))]))
+    assert r is not None and isinstance(r.items[0], NegatedExpr)
+
+    # 与 NULL 比较不做推断
+    r = optimize_conditions(QueryConditions([User.id == 1, ConditionExpr(User.id, QUERY_OP_COMPARE.NE, None)]))
+    assert len(r.items) == 2
+
+
+@pytest.mark.asyncio
+async def test_optimizer_collation():
+    # 字符串的比较取决于排序规则，类型不同的值取决于类型转换，都不做推断
+    for items in [[User.username == 'Bob', User.username == 'bob'],
+                  [User.username.in_(['Bob', 'x']), User.username != 'bob'],
+                  [User.username > 'a', User.username == 'B'],
+                  [User.id == 1, User.id == '1']]:
+        r = optimize_conditions(QueryConditions(items))
+        assert r is not None and len(r.items) == 2
+
+    db = peewee.SqliteDatabase(':memory:')
+    db.execute_sql('CREATE TABLE users (id INTEGER PRIMARY KEY, nickname TEXT, username TEXT COLLATE NOCASE)')
+    db.execute_sql("INSERT INTO users (nickname, username) VALUES ('n', 'Bob')")
+    c = PeeweeCrud(None, {User: 'users'}, db)
+
+    for optimizer in (True, False):
+        c.condition_optimizer = optimizer
+        ret = await c.get_list(QueryInfo.from_json(User, {'username.eq': 'Bob', 'username.eq.2': 'bob'}))
+        assert [x.id for x in ret] == [1]
+        ret = await c.get_list(QueryInfo.from_json(User, {'username.in': ['Bob', 'x'], 'username.ne': 'bob'}))
+        assert [x.id for x in ret] == []
+        ret = await c.get_list(QueryInfo.from_json(User, {'id.eq': 1, 'id.eq.2': '1'}))
+        assert [x.id for x in ret] == [1]
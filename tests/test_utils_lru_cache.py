@@ -0,0 +1,39 @@
+from pycrud.utils.lru_cache import LRUCache
+
+
+def test_lru_cache_evict():
+    c = LRUCache(2)
+    c.set('a', 1)
+    c.set('b', 2)
+    assert c.get('a') == 1
+
+    # b 最久未使用，被淘汰
+    c.set('c', 3)
+    assert 'b' not in c
+    assert len(c) == 2
+
+
+def test_lru_cache_counter():
+    c = LRUCache(2)
+    c.set('a', 1)
+    assert c.get('a') == 1
+    assert c.get('b') is None
+    assert c.get('b', 0) == 0
+    assert c.hits == 1
+    assert c.misses == 2
+    assert c.hit_ratio == 1 / 3
+
+
+def test_lru_cache_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('pycrud.utils.lru_cache.time.monotonic', lambda: now[0])
+
+    c = LRUCache(2, ttl=10)
+    c.set('a', 1)
+    assert c.get('a') == 1
+
+    now[0] += 10
+    assert 'a' not in c
+    assert c.get('a') is None
+    assert c.misses == 1
+    assert len(c) == 0